@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks S3StorageProvisioner.provision_storage against in-process stand-ins for S3 and STS.
+
+    $ python -m benchmarks.bench_provision --concurrency 1 8 32 --latency-ms 20
+
+For each scenario and concurrency level, reports p50 / p99 latency, throughput, errors and the number of AWS calls
+made per provision. No AWS account is needed.
+"""
+import argparse
+import itertools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_aws import FakeAWSBehavior, FakeAWSClientPool
+from storage_provisioner.cache import CredentialCache
+from storage_provisioner.instrumentation import ProvisionHook, ProvisionTrace
+from storage_provisioner.provisioner import S3StorageProvisioner, ProvisionRequest
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """
+    Return the nearest-rank percentile of :param sorted_values.
+    """
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class BenchmarkResult(object):
+
+    def __init__(self, scenario: str, concurrency: int, latencies: list, errors: int, elapsed_sec: float,
+                 call_counts: dict):
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed_sec = elapsed_sec
+        self.call_counts = call_counts
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies) + self.errors
+
+    def row(self) -> str:
+        calls = sum(self.call_counts.values()) / max(1, self.requests)
+        return '{:<8} {:>5} {:>10.2f} {:>10.2f} {:>12.1f} {:>7} {:>10.2f}'.format(
+            self.scenario,
+            self.concurrency,
+            percentile(self.latencies, 0.50) * 1000,
+            percentile(self.latencies, 0.99) * 1000,
+            self.requests / self.elapsed_sec,
+            self.errors,
+            calls)
+
+
+HEADER = '{:<8} {:>5} {:>10} {:>10} {:>12} {:>7} {:>10}'.format('scenario', 'conc', 'p50 ms', 'p99 ms', 'req/s',
+                                                                'errors', 'calls/req')
+
+
+def make_provisioner(behavior: FakeAWSBehavior, credential_cache: CredentialCache = None) -> S3StorageProvisioner:
+    provisioner = S3StorageProvisioner('AKIAFAKE', 'fake-secret', credential_cache=credential_cache)
+    provisioner.client_pool = FakeAWSClientPool(behavior)
+    return provisioner
+
+
+def make_requests(count: int, buckets: int, paths: int) -> list:
+    return [ProvisionRequest('bench_user', 'bench-bucket-{}'.format(i % buckets), 'streams/{}/'.format(i % paths))
+            for i in range(count)]
+
+
+def run_calls(provisioner: S3StorageProvisioner, requests: list, concurrency: int) -> tuple:
+    """
+    Call provision_storage once for each of :param requests on :param concurrency threads.
+    Return (latencies of successful calls, number of errors, elapsed seconds).
+    """
+    def provision(request: ProvisionRequest):
+        start = time.perf_counter()
+        try:
+            provisioner.provision_storage(request.user_name, request.bucket_name, request.path,
+                                          duration_sec=request.duration_sec)
+        except Exception:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(provision, requests))
+    elapsed_sec = time.perf_counter() - start
+
+    latencies = [latency for latency in results if latency is not None]
+    return latencies, len(results) - len(latencies), elapsed_sec
+
+
+# Attempts to provision into each bucket before warm_up gives up on it
+WARM_UP_ATTEMPTS = 10
+
+
+def warm_up(provisioner: S3StorageProvisioner, requests: list) -> int:
+    """
+    Provision into each bucket among :param requests once, retrying injected errors up to WARM_UP_ATTEMPTS times,
+    then reset call counts. Return the number of failed attempts.
+    """
+    errors = 0
+    for request in {request.bucket_name: request for request in requests}.values():
+        for _ in range(WARM_UP_ATTEMPTS):
+            try:
+                provisioner.provision_storage(request.user_name, request.bucket_name, request.path)
+            except Exception:
+                errors += 1
+            else:
+                break
+    provisioner.client_pool.reset_call_counts()
+    return errors
+
+
+def bench_cold(behavior: FakeAWSBehavior, requests: list, concurrency: int) -> BenchmarkResult:
+    """A new provisioner, with no pooled clients or cached buckets."""
+    provisioner = make_provisioner(behavior)
+    latencies, errors, elapsed_sec = run_calls(provisioner, requests, concurrency)
+    return BenchmarkResult('cold', concurrency, latencies, errors, elapsed_sec,
+                           provisioner.client_pool.call_counts())
+
+
+def bench_warm(behavior: FakeAWSBehavior, requests: list, concurrency: int) -> BenchmarkResult:
+    """A provisioner that has already provisioned into every bucket."""
+    provisioner = make_provisioner(behavior)
+    warm_up(provisioner, requests)
+    latencies, errors, elapsed_sec = run_calls(provisioner, requests, concurrency)
+    return BenchmarkResult('warm', concurrency, latencies, errors, elapsed_sec,
+                           provisioner.client_pool.call_counts())
+
+
+def bench_cached(behavior: FakeAWSBehavior, requests: list, concurrency: int) -> BenchmarkResult:
+    """A warm provisioner with a CredentialCache, so repeated paths skip STS."""
+    provisioner = make_provisioner(behavior, credential_cache=CredentialCache())
+    warm_up(provisioner, requests)
+    latencies, errors, elapsed_sec = run_calls(provisioner, requests, concurrency)
+    provisioner.credential_cache.close()
+    return BenchmarkResult('cached', concurrency, latencies, errors, elapsed_sec,
+                           provisioner.client_pool.call_counts())
+
+
+class LatencyHook(ProvisionHook):
+    """
+        Records the duration of each successful provision.
+    """
+
+    def __init__(self):
+        self.latencies = []
+
+    def on_provision(self, trace: ProvisionTrace):
+        if trace.outcome == 'ok':
+            self.latencies.append(trace.duration_sec)
+
+
+def bench_batch(behavior: FakeAWSBehavior, requests: list, concurrency: int) -> BenchmarkResult:
+    """
+    A new provisioner, provisioning every request through provision_storage_many. A request's latency is that of its
+    provision, from the provisioner's traces, so excludes waiting for a worker and for its bucket's shared check.
+    """
+    provisioner = make_provisioner(behavior)
+    hook = LatencyHook()
+    provisioner.instrumentation.add_hook(hook)
+    errors = 0
+
+    start = time.perf_counter()
+    for result in provisioner.provision_storage_many(requests, max_workers=concurrency):
+        if result.error is not None:
+            errors += 1
+    elapsed_sec = time.perf_counter() - start
+
+    return BenchmarkResult('batch', concurrency, hook.latencies, errors, elapsed_sec,
+                           provisioner.client_pool.call_counts())
+
+
+SCENARIOS = {
+    'cold': bench_cold,
+    'warm': bench_warm,
+    'cached': bench_cached,
+    'batch': bench_batch,
+}
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS),
+                        default=['cold', 'warm', 'cached', 'batch'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='provisions per scenario and concurrency level')
+    parser.add_argument('--buckets', type=int, default=2, help='distinct buckets among requests')
+    parser.add_argument('--paths', type=int, default=50, help='distinct paths among requests')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='mean latency of each AWS call')
+    parser.add_argument('--jitter-ms', type=float, default=5.0, help='maximum deviation from the mean latency')
+    parser.add_argument('--client-creation-ms', type=float, default=50.0, help='time to create each AWS client')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of AWS calls failing')
+    parser.add_argument('--error-code', default='Throttling', help='AWS error code of injected errors')
+    args = parser.parse_args(argv)
+
+    behavior = FakeAWSBehavior(latency_sec=args.latency_ms / 1000,
+                               latency_jitter_sec=args.jitter_ms / 1000,
+                               error_rate=args.error_rate,
+                               error_code=args.error_code,
+                               client_creation_sec=args.client_creation_ms / 1000)
+    requests = make_requests(args.requests, args.buckets, args.paths)
+
+    print(HEADER)
+    for scenario, concurrency in itertools.product(args.scenarios, args.concurrency):
+        print(SCENARIOS[scenario](behavior, requests, concurrency).row())
+
+
+if __name__ == '__main__':
+    main()
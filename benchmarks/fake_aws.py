@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-ins for the S3 and STS clients used by S3StorageProvisioner, with configurable latency and error
+injection. No network calls are made.
+"""
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from storage_provisioner.provisioner import AWSClientPool
+
+
+class FakeAWSBehavior(object):
+    """
+        Latency and errors injected into every call made to a fake client.
+    """
+
+    def __init__(self,
+                 latency_sec: float = 0.02,
+                 latency_jitter_sec: float = 0.005,
+                 error_rate: float = 0.0,
+                 error_code: str = 'Throttling',
+                 client_creation_sec: float = 0.05):
+        """
+        :param latency_sec: the mean latency of each API call.
+        :param latency_jitter_sec: the maximum random deviation from :param latency_sec.
+        :param error_rate: the fraction of API calls failing with :param error_code.
+        :param error_code: the AWS error code of injected errors.
+        :param client_creation_sec: the time taken to create a client, standing in for endpoint and model loading
+        and the first TLS handshake.
+        """
+        self.latency_sec = latency_sec
+        self.latency_jitter_sec = latency_jitter_sec
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.client_creation_sec = client_creation_sec
+
+    def call(self, operation_name: str):
+        time.sleep(max(0.0, self.latency_sec + random.uniform(-self.latency_jitter_sec, self.latency_jitter_sec)))
+        if self.error_rate and random.random() < self.error_rate:
+            raise ClientError({'Error': {'Code': self.error_code, 'Message': 'Injected error'},
+                               'ResponseMetadata': {'HTTPStatusCode': 400}}, operation_name)
+
+
+class FakeClient(object):
+    """
+        Records the number of calls made to each operation.
+    """
+
+    def __init__(self, behavior: FakeAWSBehavior, region_name: str):
+        self.behavior = behavior
+        self.region_name = region_name
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _call(self, operation_name: str):
+        with self._lock:
+            self.calls[operation_name] = self.calls.get(operation_name, 0) + 1
+        self.behavior.call(operation_name)
+
+
+class FakeS3Client(FakeClient):
+
+    def __init__(self, behavior: FakeAWSBehavior, region_name: str, buckets: set):
+        FakeClient.__init__(self, behavior, region_name)
+        self.buckets = buckets
+
+    def head_bucket(self, Bucket: str):
+        self._call('HeadBucket')
+        if Bucket not in self.buckets:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadBucket')
+        return {}
+
+    def create_bucket(self, Bucket: str, CreateBucketConfiguration: dict = None):
+        self._call('CreateBucket')
+        with self._lock:
+            if Bucket in self.buckets:
+                raise ClientError({'Error': {'Code': 'BucketAlreadyOwnedByYou', 'Message': 'Owned'}}, 'CreateBucket')
+            self.buckets.add(Bucket)
+        return {}
+
+
+class FakeSTSClient(FakeClient):
+
+    def get_federation_token(self, Name: str, Policy: str, DurationSeconds: int):
+        self._call('GetFederationToken')
+        token_id = '{:016X}'.format(random.getrandbits(64))
+        return {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + token_id,
+                'SecretAccessKey': 'secret' + token_id,
+                'SessionToken': 'token' + token_id,
+                'Expiration': datetime.now(timezone.utc) + timedelta(seconds=DurationSeconds),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:{}'.format(Name),
+                'Arn': 'arn:aws:sts::123456789012:federated-user/{}'.format(Name),
+            },
+            'PackedPolicySize': 10,
+            'ResponseMetadata': {'RetryAttempts': 0},
+        }
+
+
+class FakeAWSClientPool(AWSClientPool):
+    """
+        An AWSClientPool creating fake S3 and STS clients that share one set of buckets.
+    """
+
+    def __init__(self, behavior: FakeAWSBehavior = None, buckets: set = None):
+        AWSClientPool.__init__(self, 'AKIAFAKE', 'fake-secret')
+        self.behavior = behavior if behavior is not None else FakeAWSBehavior()
+        self.buckets = buckets if buckets is not None else set()
+
+    def create_session(self, region_name: str):
+        # Fake clients don't need a session, but the pool caches whatever is returned here
+        return region_name
+
+    def create_client(self, session, service_name: str, region_name: str, endpoint_url: str = None):
+        time.sleep(self.behavior.client_creation_sec)
+        if service_name == 's3':
+            return FakeS3Client(self.behavior, region_name, self.buckets)
+        if service_name == 'sts':
+            return FakeSTSClient(self.behavior, region_name)
+        raise ValueError('No fake client for {}'.format(service_name))
+
+    def reset_call_counts(self):
+        for client in self._clients.values():
+            client.calls.clear()
+
+    def call_counts(self) -> dict:
+        counts = {}
+        for client in self._clients.values():
+            for operation_name, count in client.calls.items():
+                counts[operation_name] = counts.get(operation_name, 0) + count
+        return counts
@@ -33,16 +33,24 @@ setup(
                  'storage_provisioner'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'aio': ['aiobotocore'],
+    },
     license="Apache License 2.0",
     zip_safe=False,
+    python_requires='>=3.7',
     keywords='storage_provisioner, aws, boto',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     test_suite='tests',
     tests_require=requirements
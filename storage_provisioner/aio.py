@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from contextlib import AsyncExitStack
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+from storage_provisioner.cache import BucketCache, credential_cache_key, DEFAULT_BUCKET_CACHE_TTL_SEC
+from storage_provisioner.policy import PolicyTemplate, to_policy_template, validate_policy_size
+from storage_provisioner.provisioner import DEFAULT_AWS_S3_REGION, s3_storage_from_federation_token
+from storage_provisioner.singleflight import AsyncSingleFlight
+from storage_provisioner.storage import Storage, S3Storage, AWSS3Region
+
+
+class AsyncStorageProvisioner(object):
+    """
+        Abstract class. Creates and provisions storage endpoints for arbitrary client data without blocking the event
+        loop.
+    """
+
+    def __init__(self):
+        pass
+
+    async def provision_storage(self) -> Storage:
+        raise NotImplementedError
+
+
+# region Amazon AWS Constants
+
+DEFAULT_AWS_ASYNC_MAX_CONCURRENCY = 100
+
+# endregion
+
+# region Amazon AWS S3 Async Provisioner
+
+
+class AsyncS3StorageProvisioner(AsyncStorageProvisioner):
+    """
+        Creates and provisions AWS S3 storage endpoints for arbitrary client data, using aiobotocore's non-blocking
+        HTTP transport. The asyncio counterpart of S3StorageProvisioner.
+
+        Clients are created once per region on first use and must be released with close(), or by using the
+        provisioner as an async context manager.
+    """
+
+    def __init__(self,
+                 aws_access_key_id: str,
+                 aws_secret_access_key: str,
+                 default_region: AWSS3Region = DEFAULT_AWS_S3_REGION,
+                 default_policy: PolicyTemplate = None,
+                 max_concurrency: int = DEFAULT_AWS_ASYNC_MAX_CONCURRENCY,
+                 region_max_concurrency: dict = None,
+                 bucket_cache_ttl_sec: float = DEFAULT_BUCKET_CACHE_TTL_SEC,
+                 coalesce_requests: bool = True):
+        """
+        :param aws_access_key_id:
+        :param aws_secret_access_key:
+        :param default_region:
+        :param default_policy: the PolicyTemplate, or template string, used when provision_storage is called without
+        a user_policy. DEFAULT_AWS_S3_POLICY if None.
+        :param max_concurrency: the maximum number of AWS requests in flight at once in each region.
+        :param region_max_concurrency: a dict of AWSS3Region to the maximum number of AWS requests in flight at once
+        in that region, overriding :param max_concurrency.
+        :param bucket_cache_ttl_sec: how long a bucket is assumed to exist after a successful head or create.
+        If 0, every call to provision_storage checks the bucket.
+        :param coalesce_requests: if True, concurrent calls to provision_storage with the same arguments share one
+        federation token, and concurrent checks of the same bucket share one head_bucket.
+        """
+        AsyncStorageProvisioner.__init__(self)
+
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.default_region = default_region
+        self.default_policy = to_policy_template(default_policy)
+        self.max_concurrency = max_concurrency
+        self.region_max_concurrency = {region.value: limit
+                                       for region, limit in (region_max_concurrency or {}).items()}
+        self.bucket_cache = BucketCache(bucket_cache_ttl_sec)
+        self.coalesce_requests = coalesce_requests
+        self._bucket_checks = AsyncSingleFlight()
+        self._provisions = AsyncSingleFlight()
+
+        self._session = get_session()
+        self._exit_stack = AsyncExitStack()
+        self._clients = {}
+        self._semaphores = {}
+        # Created on first use, so that they belong to the running event loop
+        self._client_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """
+        Close all clients and their connections. Subsequent calls will create new ones.
+        """
+        exit_stack, self._exit_stack = self._exit_stack, AsyncExitStack()
+        self._clients = {}
+        await exit_stack.aclose()
+
+    def region_concurrency(self, region_name: str) -> int:
+        return self.region_max_concurrency.get(region_name, self.max_concurrency)
+
+    async def client(self, service_name: str, region_name: str):
+        """
+        Return the shared aiobotocore client for :param service_name in :param region_name, creating it if necessary.
+        """
+        key = (service_name, region_name)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        if self._client_lock is None:
+            self._client_lock = asyncio.Lock()
+
+        async with self._client_lock:
+            client = self._clients.get(key)
+            if client is None:
+                config = AioConfig(max_pool_connections=self.region_concurrency(region_name))
+                client = await self._exit_stack.enter_async_context(
+                    self._session.create_client(service_name,
+                                                region_name=region_name,
+                                                aws_access_key_id=self.aws_access_key_id,
+                                                aws_secret_access_key=self.aws_secret_access_key,
+                                                config=config))
+                self._clients[key] = client
+        return client
+
+    def _semaphore(self, region_name: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(region_name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.region_concurrency(region_name))
+            self._semaphores[region_name] = semaphore
+        return semaphore
+
+    async def create_federation_token(self,
+                                      user_name: str,
+                                      user_policy: str,
+                                      duration_sec: int = 129600,
+                                      region: AWSS3Region = None,
+                                      ) -> dict:
+        if region is None:
+            region = self.default_region
+
+        sts = await self.client('sts', region.value)
+        async with self._semaphore(region.value):
+            token_resp = await sts.get_federation_token(Name=user_name[:32],
+                                                        Policy=user_policy,
+                                                        DurationSeconds=duration_sec)
+        return token_resp
+
+    async def create_bucket_if_needed(self,
+                                      bucket_name: str,
+                                      region: AWSS3Region,
+                                      bucket_policy: str = None, ):
+        region_name = region.value
+
+        if self.bucket_cache.contains(bucket_name, region_name):
+            return
+
+        if self.coalesce_requests:
+            await self._bucket_checks.do((bucket_name, region_name), self._create_bucket_if_needed, bucket_name,
+                                         region_name)
+        else:
+            await self._create_bucket_if_needed(bucket_name, region_name)
+
+    async def _create_bucket_if_needed(self, bucket_name: str, region_name: str):
+        s3 = await self.client('s3', region_name)
+
+        async with self._semaphore(region_name):
+            bucket_exists = True
+            try:
+                await s3.head_bucket(Bucket=bucket_name)
+            except ClientError as e:
+                # See S3StorageProvisioner.create_bucket_if_needed
+                error_code = e.response['Error']['Code']
+                if error_code in ('404', 'NoSuchBucket'):
+                    bucket_exists = False
+                else:
+                    return
+
+            if not bucket_exists:
+                try:
+                    await s3.create_bucket(Bucket=bucket_name,
+                                           CreateBucketConfiguration={'LocationConstraint': region_name})
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'BucketAlreadyOwnedByYou':
+                        raise
+
+        self.bucket_cache.add(bucket_name, region_name)
+
+    async def provision_storage(self,
+                                user_name: str,
+                                bucket_name: str,
+                                path: str = None,
+                                region: AWSS3Region = None,
+                                user_policy: str = None,
+                                duration_sec: int = 129600) -> S3Storage:
+        """
+        Provision read/write access to the S3 bucket and path, creating the bucket if necessary.
+        Takes the same arguments as S3StorageProvisioner.provision_storage.
+
+        :return:
+        """
+
+        if region is None:
+            region = self.default_region
+
+        if user_policy is None:
+            user_policy = self.default_policy.render(bucket_name, path)
+        else:
+            validate_policy_size(user_policy)
+
+        if self.coalesce_requests:
+            key = credential_cache_key(user_name, user_policy, bucket_name, path, region.value, duration_sec)
+            return await self._provisions.do(key, self._provision_new_storage,
+                                             user_name, bucket_name, path, region, user_policy, duration_sec)
+        return await self._provision_new_storage(user_name, bucket_name, path, region, user_policy, duration_sec)
+
+    async def _provision_new_storage(self,
+                                     user_name: str,
+                                     bucket_name: str,
+                                     path: str,
+                                     region: AWSS3Region,
+                                     user_policy: str,
+                                     duration_sec: int) -> S3Storage:
+        await self.create_bucket_if_needed(bucket_name=bucket_name,
+                                           region=region)
+
+        token_resp = await self.create_federation_token(user_name=user_name,
+                                                        user_policy=user_policy,
+                                                        duration_sec=duration_sec,
+                                                        region=region)
+
+        return s3_storage_from_federation_token(token_resp, bucket_name, region.value, path, user_policy)
+
+# endregion
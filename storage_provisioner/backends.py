@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+A registry of storage provisioner backends by name, e.g: 's3' or 'local'.
+
+Backends are registered as 'module:ClassName' strings and only imported when first requested, so that processes which
+never use a backend, e.g: a CLI only writing local files, don't pay for importing its dependencies.
+"""
+import importlib
+import threading
+
+# region Backend Registry
+
+_BACKENDS = {
+    'local': 'storage_provisioner.provisioner:LocalFileStorageProvisioner',
+    's3': 'storage_provisioner.provisioner:S3StorageProvisioner',
+    'aio_s3': 'storage_provisioner.aio:AsyncS3StorageProvisioner',
+}
+
+_lock = threading.Lock()
+
+
+def register_backend(name: str, provisioner):
+    """
+    Register a provisioner under :param name, replacing any backend already registered under it.
+
+    :param name: the name passed to get_provisioner_class and create_provisioner.
+    :param provisioner: a provisioner class, or a 'module:ClassName' string imported when the backend is first used.
+    """
+    if isinstance(provisioner, str) and ':' not in provisioner:
+        raise ValueError('Expected a provisioner class or a "module:ClassName" string, got {!r}'.format(provisioner))
+    with _lock:
+        _BACKENDS[name] = provisioner
+
+
+def available_backends() -> list:
+    """
+    Return the names of all registered backends, whether or not they have been imported.
+    """
+    with _lock:
+        return sorted(_BACKENDS)
+
+
+def get_provisioner_class(name: str) -> type:
+    """
+    Return the provisioner class registered under :param name, importing its module if necessary.
+    Raises ValueError if no backend is registered under :param name, and ImportError if the backend's dependencies,
+    e.g: aiobotocore for 'aio_s3', are not installed.
+    """
+    with _lock:
+        provisioner = _BACKENDS.get(name)
+    if provisioner is None:
+        raise ValueError('Unknown storage backend {!r}, expected one of {}'.format(name, available_backends()))
+    if not isinstance(provisioner, str):
+        return provisioner
+
+    module_name, class_name = provisioner.split(':', 1)
+    provisioner_class = getattr(importlib.import_module(module_name), class_name)
+
+    with _lock:
+        # Unless the backend was re-registered meanwhile, skip the import next time
+        if _BACKENDS.get(name) == provisioner:
+            _BACKENDS[name] = provisioner_class
+    return provisioner_class
+
+
+def create_provisioner(name: str, *args, **kwargs):
+    """
+    Create a provisioner of the backend registered under :param name, passing it :param args and :param kwargs.
+
+        provisioner = create_provisioner('s3', aws_access_key_id, aws_secret_access_key)
+    """
+    return get_provisioner_class(name)(*args, **kwargs)
+
+# endregion
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from storage_provisioner.storage import S3Storage
+
+logger = logging.getLogger(__name__)
+
+
+# region Bucket Cache
+
+DEFAULT_BUCKET_CACHE_TTL_SEC = 300
+
+
+class BucketCache(object):
+    """
+        Thread-safe record of buckets known to exist, keyed by (bucket name, region name).
+        Entries expire :param ttl_sec seconds after they were last added.
+    """
+
+    def __init__(self, ttl_sec: float = DEFAULT_BUCKET_CACHE_TTL_SEC):
+        """
+        :param ttl_sec: how long a bucket is assumed to exist after a successful head or create. If 0, nothing is
+        cached.
+        """
+        self.ttl_sec = ttl_sec
+        self._expirations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expirations)
+
+    def contains(self, bucket_name: str, region_name: str) -> bool:
+        """
+        Return True if :param bucket_name in :param region_name is known to exist and its entry has not expired.
+        """
+        expiration = self._expirations.get((bucket_name, region_name))
+        if expiration is None:
+            return False
+        if expiration <= time.monotonic():
+            with self._lock:
+                if self._expirations.get((bucket_name, region_name)) == expiration:
+                    del self._expirations[(bucket_name, region_name)]
+            return False
+        return True
+
+    def add(self, bucket_name: str, region_name: str):
+        """
+        Record that :param bucket_name in :param region_name exists.
+        """
+        if self.ttl_sec <= 0:
+            return
+        with self._lock:
+            self._expirations[(bucket_name, region_name)] = time.monotonic() + self.ttl_sec
+
+    def invalidate(self, bucket_name: str = None, region_name: str = None):
+        """
+        Forget matching buckets. If both parameters are None, the cache is cleared.
+
+        :param bucket_name: only forget entries for this bucket, in any region if :param region_name is None.
+        :param region_name: only forget entries in this region, for any bucket if :param bucket_name is None.
+        """
+        with self._lock:
+            if bucket_name is None and region_name is None:
+                self._expirations.clear()
+                return
+            for key in list(self._expirations):
+                if (bucket_name is None or key[0] == bucket_name) and (region_name is None or key[1] == region_name):
+                    del self._expirations[key]
+
+
+# endregion
+
+# region Credential Cache
+
+DEFAULT_CREDENTIAL_CACHE_MAX_SIZE = 50000
+
+DEFAULT_CREDENTIAL_CACHE_MIN_REMAINING_SEC = 300
+
+DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_SEC = 1800
+
+# Refresh ahead no earlier than this fraction of a storage's duration, so short-lived storages aren't due at once
+DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_FRACTION = 0.5
+
+
+def credential_cache_key(user_name: str,
+                         user_policy: str,
+                         bucket_name: str,
+                         path: str,
+                         region_name: str,
+                         duration_sec: int) -> tuple:
+    """
+    Return the key identifying the credentials produced by S3StorageProvisioner.provision_storage for these arguments.
+    """
+    return user_name[:32], user_policy, bucket_name, path, region_name, duration_sec
+
+
+class CredentialCache(object):
+    """
+        Thread-safe, size-bounded LRU cache of provisioned S3Storage objects.
+
+        A cached storage is returned while it has more than :param min_remaining_sec of lifetime left. Once fewer than
+        :param refresh_ahead_sec, or :param refresh_ahead_fraction of the duration it was requested for, remain, the
+        cached storage is still returned but a replacement is provisioned on a background thread, so callers only block
+        on the loader when an entry is missing or nearly expired.
+    """
+
+    def __init__(self,
+                 max_size: int = DEFAULT_CREDENTIAL_CACHE_MAX_SIZE,
+                 min_remaining_sec: float = DEFAULT_CREDENTIAL_CACHE_MIN_REMAINING_SEC,
+                 refresh_ahead_sec: float = DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_SEC,
+                 max_refresh_workers: int = 4,
+                 refresh_ahead_fraction: float = DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_FRACTION):
+        """
+        :param max_size: the maximum number of cached storages. The least recently used entry is evicted beyond this.
+        :param min_remaining_sec: the minimum lifetime a cached storage must have left to be returned.
+        :param refresh_ahead_sec: the remaining lifetime below which a cached storage is refreshed in the background.
+        :param max_refresh_workers: the number of threads used for background refreshes.
+        :param refresh_ahead_fraction: caps :param refresh_ahead_sec at this fraction of the duration in the key of a
+        cached storage, e.g: a storage requested for 900s is refreshed with 450s left rather than on every hit.
+        """
+        self.max_size = max_size
+        self.min_remaining_sec = min_remaining_sec
+        self.refresh_ahead_sec = refresh_ahead_sec
+        self.refresh_ahead_fraction = refresh_ahead_fraction
+        self.max_refresh_workers = max_refresh_workers
+
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple, loader) -> S3Storage:
+        """
+        Return the cached storage for :param key, calling :param loader to provision one if none is usable.
+
+        :param key: a key returned by credential_cache_key.
+        :param loader: a callable taking no arguments and returning a new S3Storage for :param key.
+        :return:
+        """
+        storage = self.peek(key)
+
+        if storage is not None:
+            seconds_remaining = storage.seconds_until_expiration()
+            if seconds_remaining > self.min_remaining_sec:
+                if seconds_remaining < self.refresh_ahead_sec_for(key):
+                    self._refresh_in_background(key, loader)
+                return storage
+
+        storage = loader()
+        self.put(key, storage)
+        return storage
+
+    def refresh_ahead_sec_for(self, key: tuple) -> float:
+        """
+        Return the remaining lifetime below which the storage cached for :param key is refreshed in the background.
+        """
+        duration_sec = key[5] if isinstance(key, tuple) and len(key) > 5 else None
+        if not duration_sec:
+            return self.refresh_ahead_sec
+        return min(self.refresh_ahead_sec, self.refresh_ahead_fraction * duration_sec)
+
+    def peek(self, key: tuple) -> S3Storage:
+        """
+        Return the cached storage for :param key, whatever its remaining lifetime, or None.
+        """
+        with self._lock:
+            storage = self._entries.get(key)
+            if storage is not None:
+                self._entries.move_to_end(key)
+        return storage
+
+    def put(self, key: tuple, storage: S3Storage):
+        with self._lock:
+            self._entries[key] = storage
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: tuple = None):
+        """
+        Forget the storage cached for :param key, or every cached storage if :param key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def close(self, wait: bool = True):
+        """
+        Stop background refreshes. If :param wait, block until in-progress refreshes finish.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _refresh_in_background(self, key: tuple, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_refresh_workers)
+            self._refreshing.add(key)
+            self._executor.submit(self._refresh, key, loader)
+
+    def _refresh(self, key: tuple, loader):
+        try:
+            storage = loader()
+        except Exception:
+            # The stale entry stays in place, and the next get will try again
+            logger.exception('Failed to refresh cached credentials for %s', key[0])
+        else:
+            self._replace(key, storage)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _replace(self, key: tuple, storage: S3Storage) -> bool:
+        """
+        Replace the cached storage for :param key with a refreshed :param storage. Return False, leaving the cache
+        unchanged, if the entry was invalidated or evicted while refreshing, so that it isn't resurrected.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._entries[key] = storage
+            return True
+
+# endregion
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.ratelimit import AdaptiveRateLimiter, THROTTLING_ERROR_CODES
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+logger = logging.getLogger(__name__)
+
+
+# region S3 Cleanup
+
+# The most keys s3.delete_objects accepts in one call
+S3_DELETE_OBJECTS_MAX_KEYS = 1000
+
+DEFAULT_CLEANUP_CONCURRENCY = 8
+
+DEFAULT_CLEANUP_MAX_ATTEMPTS = 4
+
+# DeleteObjects calls per second, before adapting to throttling
+DEFAULT_CLEANUP_DELETE_RATE = 20.0
+
+DEFAULT_CLEANUP_RETENTION_SEC = 7 * 24 * 3600
+
+# Per-key DeleteObjects error codes worth retrying
+_RETRYABLE_DELETE_ERROR_CODES = THROTTLING_ERROR_CODES | {'InternalError', 'ServiceUnavailable'}
+
+
+def _error_code(error: Exception) -> str:
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    return response.get('Error', {}).get('Code')
+
+
+class CleanupResult(object):
+
+    def __init__(self, bucket_name: str, prefix: str):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        # Objects, or object versions, listed and deleted
+        self.listed = 0
+        self.deleted = 0
+        # Incomplete multipart uploads aborted
+        self.aborted_uploads = 0
+        # key -> error code, for objects that couldn't be deleted
+        self.failed = {}
+        self.bucket_deleted = False
+
+
+class S3Cleaner(object):
+    """
+        Deletes everything under provisioned paths, with the provisioner's credentials and pooled clients.
+
+        Prefixes are listed one level down in parallel, so a path holding many streams is listed by several workers.
+        Keys are deleted in DeleteObjects batches of 1000, :param max_concurrency batches at a time. Batches go through
+        an AdaptiveRateLimiter, which slows down when S3 answers SlowDown, and keys that fail with a retryable error are
+        retried in a later batch.
+    """
+
+    def __init__(self,
+                 provisioner: S3StorageProvisioner,
+                 max_concurrency: int = DEFAULT_CLEANUP_CONCURRENCY,
+                 max_attempts: int = DEFAULT_CLEANUP_MAX_ATTEMPTS,
+                 rate_limiter: AdaptiveRateLimiter = None):
+        """
+        :param provisioner: the provisioner whose credentials and clients are used. Deleted buckets are removed from
+        its bucket cache.
+        :param max_concurrency: the number of listings, and of DeleteObjects calls, made at once.
+        :param max_attempts: the number of times a key failing with a retryable error is attempted.
+        :param rate_limiter: the limiter of DeleteObjects calls, which may be shared between cleaners. One allowing
+        DEFAULT_CLEANUP_DELETE_RATE calls per second if None.
+        """
+        self.provisioner = provisioner
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        if rate_limiter is None:
+            rate_limiter = AdaptiveRateLimiter(rate=DEFAULT_CLEANUP_DELETE_RATE,
+                                               max_rate=10 * DEFAULT_CLEANUP_DELETE_RATE,
+                                               max_waiters=max(64, max_concurrency),
+                                               max_wait_sec=60.0)
+        self.rate_limiter = rate_limiter
+
+    def _client(self, region: AWSS3Region):
+        if region is None:
+            region = self.provisioner.default_region
+        return self.provisioner.client_pool.client('s3', region.value)
+
+    def iter_objects(self, bucket_name: str, prefix: str = '', region: AWSS3Region = None, versions: bool = False):
+        """
+        Yield lists of the objects under :param prefix, as DeleteObjects identifiers: {'Key': ...}, with 'VersionId'
+        if :param versions. Pages of different sub-prefixes arrive in no particular order.
+
+        :param versions: list every version and delete marker, as needed to empty a versioned bucket.
+        """
+        client = self._client(region)
+        sub_prefixes = []
+        for objects, common_prefixes in _list_pages(client, bucket_name, prefix, '/', versions):
+            if objects:
+                yield objects
+            sub_prefixes.extend(common_prefixes)
+        if not sub_prefixes:
+            return
+
+        # Workers list one sub-prefix each into a bounded queue, so they don't run far ahead of deletion
+        pages = queue.Queue(maxsize=2 * self.max_concurrency)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def list_sub_prefix(sub_prefix: str):
+            try:
+                for objects, _ in _list_pages(client, bucket_name, sub_prefix, None, versions):
+                    if stopped.is_set():
+                        return
+                    if objects:
+                        put(objects)
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for sub_prefix in sub_prefixes:
+                executor.submit(list_sub_prefix, sub_prefix)
+            try:
+                remaining = len(sub_prefixes)
+                while remaining:
+                    item = pages.get()
+                    if item is done:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stopped.set()
+
+    def delete_prefix(self,
+                      bucket_name: str,
+                      prefix: str,
+                      region: AWSS3Region = None,
+                      versions: bool = False,
+                      abort_uploads: bool = True,
+                      progress=None) -> CleanupResult:
+        """
+        Delete every object under :param prefix in :param bucket_name.
+
+        :param versions: delete every version and delete marker, rather than only adding delete markers in a versioned
+        bucket.
+        :param abort_uploads: also abort incomplete multipart uploads under :param prefix, e.g: those left by
+        S3Storage.upload with a state_path.
+        :param progress: an optional callable taking the CleanupResult, called after each batch.
+        """
+        client = self._client(region)
+        result = CleanupResult(bucket_name, prefix)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = set()
+            batch = []
+
+            def submit(objects: list):
+                nonlocal pending
+                if len(pending) >= self.max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._record(result, done, progress)
+                pending.add(executor.submit(self._delete_batch, client, bucket_name, objects))
+
+            for objects in self.iter_objects(bucket_name, prefix, region, versions):
+                result.listed += len(objects)
+                batch.extend(objects)
+                while len(batch) >= S3_DELETE_OBJECTS_MAX_KEYS:
+                    submit(batch[:S3_DELETE_OBJECTS_MAX_KEYS])
+                    batch = batch[S3_DELETE_OBJECTS_MAX_KEYS:]
+            if batch:
+                submit(batch)
+            self._record(result, wait(pending).done, progress)
+
+        if abort_uploads:
+            result.aborted_uploads = self._abort_uploads(client, bucket_name, prefix)
+        return result
+
+    def delete_bucket(self, bucket_name: str, region: AWSS3Region = None, progress=None) -> CleanupResult:
+        """
+        Delete every object version in :param bucket_name, then the bucket itself. A bucket that doesn't exist is
+        left alone. The bucket is forgotten by the provisioner's bucket cache either way.
+        """
+        if region is None:
+            region = self.provisioner.default_region
+        try:
+            result = self.delete_prefix(bucket_name, '', region, versions=True, progress=progress)
+            if not result.failed:
+                self._client(region).delete_bucket(Bucket=bucket_name)
+                result.bucket_deleted = True
+        except Exception as e:
+            if _error_code(e) != 'NoSuchBucket':
+                raise
+            result = CleanupResult(bucket_name, '')
+        finally:
+            self.provisioner.bucket_cache.invalidate(bucket_name, region.value)
+        return result
+
+    def sweep_expired(self,
+                      storages,
+                      retention_sec: float = DEFAULT_CLEANUP_RETENTION_SEC,
+                      progress=None) -> list:
+        """
+        Delete the paths of :param storages whose credentials expired more than :param retention_sec ago, returning a
+        CleanupResult for each path swept. Storages sharing a path are swept once. Storages without a path, which
+        would empty the whole bucket, are skipped.
+
+        A path is swept as a folder: 'streams/1' sweeps 'streams/1/', leaving 'streams/10/' alone, although the
+        storage's policy grants access to both.
+
+        :param storages: S3Storages, e.g: restored with S3Storage.from_dict from a record of what was provisioned.
+        """
+        swept = set()
+        results = []
+        for storage in storages:
+            if storage.seconds_until_expiration() > -retention_sec:
+                continue
+            path = storage.s3_bucket_path
+            if not path:
+                logger.warning('Not sweeping all of %s for a storage without a path', storage.s3_bucket_name)
+                continue
+            if not path.endswith('/'):
+                path += '/'
+            location = (storage.s3_bucket_name, path)
+            if location in swept:
+                continue
+            swept.add(location)
+            results.append(self.delete_prefix(storage.s3_bucket_name,
+                                              path,
+                                              _storage_region(storage),
+                                              progress=progress))
+        return results
+
+    def _delete_batch(self, client, bucket_name: str, objects: list) -> tuple:
+        """
+        Return (number of objects deleted, {key: error code} for those that weren't).
+        """
+        deleted = 0
+        failed = {}
+        attempt = 0
+        while objects:
+            attempt += 1
+            resp = self.rate_limiter.call(client.delete_objects,
+                                          Bucket=bucket_name,
+                                          Delete={'Objects': objects, 'Quiet': True})
+            errors = resp.get('Errors', ())
+            deleted += len(objects) - len(errors)
+
+            retry = []
+            throttled = False
+            for error in errors:
+                if error['Code'] in _RETRYABLE_DELETE_ERROR_CODES and attempt < self.max_attempts:
+                    identifier = {'Key': error['Key']}
+                    if error.get('VersionId') is not None:
+                        identifier['VersionId'] = error['VersionId']
+                    retry.append(identifier)
+                    throttled = throttled or error['Code'] in THROTTLING_ERROR_CODES
+                else:
+                    failed[error['Key']] = error['Code']
+            if retry:
+                if throttled:
+                    self.rate_limiter.on_throttle()
+                time.sleep(self.rate_limiter.backoff_sec(attempt))
+            objects = retry
+        return deleted, failed
+
+    @staticmethod
+    def _record(result: CleanupResult, futures, progress):
+        for future in futures:
+            deleted, failed = future.result()
+            result.deleted += deleted
+            result.failed.update(failed)
+            if progress is not None:
+                progress(result)
+
+    @staticmethod
+    def _abort_uploads(client, bucket_name: str, prefix: str) -> int:
+        aborted = 0
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+        while True:
+            resp = client.list_multipart_uploads(**kwargs)
+            for upload in resp.get('Uploads', ()):
+                client.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+                aborted += 1
+            if not resp.get('IsTruncated'):
+                return aborted
+            kwargs['KeyMarker'] = resp['NextKeyMarker']
+            kwargs['UploadIdMarker'] = resp['NextUploadIdMarker']
+
+
+def _storage_region(storage: S3Storage) -> AWSS3Region:
+    region = storage.s3_bucket_region
+    return region if isinstance(region, AWSS3Region) else AWSS3Region(region)
+
+
+def _list_pages(client, bucket_name: str, prefix: str, delimiter: str, versions: bool):
+    """
+    Yield (DeleteObjects identifiers, common prefixes) for each page listing :param prefix.
+    """
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+    while True:
+        if versions:
+            resp = client.list_object_versions(**kwargs)
+            objects = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                       for version in resp.get('Versions', []) + resp.get('DeleteMarkers', [])]
+        else:
+            resp = client.list_objects_v2(**kwargs)
+            objects = [{'Key': content['Key']} for content in resp.get('Contents', ())]
+        yield objects, [common['Prefix'] for common in resp.get('CommonPrefixes', ())]
+
+        if not resp.get('IsTruncated'):
+            return
+        if versions:
+            kwargs['KeyMarker'] = resp['NextKeyMarker']
+            kwargs['VersionIdMarker'] = resp['NextVersionIdMarker']
+        else:
+            kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+# endregion
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from storage_provisioner.ratelimit import is_server_error, is_throttling_error
+
+logger = logging.getLogger(__name__)
+
+
+# region Hedged Requests
+
+DEFAULT_HEDGE_PERCENTILE = 95.0
+
+DEFAULT_HEDGE_INITIAL_DELAY_SEC = 0.5
+
+DEFAULT_HEDGE_MIN_DELAY_SEC = 0.02
+
+DEFAULT_HEDGE_MAX_DELAY_SEC = 2.0
+
+DEFAULT_HEDGE_LATENCY_WINDOW = 128
+
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 5
+
+DEFAULT_CIRCUIT_COOLDOWN_SEC = 30.0
+
+# Weight of the latest latency in an endpoint's moving average
+_EWMA_ALPHA = 0.2
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """
+    Return True if :param error suggests the endpoint, rather than the request, is at fault: a connection error or
+    timeout, or a 5xx response. Other errors, e.g: invalid parameters or missing credentials, would fail the same way
+    against every endpoint.
+    """
+    return is_server_error(error)
+
+
+class EndpointHealth(object):
+    """
+        Recent latencies and circuit breaker state of one endpoint, e.g: a regional STS endpoint.
+
+        The circuit opens after :param failure_threshold consecutive endpoint failures. An open endpoint is skipped for
+        cooldown_sec, after which requests are let through again as probes: a success closes the circuit, and a failure
+        opens it for another cooldown.
+    """
+
+    __slots__ = ('name', 'latencies', 'ewma_sec', 'consecutive_failures', 'open_until', 'requests', 'failures')
+
+    def __init__(self, name: str, window: int = DEFAULT_HEDGE_LATENCY_WINDOW):
+        self.name = name
+        self.latencies = deque(maxlen=window)
+        self.ewma_sec = None
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Return the :param percentile (0-100) of recent latencies, or None if there are none.
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+
+class HedgedCaller(object):
+    """
+        Calls a function against the fastest healthy endpoint and, if it hasn't answered within its recent
+        :param hedge_percentile latency, calls it again against the next fastest, returning whichever answers first.
+
+        Endpoints are ranked by a moving average of their latency; endpoints not yet measured rank after measured ones,
+        in the order given. Latencies of hedged calls that lose the race are still recorded, so alternates stay ranked.
+        An endpoint failure, a connection error or 5xx response, sends the call to the alternate at once, and
+        consecutive endpoint failures open the endpoint's circuit so it is routed around. If every circuit is open, all
+        endpoints are tried anyway.
+    """
+
+    def __init__(self,
+                 endpoints,
+                 hedge_percentile: float = DEFAULT_HEDGE_PERCENTILE,
+                 min_samples: int = 10,
+                 initial_delay_sec: float = DEFAULT_HEDGE_INITIAL_DELAY_SEC,
+                 min_delay_sec: float = DEFAULT_HEDGE_MIN_DELAY_SEC,
+                 max_delay_sec: float = DEFAULT_HEDGE_MAX_DELAY_SEC,
+                 failure_threshold: int = DEFAULT_CIRCUIT_FAILURE_THRESHOLD,
+                 cooldown_sec: float = DEFAULT_CIRCUIT_COOLDOWN_SEC,
+                 window: int = DEFAULT_HEDGE_LATENCY_WINDOW,
+                 max_workers: int = 32):
+        """
+        :param endpoints: the endpoint names passed to the called function, e.g: STS region names. At least one.
+        :param hedge_percentile: the percentile (0-100) of the primary's recent latencies after which a call is hedged.
+        :param min_samples: the number of latencies needed before :param hedge_percentile is used.
+        :param initial_delay_sec: the hedge delay used until then.
+        :param min_delay_sec: the hedge delay is never shorter than this, so fast endpoints aren't hedged on jitter.
+        :param max_delay_sec: the hedge delay is never longer than this.
+        :param failure_threshold: the number of consecutive endpoint failures that opens an endpoint's circuit.
+        :param cooldown_sec: how long an open circuit routes around its endpoint before probing it again.
+        :param window: the number of recent latencies kept per endpoint.
+        :param max_workers: the number of calls, including hedges, in flight at once.
+        """
+        self.endpoints = [EndpointHealth(name, window) for name in endpoints]
+        if not self.endpoints:
+            raise ValueError('At least one endpoint is required')
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.initial_delay_sec = initial_delay_sec
+        self.min_delay_sec = min_delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.failure_threshold = failure_threshold
+        self.cooldown_sec = cooldown_sec
+
+        self.hedges = 0
+        self.hedge_wins = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='HedgedCaller')
+        self._lock = threading.Lock()
+
+    def ranked(self, now: float = None) -> list:
+        """
+        Return the endpoints to try, fastest first, leaving out those whose circuit is open unless all of them are.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            ranked = sorted(enumerate(self.endpoints),
+                            key=lambda item: (item[1].ewma_sec is None, item[1].ewma_sec or 0.0, item[0]))
+            endpoints = [endpoint for _, endpoint in ranked]
+            closed = [endpoint for endpoint in endpoints if not endpoint.is_open(now)]
+        return closed or endpoints
+
+    def hedge_delay_sec(self, endpoint: EndpointHealth) -> float:
+        with self._lock:
+            if len(endpoint.latencies) < self.min_samples:
+                delay_sec = self.initial_delay_sec
+            else:
+                delay_sec = endpoint.percentile(self.hedge_percentile)
+        return min(self.max_delay_sec, max(self.min_delay_sec, delay_sec))
+
+    def call(self, fn):
+        """
+        Return fn(endpoint name) from the first endpoint to answer, hedging as described above. If every attempt
+        fails, the first error is raised. Errors that aren't endpoint failures or throttling, e.g: AccessDenied,
+        are raised without trying the alternate.
+        """
+        endpoints = self.ranked()
+        primary = endpoints[0]
+        alternates = deque(endpoints[1:2])
+
+        futures = {self._executor.submit(self._attempt, primary, fn): primary}
+        done, pending = wait(futures, timeout=self.hedge_delay_sec(primary))
+        if not done and alternates:
+            with self._lock:
+                self.hedges += 1
+            alternate = alternates.popleft()
+            logger.debug('Hedging call to %s with %s', primary.name, alternate.name)
+            future = self._executor.submit(self._attempt, alternate, fn)
+            futures[future] = alternate
+            pending.add(future)
+
+        first_error = None
+        while True:
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if first_error is None:
+                        first_error = e
+                    if not (is_endpoint_failure(e) or is_throttling_error(e)):
+                        raise
+                    continue
+                if futures[future] is not primary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return result
+            if not pending and alternates:
+                # The primary failed before the hedge delay; go straight to the alternate
+                alternate = alternates.popleft()
+                future = self._executor.submit(self._attempt, alternate, fn)
+                futures[future] = alternate
+                pending = {future}
+            if not pending:
+                raise first_error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    def _attempt(self, endpoint: EndpointHealth, fn):
+        start = time.monotonic()
+        try:
+            result = fn(endpoint.name)
+        except Exception as e:
+            self._on_failure(endpoint, e)
+            raise
+        self._on_success(endpoint, time.monotonic() - start)
+        return result
+
+    def _on_success(self, endpoint: EndpointHealth, latency_sec: float):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.latencies.append(latency_sec)
+            if endpoint.ewma_sec is None:
+                endpoint.ewma_sec = latency_sec
+            else:
+                endpoint.ewma_sec += _EWMA_ALPHA * (latency_sec - endpoint.ewma_sec)
+            endpoint.consecutive_failures = 0
+            endpoint.open_until = 0.0
+
+    def _on_failure(self, endpoint: EndpointHealth, error: Exception):
+        if not is_endpoint_failure(error):
+            with self._lock:
+                endpoint.requests += 1
+            return
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures < self.failure_threshold:
+                return
+            endpoint.open_until = time.monotonic() + self.cooldown_sec
+        logger.warning('Routing around %s for %.0fs after %d consecutive failures: %s', endpoint.name,
+                       self.cooldown_sec, endpoint.consecutive_failures, error)
+
+    def close(self, wait: bool = True):
+        """
+        Shut down the threads making calls. If :param wait, block until calls in flight, including losing hedges,
+        finish.
+        """
+        self._executor.shutdown(wait=wait)
+
+# endregion
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+import bisect
+import io
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+# region Traces
+
+
+def error_outcome(error: BaseException) -> str:
+    """
+    Return the outcome recorded for a phase or call that raised :param error: the AWS error code for botocore
+    ClientErrors, otherwise the exception's class name.
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        if code:
+            return code
+    return type(error).__name__
+
+
+def retry_attempts(response: dict) -> int:
+    """
+    Return the number of retries botocore made to obtain :param response, a response dict or ClientError.response.
+    """
+    if not isinstance(response, dict):
+        return 0
+    return response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+
+class PhaseTiming(object):
+    """
+        The duration, outcome and retry count of one step of a provision, such as head_bucket.
+    """
+
+    __slots__ = ('name', 'start', 'duration_sec', 'outcome', 'retries')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+        self.duration_sec = 0.0
+        self.outcome = 'ok'
+        self.retries = 0
+
+
+class ProvisionTrace(object):
+    """
+        The phases of one provision, in the order they finished.
+        annotations is free for hooks to store per-call state in.
+    """
+
+    __slots__ = ('user_name', 'bucket_name', 'path', 'region_name', 'start', 'duration_sec', 'outcome', 'phases',
+                 'annotations')
+
+    def __init__(self, user_name: str, bucket_name: str, path: str, region_name: str):
+        self.user_name = user_name
+        self.bucket_name = bucket_name
+        self.path = path
+        self.region_name = region_name
+        self.start = time.perf_counter()
+        self.duration_sec = 0.0
+        self.outcome = 'ok'
+        self.phases = []
+        self.annotations = {}
+
+
+class ProvisionHook(object):
+    """
+        Base class of callbacks receiving provisioning timings. Methods are called on the provisioning thread, so they
+        should return quickly, and must be thread-safe.
+    """
+
+    def on_start(self, trace: ProvisionTrace):
+        pass
+
+    def on_phase(self, trace: ProvisionTrace, phase: PhaseTiming):
+        """
+        Called when a phase ends. :param trace is None for phases run outside of a provision, e.g: a direct call to
+        create_bucket_if_needed or a background credential refresh.
+        """
+        pass
+
+    def on_provision(self, trace: ProvisionTrace):
+        pass
+
+
+class _NullContext(object):
+    """
+        Returned while instrumentation is disabled, so that instrumented code pays for one method call and no timing.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class _PhaseContext(object):
+
+    __slots__ = ('instrumentation', 'phase')
+
+    def __init__(self, instrumentation: 'Instrumentation', name: str):
+        self.instrumentation = instrumentation
+        self.phase = PhaseTiming(name)
+
+    def __enter__(self) -> PhaseTiming:
+        self.phase.start = time.perf_counter()
+        return self.phase
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        phase = self.phase
+        phase.duration_sec = time.perf_counter() - phase.start
+        if exc_val is not None:
+            phase.outcome = error_outcome(exc_val)
+            phase.retries = retry_attempts(getattr(exc_val, 'response', None))
+        self.instrumentation._end_phase(phase)
+        return False
+
+
+class _TraceContext(object):
+
+    __slots__ = ('instrumentation', 'trace', 'parent')
+
+    def __init__(self, instrumentation: 'Instrumentation', trace: ProvisionTrace):
+        self.instrumentation = instrumentation
+        self.trace = trace
+        self.parent = None
+
+    def __enter__(self) -> ProvisionTrace:
+        local = self.instrumentation._local
+        self.parent = getattr(local, 'trace', None)
+        local.trace = self.trace
+        for hook in self.instrumentation.hooks:
+            try:
+                hook.on_start(self.trace)
+            except Exception:
+                logger.exception('Provision hook %r failed', hook)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        trace = self.trace
+        trace.duration_sec = time.perf_counter() - trace.start
+        if exc_val is not None:
+            trace.outcome = error_outcome(exc_val)
+        self.instrumentation._local.trace = self.parent
+        for hook in self.instrumentation.hooks:
+            try:
+                hook.on_provision(trace)
+            except Exception:
+                logger.exception('Provision hook %r failed', hook)
+        return False
+
+
+class Instrumentation(object):
+    """
+        Dispatches provision traces to hooks. While there are no hooks, trace and phase return a shared no-op context
+        manager, so instrumentation costs close to nothing.
+    """
+
+    def __init__(self, hooks: list = None):
+        self.hooks = tuple(hooks or ())
+        self._local = threading.local()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hooks)
+
+    def add_hook(self, hook: ProvisionHook):
+        self.hooks = self.hooks + (hook,)
+
+    def remove_hook(self, hook: ProvisionHook):
+        self.hooks = tuple(h for h in self.hooks if h is not hook)
+
+    def trace(self, user_name: str, bucket_name: str, path: str, region_name: str):
+        """
+        Return a context manager timing one provision. Phases entered within it, on the same thread, are attributed
+        to its ProvisionTrace.
+        """
+        if not self.hooks:
+            return _NULL_CONTEXT
+        return _TraceContext(self, ProvisionTrace(user_name, bucket_name, path, region_name))
+
+    def phase(self, name: str):
+        """
+        Return a context manager timing one phase. The PhaseTiming it yields may have its retries set.
+        """
+        if not self.hooks:
+            return _NULL_CONTEXT
+        return _PhaseContext(self, name)
+
+    def _end_phase(self, phase: PhaseTiming):
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.phases.append(phase)
+        for hook in self.hooks:
+            try:
+                hook.on_phase(trace, phase)
+            except Exception:
+                logger.exception('Provision hook %r failed', hook)
+
+
+# endregion
+
+# region Histograms
+
+# Upper bounds, in seconds, of the buckets of HistogramCollector histograms
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Histogram(object):
+
+    __slots__ = ('counts', 'sum', 'count', 'retries')
+
+    def __init__(self, bucket_count: int):
+        # One count per bucket, plus the +Inf bucket
+        self.counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.retries = 0
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class HistogramCollector(ProvisionHook):
+    """
+        Collects histograms of phase and provision durations, labelled by phase name and outcome, and exports them in
+        the Prometheus text exposition format.
+    """
+
+    def __init__(self,
+                 buckets: tuple = DEFAULT_LATENCY_BUCKETS,
+                 namespace: str = 'storage_provisioner'):
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self._phases = {}
+        self._provisions = {}
+        self._lock = threading.Lock()
+
+    def on_phase(self, trace: ProvisionTrace, phase: PhaseTiming):
+        self._observe(self._phases, (phase.name, phase.outcome), phase.duration_sec, phase.retries)
+
+    def on_provision(self, trace: ProvisionTrace):
+        self._observe(self._provisions, (trace.outcome,), trace.duration_sec, 0)
+
+    def _observe(self, histograms: dict, labels: tuple, duration_sec: float, retries: int):
+        index = bisect.bisect_left(self.buckets, duration_sec)
+        with self._lock:
+            histogram = histograms.get(labels)
+            if histogram is None:
+                histogram = histograms[labels] = _Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += duration_sec
+            histogram.count += 1
+            histogram.retries += retries
+
+    def reset(self):
+        with self._lock:
+            self._phases.clear()
+            self._provisions.clear()
+
+    def export_prometheus(self) -> str:
+        """
+        Return all histograms in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            self._export_histograms(lines,
+                                    '{}_phase_duration_seconds'.format(self.namespace),
+                                    'Duration of each phase of provisioning storage.',
+                                    ('phase', 'outcome'),
+                                    self._phases)
+            self._export_histograms(lines,
+                                    '{}_provision_duration_seconds'.format(self.namespace),
+                                    'Duration of provisioning storage.',
+                                    ('outcome',),
+                                    self._provisions)
+
+            name = '{}_phase_retries_total'.format(self.namespace)
+            lines.append('# HELP {} AWS request retries made during each phase of provisioning storage.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for labels, histogram in sorted(self._phases.items()):
+                lines.append('{}{{{}}} {}'.format(name, self._format_labels(('phase', 'outcome'), labels),
+                                                  histogram.retries))
+        return '\n'.join(lines) + '\n'
+
+    def _export_histograms(self, lines: list, name: str, help_text: str, label_names: tuple, histograms: dict):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels, histogram in sorted(histograms.items()):
+            label_text = self._format_labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, le, cumulative))
+            lines.append('{}_sum{{{}}} {!r}'.format(name, label_text, histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, label_text, histogram.count))
+
+    @staticmethod
+    def _format_labels(label_names: tuple, labels: tuple) -> str:
+        return ','.join('{}="{}"'.format(name, _escape_label_value(value)) for name, value in zip(label_names, labels))
+
+
+# endregion
+
+# region Profiling
+
+DEFAULT_SLOW_CALL_SEC = 1.0
+
+
+class SlowCallProfiler(ProvisionHook):
+    """
+        Profiles a random sample of provisions with cProfile, and optionally tracemalloc, keeping a report for each
+        sampled provision slower than :param slow_call_sec.
+
+        Reports are kept in reports, newest last, and passed to :param on_slow_call if set.
+    """
+
+    def __init__(self,
+                 sample_rate: float = 0.01,
+                 slow_call_sec: float = DEFAULT_SLOW_CALL_SEC,
+                 trace_memory: bool = False,
+                 max_reports: int = 100,
+                 top_functions: int = 25,
+                 on_slow_call=None):
+        """
+        :param sample_rate: the fraction of provisions profiled.
+        :param slow_call_sec: the duration above which a profiled provision is reported.
+        :param trace_memory: if True, start tracemalloc and include the largest allocations in reports. tracemalloc
+        slows every allocation in the process while it runs.
+        :param max_reports: the number of reports kept.
+        :param top_functions: the number of functions, and allocation sites, included in each report.
+        :param on_slow_call: a callable taking (ProvisionTrace, report text), called for each report.
+        """
+        self.sample_rate = sample_rate
+        self.slow_call_sec = slow_call_sec
+        self.trace_memory = trace_memory
+        self.top_functions = top_functions
+        self.on_slow_call = on_slow_call
+        self.reports = deque(maxlen=max_reports)
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def on_start(self, trace: ProvisionTrace):
+        if random.random() >= self.sample_rate:
+            return
+
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            return
+        trace.annotations['profile'] = profile
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            trace.annotations['snapshot'] = tracemalloc.take_snapshot()
+
+    def on_provision(self, trace: ProvisionTrace):
+        profile = trace.annotations.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        snapshot = trace.annotations.pop('snapshot', None)
+
+        if trace.duration_sec < self.slow_call_sec:
+            return
+
+        report = io.StringIO()
+        report.write('Slow provision of {}/{} for {} in {}: {:.3f}s ({})\n'.format(
+            trace.bucket_name, trace.path, trace.user_name, trace.region_name, trace.duration_sec, trace.outcome))
+        for phase in trace.phases:
+            report.write('  {}: {:.3f}s {} retries={}\n'.format(
+                phase.name, phase.duration_sec, phase.outcome, phase.retries))
+
+        import pstats
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(self.top_functions)
+
+        if snapshot is not None and tracemalloc.is_tracing():
+            report.write('Largest allocations during provision:\n')
+            for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:self.top_functions]:
+                report.write('  {}\n'.format(stat))
+
+        text = report.getvalue()
+        self.reports.append(text)
+        if self.on_slow_call is not None:
+            self.on_slow_call(trace, text)
+
+# endregion
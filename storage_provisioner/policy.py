@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import re
+import zlib
+
+# region Amazon AWS Policy Constants
+
+DEFAULT_AWS_S3_POLICY_TEMPLATE = """{
+   "Version":"2012-10-17",
+   "Statement":[
+      {
+         "Effect":"Allow",
+         "Action":[
+            "s3:PutObject",
+            "s3:PutObjectAcl",
+            "s3:PutObjectAclVersion",
+            "s3:GetObject",
+            "s3:GetObjectVersion",
+            "s3:DeleteObject",
+            "s3:DeleteObjectVersion",
+            "s3:ListMultipartUploadParts",
+            "s3:AbortMultipartUpload"
+         ],
+         "Resource":"arn:aws:s3:::{bucket}/{path}*"
+      },
+      {
+         "Effect":"Allow",
+         "Action":[
+            "s3:ListBucket",
+            "s3:GetBucketLocation",
+            "s3:ListAllMyBuckets"
+         ],
+         "Resource":"arn:aws:s3:::{bucket}/{path}"
+      }
+   ]
+}
+"""
+
+# The maximum length of the plaintext of an inline session policy passed to sts.get_federation_token(..)
+AWS_STS_MAX_POLICY_LENGTH = 2048
+
+DEFAULT_POLICY_RENDER_CACHE_SIZE = 4096
+
+# endregion
+
+# region Policy Templates
+
+_PLACEHOLDER_PATTERN = re.compile(r'\{(bucket|path)\}')
+
+
+class PolicyTooLargeError(ValueError):
+    """
+        Raised when a policy would be rejected by STS for exceeding its size limits.
+    """
+
+    def __init__(self, policy: str, message: str):
+        ValueError.__init__(self, message)
+        self.policy = policy
+
+
+def estimate_packed_policy_size(policy: str) -> int:
+    """
+    Return a local estimate, in bytes, of the size of :param policy after STS packs it.
+
+    STS compresses policies into a binary format before comparing them against PackedPolicySize. That format is not
+    public, so the zlib-compressed size of the minified policy is used as an approximation. It tracks the packed size
+    closely enough to reject clearly oversized policies, but is not exact.
+    """
+    return len(zlib.compress(policy.encode('utf-8'), 9))
+
+
+def validate_policy_size(policy: str,
+                         max_length: int = AWS_STS_MAX_POLICY_LENGTH,
+                         max_packed_bytes: int = None):
+    """
+    Raise PolicyTooLargeError if :param policy is longer than :param max_length characters, or if
+    :param max_packed_bytes is set and the estimated packed size of :param policy exceeds it.
+    """
+    if len(policy) > max_length:
+        raise PolicyTooLargeError(policy, 'Policy is {} characters, exceeding the limit of {}'
+                                  .format(len(policy), max_length))
+    if max_packed_bytes is not None:
+        packed_size = estimate_packed_policy_size(policy)
+        if packed_size > max_packed_bytes:
+            raise PolicyTooLargeError(policy, 'Policy packs to an estimated {} bytes, exceeding the limit of {}'
+                                      .format(packed_size, max_packed_bytes))
+
+
+def minify_policy(policy: str) -> str:
+    """
+    Return :param policy with all insignificant whitespace removed. Whitespace counts toward STS policy size limits.
+    """
+    return json.dumps(json.loads(policy), separators=(',', ':'))
+
+
+class PolicyTemplate(object):
+    """
+        An AWS access policy containing '{bucket}' and '{path}' placeholders, parsed and validated once.
+
+        The template is minified and split into a list of literal segments and placeholders, so rendering is a single
+        join. Renders are memoized per (bucket, path), and each rendered policy is checked against STS size limits
+        before it is returned, so an oversized policy fails without an STS round trip.
+    """
+
+    def __init__(self,
+                 template: str,
+                 max_length: int = AWS_STS_MAX_POLICY_LENGTH,
+                 max_packed_bytes: int = None,
+                 cache_size: int = DEFAULT_POLICY_RENDER_CACHE_SIZE):
+        """
+        :param template: a JSON policy document. Placeholders may only appear within JSON strings.
+        :param max_length: the maximum length of a rendered policy.
+        :param max_packed_bytes: if set, the maximum estimated packed size of a rendered policy.
+        :param cache_size: the number of rendered policies to memoize.
+        :return:
+        """
+        try:
+            self.template = minify_policy(template)
+        except ValueError as e:
+            raise ValueError('Policy template is not valid JSON: {}'.format(e))
+
+        self.max_length = max_length
+        self.max_packed_bytes = max_packed_bytes
+
+        # Alternating literal text and placeholder names, starting and ending with literal text
+        self._segments = _PLACEHOLDER_PATTERN.split(self.template)
+        self._placeholder_indexes = range(1, len(self._segments), 2)
+        self._render_cached = functools.lru_cache(maxsize=cache_size)(self._render)
+        self._render_many_cached = functools.lru_cache(maxsize=cache_size)(self._render_many)
+
+        # The template without placeholders is the smallest policy it can render
+        validate_policy_size(self.render('', ''), max_length, max_packed_bytes)
+
+    def render(self, bucket_name: str, path: str) -> str:
+        """
+        Return this template scoped to :param path within :param bucket_name.
+        Raise PolicyTooLargeError if the result exceeds this template's size limits.
+        """
+        if bucket_name is None or path is None:
+            raise ValueError('bucket_name and path are required to render a policy template')
+        return self._render_cached(bucket_name, path)
+
+    def render_many(self, grants) -> str:
+        """
+        Return one policy granting this template's access to every (bucket, path) in :param grants.
+
+        Each statement's placeholder resources are expanded for every grant into a list of resources, which is
+        compacted: duplicates are removed, as are paths within another granted path. Placeholders may only appear in
+        resources. Raise PolicyTooLargeError if the result exceeds this template's size limits.
+        """
+        grants = tuple((bucket_name, path) for bucket_name, path in grants)
+        if not grants or any(bucket_name is None or path is None for bucket_name, path in grants):
+            raise ValueError('At least one grant, with a bucket_name and path, is required to render a policy')
+        return self._render_many_cached(grants)
+
+    def _render_many(self, grants: tuple) -> str:
+        document = json.loads(self.template)
+        for statement in document.get('Statement', ()):
+            resources = statement.get('Resource')
+            if isinstance(resources, str):
+                resources = [resources]
+            others = {name: value for name, value in statement.items() if name != 'Resource'}
+            if _PLACEHOLDER_PATTERN.search(json.dumps(others)):
+                raise ValueError('Only resources may contain placeholders in a policy rendered for many paths')
+            if not resources:
+                continue
+
+            expanded = []
+            for resource in resources:
+                if _PLACEHOLDER_PATTERN.search(resource) is None:
+                    expanded.append(resource)
+                    continue
+                for bucket_name, path in grants:
+                    expanded.append(_PLACEHOLDER_PATTERN.sub(
+                        lambda match: bucket_name if match.group(1) == 'bucket' else path, resource))
+            expanded = compact_resources(expanded)
+            statement['Resource'] = expanded[0] if len(expanded) == 1 else expanded
+
+        policy = json.dumps(document, separators=(',', ':'))
+        validate_policy_size(policy, self.max_length, self.max_packed_bytes)
+        return policy
+
+    def _render(self, bucket_name: str, path: str) -> str:
+        # Escape values so they can't break out of the JSON strings they are substituted into
+        values = {'bucket': json.dumps(bucket_name)[1:-1], 'path': json.dumps(path)[1:-1]}
+        segments = list(self._segments)
+        for index in self._placeholder_indexes:
+            segments[index] = values[segments[index]]
+        policy = ''.join(segments)
+
+        validate_policy_size(policy, self.max_length, self.max_packed_bytes)
+        return policy
+
+
+def compact_resources(resources) -> list:
+    """
+    Return :param resources in order without duplicates, or resources covered by another ending in a '*' wildcard,
+    e.g: "arn:aws:s3:::bucket/a/b/*" is dropped if "arn:aws:s3:::bucket/a/*" is present.
+    """
+    unique = list(dict.fromkeys(resources))
+    wildcard_prefixes = [resource[:-1] for resource in unique if resource.endswith('*')]
+    return [resource for resource in unique
+            if not any(resource != prefix + '*' and resource.startswith(prefix) for prefix in wildcard_prefixes)]
+
+
+def to_policy_template(policy) -> PolicyTemplate:
+    """
+    Return :param policy as a PolicyTemplate. A template string is parsed, and None gives DEFAULT_AWS_S3_POLICY.
+    """
+    if policy is None:
+        return DEFAULT_AWS_S3_POLICY
+    if isinstance(policy, PolicyTemplate):
+        return policy
+    return PolicyTemplate(policy)
+
+
+DEFAULT_AWS_S3_POLICY = PolicyTemplate(DEFAULT_AWS_S3_POLICY_TEMPLATE)
+
+# endregion
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from storage_provisioner.cache import credential_cache_key
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+logger = logging.getLogger(__name__)
+
+
+# region Credential Pool
+
+DEFAULT_CREDENTIAL_POOL_DEPTH = 16
+
+DEFAULT_CREDENTIAL_POOL_MIN_REMAINING_SEC = 1800
+
+DEFAULT_CREDENTIAL_POOL_MAX_AGE_SEC = 3600
+
+DEFAULT_CREDENTIAL_POOL_REFILL_INTERVAL_SEC = 1.0
+
+
+class CredentialPool(object):
+    """
+        Keeps already-minted S3Storage objects for paths that are known ahead of time, such as the next stream IDs
+        under a prefix, so that matching calls to S3StorageProvisioner.provision_storage skip STS entirely.
+
+        Each pooled storage is handed out once. A background thread tops the pool up to the paths returned by
+        :param next_paths, and drops storages that are too old or too close to expiring.
+
+        Only requests using the default policy, for :param user_name in :param bucket_name with the pool's region and
+        duration, can be served by the pool. hits and misses count the matching requests that were and were not.
+    """
+
+    def __init__(self,
+                 provisioner: S3StorageProvisioner,
+                 user_name: str,
+                 bucket_name: str,
+                 next_paths,
+                 depth: int = DEFAULT_CREDENTIAL_POOL_DEPTH,
+                 region: AWSS3Region = None,
+                 duration_sec: int = 129600,
+                 min_remaining_sec: float = DEFAULT_CREDENTIAL_POOL_MIN_REMAINING_SEC,
+                 max_age_sec: float = DEFAULT_CREDENTIAL_POOL_MAX_AGE_SEC,
+                 refill_interval_sec: float = DEFAULT_CREDENTIAL_POOL_REFILL_INTERVAL_SEC):
+        """
+        :param provisioner: the provisioner used to mint storages.
+        :param user_name: the user name of pooled storages.
+        :param bucket_name: the bucket of pooled storages.
+        :param next_paths: a callable taking a count and returning up to that many paths expected to be requested
+        next, e.g: lambda count: ['streams/{}/'.format(i) for i in range(next_stream_id, next_stream_id + count)]
+        :param depth: the number of storages the pool tries to hold.
+        :param region: the region of pooled storages. The provisioner's default region if None.
+        :param duration_sec: the duration of pooled storages.
+        :param min_remaining_sec: the minimum lifetime a pooled storage must have left to be handed out.
+        :param max_age_sec: the maximum time a storage is held before being discarded.
+        :param refill_interval_sec: how often the background thread tops the pool up.
+        """
+        if region is None:
+            region = provisioner.default_region
+
+        self.provisioner = provisioner
+        self.user_name = user_name
+        self.bucket_name = bucket_name
+        self.next_paths = next_paths
+        self.depth = depth
+        self.region = region
+        self.duration_sec = duration_sec
+        self.min_remaining_sec = min_remaining_sec
+        self.max_age_sec = max_age_sec
+        self.refill_interval_sec = refill_interval_sec
+
+        self.hits = 0
+        self.misses = 0
+
+        # credential_cache_key -> (storage, time.monotonic() when minted)
+        self._storages = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._storages)
+
+    def key_for_path(self, path: str) -> tuple:
+        return credential_cache_key(self.user_name,
+                                    self.provisioner.default_policy.render(self.bucket_name, path),
+                                    self.bucket_name,
+                                    path,
+                                    self.region.value,
+                                    self.duration_sec)
+
+    def matches(self, key: tuple) -> bool:
+        """
+        Return True if a request with :param key falls within the scope of this pool.
+        """
+        return (key[0] == self.user_name[:32] and key[2] == self.bucket_name and
+                key[4] == self.region.value and key[5] == self.duration_sec)
+
+    def take(self, key: tuple) -> S3Storage:
+        """
+        Remove and return the pooled storage for :param key, or None if there is no usable one.
+        """
+        with self._lock:
+            entry = self._storages.pop(key, None)
+            if entry is not None and self._usable(*entry):
+                self.hits += 1
+                return entry[0]
+            if self.matches(key):
+                self.misses += 1
+        return None
+
+    def refill(self):
+        """
+        Discard unusable storages, then mint storages for any of the next :param depth paths not already pooled.
+        """
+        with self._lock:
+            for key, entry in list(self._storages.items()):
+                if not self._usable(*entry):
+                    del self._storages[key]
+            room = self.depth - len(self._storages)
+
+        if room <= 0:
+            return
+
+        region_name = self.region.value
+        for path in self.next_paths(self.depth):
+            if room <= 0 or self._stopped.is_set():
+                break
+
+            key = self.key_for_path(path)
+            if key in self._storages:
+                continue
+
+            storage = self.provisioner.provision_new_storage(self.user_name,
+                                                             self.bucket_name,
+                                                             path,
+                                                             self.region,
+                                                             key[1],
+                                                             self.duration_sec)
+            with self._lock:
+                self._storages[key] = (storage, time.monotonic())
+            room -= 1
+
+        logger.debug('Refilled credential pool for %s in %s/%s', self.user_name, region_name, self.bucket_name)
+
+    def start(self):
+        """
+        Start the background thread keeping the pool filled.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='CredentialPool-{}'.format(self.bucket_name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, waiting for any refill in progress to finish.
+        """
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _usable(self, storage: S3Storage, minted_at: float) -> bool:
+        return (time.monotonic() - minted_at < self.max_age_sec and
+                storage.seconds_until_expiration() > self.min_remaining_sec)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refill()
+            except Exception:
+                logger.exception('Failed to refill credential pool for %s', self.user_name)
+            self._stopped.wait(self.refill_interval_sec)
+
+# endregion
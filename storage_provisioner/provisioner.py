@@ -1,7 +1,25 @@
 # -*- coding: utf-8 -*-
-
-from boto3.session import Session, botocore
-from storage_provisioner.storage import Storage, S3Storage, AWSS3Region
+import functools
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import TYPE_CHECKING
+
+from storage_provisioner.cache import BucketCache, CredentialCache, credential_cache_key, \
+    DEFAULT_BUCKET_CACHE_TTL_SEC
+from storage_provisioner.hedging import HedgedCaller
+from storage_provisioner.instrumentation import Instrumentation, retry_attempts
+# DEFAULT_AWS_S3_POLICY_TEMPLATE moved to policy, and is still importable from here
+from storage_provisioner.policy import PolicyTemplate, DEFAULT_AWS_S3_POLICY, DEFAULT_AWS_S3_POLICY_TEMPLATE, \
+    to_policy_template, validate_policy_size  # noqa: F401
+from storage_provisioner.ratelimit import AdaptiveRateLimiter
+from storage_provisioner.singleflight import SingleFlight
+from storage_provisioner.storage import Storage, LocalFileStorage, S3Storage, AWSS3Region
+
+if TYPE_CHECKING:
+    import boto3
+    from storage_provisioner.pool import CredentialPool
 
 
 class StorageProvisioner(object):
@@ -16,44 +34,254 @@ class StorageProvisioner(object):
         raise NotImplementedError
 
 
+# region Local File Provisioner
+
+
+class LocalFileStorageProvisioner(StorageProvisioner):
+    """
+        Creates and provisions directories under a base path on the local filesystem, for development, CI and edge
+        nodes. Makes no network calls.
+    """
+
+    def __init__(self,
+                 base_path: str,
+                 dir_mode: int = 0o700):
+        """
+        :param base_path: the directory under which all storage is provisioned. Created if necessary.
+        :param dir_mode: the mode of directories created by provision_storage.
+        :return:
+        """
+        StorageProvisioner.__init__(self)
+
+        self.base_path = os.path.realpath(base_path)
+        self.dir_mode = dir_mode
+        os.makedirs(self.base_path, mode=dir_mode, exist_ok=True)
+
+    def provision_storage(self, path: str = None) -> LocalFileStorage:
+        """
+        Create the directory :param path under base_path if necessary, returning a LocalFileStorage scoped to it.
+
+        :param path: a path within base_path, omitting leading '/'. If None, storage is scoped to base_path itself.
+        :return:
+        """
+        storage_path = LocalFileStorage(self.base_path).path_for_key(path or '')
+        os.makedirs(storage_path, mode=self.dir_mode, exist_ok=True)
+        return LocalFileStorage(storage_path)
+
+
+# endregion
+
 # region Amazon AWS Constants
 
 DEFAULT_AWS_S3_REGION = AWSS3Region.USWest1
 
-DEFAULT_AWS_S3_POLICY_TEMPLATE = """{
-   "Version":"2012-10-17",
-   "Statement":[
-      {
-         "Effect":"Allow",
-         "Action":[
-            "s3:PutObject",
-            "s3:PutObjectAcl",
-            "s3:PutObjectAclVersion",
-            "s3:GetObject",
-            "s3:GetObjectVersion",
-            "s3:DeleteObject",
-            "s3:DeleteObjectVersion"
-         ],
-         "Resource":"arn:aws:s3:::{bucket}/{path}*"
-      },
-      {
-         "Effect":"Allow",
-         "Action":[
-            "s3:ListBucket",
-            "s3:GetBucketLocation",
-            "s3:ListAllMyBuckets"
-         ],
-         "Resource":"arn:aws:s3:::{bucket}/{path}"
-      }
-   ]
-}
-"""
+DEFAULT_AWS_MAX_POOL_CONNECTIONS = 10
+
+# The regional STS endpoint. botocore may resolve every region to the global endpoint, sts.amazonaws.com
+AWS_STS_REGIONAL_ENDPOINT_URL = 'https://sts.{region}.amazonaws.com'
+
+# botocore retry configuration making one attempt per call, leaving retries to the caller
+AWS_SINGLE_ATTEMPT_RETRIES = {'mode': 'standard', 'total_max_attempts': 1}
+
+DEFAULT_AWS_BATCH_MAX_WORKERS = 8
+
+
+def render_default_policy(bucket_name: str, path: str) -> str:
+    """
+    Return DEFAULT_AWS_S3_POLICY_TEMPLATE scoped to :param path within :param bucket_name.
+    """
+    return DEFAULT_AWS_S3_POLICY.render(bucket_name, path)
+
+
+def s3_storage_from_federation_token(token_resp: dict,
+                                     bucket_name: str,
+                                     region_name: str,
+                                     path: str,
+                                     user_policy: str) -> S3Storage:
+    """
+    Return an S3Storage for the response of sts.get_federation_token(..)
+    """
+    token_aws_creds = token_resp['Credentials']
+    token_aws_federated_user = token_resp['FederatedUser']
+
+    return S3Storage(bucket_name,
+                     region_name,
+                     path,
+                     token_aws_creds['AccessKeyId'],
+                     token_aws_creds['SecretAccessKey'],
+                     token_aws_creds['SessionToken'],
+                     token_aws_creds['Expiration'],
+                     token_aws_federated_user['FederatedUserId'],
+                     token_aws_federated_user['Arn'],
+                     user_policy)
+
+
+# endregion
+
+# region Amazon AWS Client Pool
+
+
+class AWSClientPool(object):
+    """
+        Thread-safe pool of boto3 sessions and clients, holding one session per region and one client per
+        (service, region) pair.
+
+        boto3 clients are thread-safe once created and keep their HTTP connection pool between calls, but sessions
+        are not thread-safe. Client creation is therefore serialized behind a lock, while lookups of clients that
+        already exist are lock-free.
+
+        botocore is imported when a pool is created, and boto3 when its first session is, so that importing this
+        module stays cheap for processes that never talk to AWS.
+    """
+
+    def __init__(self,
+                 aws_access_key_id: str,
+                 aws_secret_access_key: str,
+                 max_pool_connections: int = DEFAULT_AWS_MAX_POOL_CONNECTIONS,
+                 tcp_keepalive: bool = True,
+                 service_retries: dict = None):
+        """
+        :param aws_access_key_id:
+        :param aws_secret_access_key:
+        :param max_pool_connections: the maximum number of HTTP connections each client keeps open. Should be at
+        least the number of threads expected to call a single region concurrently.
+        :param tcp_keepalive: if True, enable TCP keep-alive on pooled connections so idle connections stay warm.
+        :param service_retries: botocore retry configurations by service name, overriding botocore's default for
+        clients of that service, e.g: {'sts': {'mode': 'standard', 'total_max_attempts': 1}}.
+        """
+
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+
+        from botocore.config import Config
+        config_kwargs = {'max_pool_connections': max_pool_connections}
+        if tcp_keepalive:
+            config_kwargs['tcp_keepalive'] = True
+        self.config = Config(**config_kwargs)
+        self.service_configs = {service_name: self.config.merge(Config(retries=retries))
+                                for service_name, retries in (service_retries or {}).items()}
+
+        self._sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def session(self, region_name: str) -> 'boto3.session.Session':
+        """
+        Return the shared session for :param region_name, creating it if necessary.
+        Callers must not create clients or resources on the returned session without holding this pool's lock.
+        """
+        session = self._sessions.get(region_name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(region_name)
+                if session is None:
+                    session = self.create_session(region_name)
+                    self._sessions[region_name] = session
+        return session
+
+    def client(self, service_name: str, region_name: str, endpoint_url: str = None):
+        """
+        Return the shared boto3 client for :param service_name in :param region_name, creating it if necessary.
+
+        :param endpoint_url: the endpoint the client calls, instead of the one botocore resolves for the region.
+        """
+        key = (service_name, region_name, endpoint_url)
+        client = self._clients.get(key)
+        if client is None:
+            session = self.session(region_name)
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self.create_client(session, service_name, region_name, endpoint_url)
+                    self._clients[key] = client
+        return client
+
+    def create_session(self, region_name: str) -> 'boto3.session.Session':
+        from boto3.session import Session
+        return Session(aws_access_key_id=self.aws_access_key_id,
+                       aws_secret_access_key=self.aws_secret_access_key,
+                       region_name=region_name)
+
+    def create_client(self, session: 'boto3.session.Session', service_name: str, region_name: str,
+                      endpoint_url: str = None):
+        return session.client(service_name, region_name=region_name, endpoint_url=endpoint_url,
+                              config=self.service_configs.get(service_name, self.config))
+
+    def clear(self):
+        """
+        Drop all pooled sessions and clients. Subsequent calls will create new ones.
+        """
+        with self._lock:
+            self._clients.clear()
+            self._sessions.clear()
+
+
+def _warn_session_ignored(session):
+    if session is not None:
+        warnings.warn('The session argument is deprecated and ignored; clients come from the provisioner\'s '
+                      'client_pool', DeprecationWarning, stacklevel=3)
+
+
+# endregion
+
+# region Amazon AWS S3 Batch Provisioning
+
+
+class ProvisionRequest(object):
+    """
+        The arguments of a single S3StorageProvisioner.provision_storage call, for use with provision_storage_many.
+    """
+
+    def __init__(self,
+                 user_name: str,
+                 bucket_name: str,
+                 path: str = None,
+                 region: AWSS3Region = None,
+                 user_policy: str = None,
+                 duration_sec: int = 129600):
+        self.user_name = user_name
+        self.bucket_name = bucket_name
+        self.path = path
+        self.region = region
+        self.user_policy = user_policy
+        self.duration_sec = duration_sec
+
+
+class ProvisionResult(object):
+    """
+        The outcome of a single request passed to S3StorageProvisioner.provision_storage_many.
+        Exactly one of storage and error is set.
+    """
+
+    def __init__(self,
+                 request: ProvisionRequest,
+                 storage: S3Storage = None,
+                 error: Exception = None):
+        self.request = request
+        self.storage = storage
+        self.error = error
 
 
 # endregion
 
 # region Amazon AWS S3 Provisioner
 
+def _to_region(region) -> AWSS3Region:
+    """
+    Return :param region, an AWSS3Region, its value such as 'us-west-2', or its name such as 'USWest2', as an
+    AWSS3Region.
+    """
+    if isinstance(region, AWSS3Region):
+        return region
+    try:
+        return AWSS3Region(region)
+    except ValueError:
+        pass
+    try:
+        return AWSS3Region[region]
+    except KeyError:
+        raise ValueError('{!r} is not an AWSS3Region, or the value or name of one'.format(region)) from None
+
 
 class S3StorageProvisioner:
     """
@@ -64,54 +292,177 @@ class S3StorageProvisioner:
                  aws_access_key_id: str,
                  aws_secret_access_key: str,
                  default_region: AWSS3Region = DEFAULT_AWS_S3_REGION,
-                 default_policy: str = None):
+                 default_policy: PolicyTemplate = None,
+                 max_pool_connections: int = DEFAULT_AWS_MAX_POOL_CONNECTIONS,
+                 tcp_keepalive: bool = True,
+                 bucket_cache_ttl_sec: float = DEFAULT_BUCKET_CACHE_TTL_SEC,
+                 credential_cache: CredentialCache = None,
+                 hooks: list = None,
+                 rate_limiter: AdaptiveRateLimiter = None,
+                 coalesce_requests: bool = True,
+                 hedger: HedgedCaller = None):
         """
         These are the minimum parameters needed by boto3 in order to provision new S3 buckets and IAM users.
 
+        Sessions and clients are created once per region and shared by all calls to provision_storage, so
+        concurrent callers reuse warm HTTP connections. Buckets known to exist are remembered for
+        :param bucket_cache_ttl_sec, so repeated provisioning into the same bucket skips head_bucket.
+        If :param credential_cache is set, repeated requests for the same credentials are served from it.
+
         :param aws_access_key_id:
         :param aws_secret_access_key:
         :param default_region:
-        :param default_policy:
+        :param default_policy: the PolicyTemplate, or template string, used when provision_storage is called without
+        a user_policy. DEFAULT_AWS_S3_POLICY if None.
+        :param max_pool_connections: the maximum number of HTTP connections kept open per AWS client.
+        :param tcp_keepalive: if True, enable TCP keep-alive on pooled connections.
+        :param bucket_cache_ttl_sec: how long a bucket is assumed to exist after a successful head or create.
+        If 0, every call to provision_storage checks the bucket.
+        :param credential_cache: an optional cache of provisioned storages. If None, every call to provision_storage
+        creates a new federation token.
+        :param hooks: ProvisionHooks receiving the timing of each phase of each provision, e.g: a HistogramCollector.
+        Hooks can be added later through instrumentation.add_hook.
+        :param rate_limiter: an optional limiter of calls to sts.get_federation_token, which may be shared between
+        provisioners using the same AWS account. Throttled calls, and calls failing with server errors, are retried
+        with backoff instead of raising. STS clients then make a single attempt per call, so the limiter sees every
+        throttle and owns the backoff.
+        :param coalesce_requests: if True, concurrent calls to provision_storage with the same user, policy, bucket,
+        path, region and duration share one federation token, and concurrent checks of the same bucket share one
+        head_bucket, instead of each making their own.
+        :param hedger: an optional HedgedCaller over STS region names, e.g: HedgedCaller(['us-west-1', 'us-east-1']).
+        If set, sts.get_federation_token is called through the fastest healthy regional endpoint, and hedged to the
+        next fastest when slow, instead of always using the endpoint of the requested region. Hedged calls always use
+        regional endpoints, see AWS_STS_REGIONAL_ENDPOINT_URL. A rate limiter counts a hedged call once.
         :return:
         """
 
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
         self.default_region = default_region
-        self.default_policy = default_policy
+        self.default_policy = to_policy_template(default_policy)
+        self.client_pool = AWSClientPool(aws_access_key_id,
+                                         aws_secret_access_key,
+                                         max_pool_connections=max_pool_connections,
+                                         tcp_keepalive=tcp_keepalive,
+                                         service_retries=None if rate_limiter is None else
+                                         {'sts': AWS_SINGLE_ATTEMPT_RETRIES})
+        self.bucket_cache = BucketCache(bucket_cache_ttl_sec)
+        self.credential_cache = credential_cache
+        self.credential_pools = ()
+        self.instrumentation = Instrumentation(hooks)
+        self.rate_limiter = rate_limiter
+        self.coalesce_requests = coalesce_requests
+        self.hedger = hedger
+        self._bucket_checks = SingleFlight()
+        self._provisions = SingleFlight()
 
     def create_federation_token(self,
-                                session: Session,
-                                user_name: str,
-                                user_policy: str,
+                                session: 'boto3.session.Session' = None,
+                                user_name: str = None,
+                                user_policy: str = None,
                                 duration_sec: int = 129600,
+                                region: AWSS3Region = None,
                                 ) -> dict:
-        sts = session.client('sts')
-        token_resp = sts.get_federation_token(Name=user_name[:32],
-                                              Policy=user_policy,
-                                              DurationSeconds=duration_sec)
-        return token_resp
+        """
+        :param session: deprecated and ignored. Clients come from this provisioner's client_pool. Kept first, so
+        calls passing it positionally still work; pass the other arguments by keyword.
+        :param user_name: required.
+        :param user_policy: required.
+        """
+        _warn_session_ignored(session)
+        if user_name is None or user_policy is None:
+            raise TypeError('create_federation_token requires user_name and user_policy')
+        if region is None:
+            region = self.default_region
+
+        def get_federation_token_from(sts) -> dict:
+            return sts.get_federation_token(Name=user_name[:32],
+                                            Policy=user_policy,
+                                            DurationSeconds=duration_sec)
+
+        # Read once, so sts is bound whenever it is used, even if the hedger is replaced meanwhile
+        hedger = self.hedger
+        if hedger is None:
+            with self.instrumentation.phase('client'):
+                sts = self.client_pool.client('sts', region.value)
+
+        def get_federation_token() -> dict:
+            with self.instrumentation.phase('get_federation_token') as phase:
+                if hedger is None:
+                    token_resp = get_federation_token_from(sts)
+                else:
+                    token_resp = hedger.call(
+                        lambda region_name: get_federation_token_from(self.regional_sts(region_name)))
+                phase.retries = retry_attempts(token_resp)
+            return token_resp
+
+        if self.rate_limiter is None:
+            return get_federation_token()
+        return self.rate_limiter.call(get_federation_token)
+
+    def regional_sts(self, region_name: str):
+        """
+        Return the pooled STS client calling the regional endpoint of :param region_name.
+        """
+        return self.client_pool.client('sts', region_name,
+                                       endpoint_url=AWS_STS_REGIONAL_ENDPOINT_URL.format(region=region_name))
 
     def create_bucket_if_needed(self,
-                                session: Session,
-                                bucket_name: str,
-                                region: AWSS3Region,
+                                session: 'boto3.session.Session' = None,
+                                bucket_name: str = None,
+                                region: AWSS3Region = None,
                                 bucket_policy: str = None, ):
-        s3 = session.resource('s3')
+        """
+        :param session: deprecated and ignored. Clients come from this provisioner's client_pool. Kept first, so
+        calls passing it positionally still work; pass the other arguments by keyword.
+        :param bucket_name: required.
+        :param region: required.
+        """
+        _warn_session_ignored(session)
+        if bucket_name is None or region is None:
+            raise TypeError('create_bucket_if_needed requires bucket_name and region')
+        region_name = region.value
+
+        if self.bucket_cache.contains(bucket_name, region_name):
+            return
+
+        if self.coalesce_requests:
+            self._bucket_checks.do((bucket_name, region_name), self._create_bucket_if_needed, bucket_name, region_name)
+        else:
+            self._create_bucket_if_needed(bucket_name, region_name)
+
+    def _create_bucket_if_needed(self, bucket_name: str, region_name: str):
+        from botocore.exceptions import ClientError
+
+        with self.instrumentation.phase('client'):
+            s3 = self.client_pool.client('s3', region_name)
 
         bucket_exists = True
         try:
-            s3.meta.client.head_bucket(Bucket=bucket_name)
-        except botocore.exceptions.ClientError as e:
+            with self.instrumentation.phase('head_bucket') as phase:
+                phase.retries = retry_attempts(s3.head_bucket(Bucket=bucket_name))
+        except ClientError as e:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
+            # Any other error (e.g: 403) is not proof of existence, so the bucket is not cached.
+            error_code = e.response['Error']['Code']
+            if error_code in ('404', 'NoSuchBucket'):
                 bucket_exists = False
+            else:
+                return
 
         if not bucket_exists:
-            s3.create_bucket(Bucket=bucket_name,
-                             CreateBucketConfiguration={'LocationConstraint': region.value})
+            try:
+                with self.instrumentation.phase('create_bucket') as phase:
+                    phase.retries = retry_attempts(
+                        s3.create_bucket(Bucket=bucket_name,
+                                         CreateBucketConfiguration={'LocationConstraint': region_name}))
+            except ClientError as e:
+                # Another worker may have created the bucket between our head_bucket and create_bucket
+                if e.response['Error']['Code'] != 'BucketAlreadyOwnedByYou':
+                    raise
+
+        self.bucket_cache.add(bucket_name, region_name)
 
     def provision_storage(self,
                           user_name: str,
@@ -142,39 +493,219 @@ class S3StorageProvisioner:
 
         # TODO : Sanitize arguments?
 
+        return self._provision(user_name, bucket_name, path, region, user_policy, duration_sec)
+
+    def provision_storage_for_paths(self,
+                                    user_name: str,
+                                    grants,
+                                    region: AWSS3Region = None,
+                                    duration_sec: int = 129600) -> list:
+        """
+        Provision one federation token granting access to several paths, e.g: a client's upload, thumbnail and shared
+        asset paths, with one STS call instead of one per path. Buckets are created if necessary.
+
+        The default policy is rendered for every grant into one policy, with duplicate resources and paths within
+        other granted paths removed so it stays under STS's size limits. Tokens go through the same cache, pools and
+        request coalescing as provision_storage.
+
+        :param user_name: the user name to associate with this credential in AWS. Will be truncated to 32 characters.
+        :param grants: (bucket name, path) or (bucket name, path, region) tuples. A grant's region, an AWSS3Region or
+        its value or name, is that of its bucket, :param region if omitted.
+        :param region: the region of the STS endpoint, and of buckets of grants without one. DEFAULT_AWS_S3_REGION if
+        None.
+        :param duration_sec: the duration of the returned credentials.
+        :return: an S3Storage for each grant, in order, all sharing the same credentials and policy.
+        """
+        if region is None:
+            region = self.default_region
+
+        locations = []
+        for grant in grants:
+            bucket_name, path = grant[0], grant[1]
+            bucket_region = _to_region(grant[2]) if len(grant) > 2 and grant[2] is not None else region
+            locations.append((bucket_name, path, bucket_region))
+        if not locations:
+            raise ValueError('At least one grant is required')
+
+        user_policy = self.default_policy.render_many((bucket_name, path) for bucket_name, path, _ in locations)
+
+        for bucket_name, bucket_region in dict.fromkeys((bucket_name, bucket_region)
+                                                        for bucket_name, _, bucket_region in locations):
+            self.create_bucket_if_needed(bucket_name=bucket_name, region=bucket_region)
+
+        bucket_name, path, _ = locations[0]
+        storage = self._provision(user_name, bucket_name, path, region, user_policy, duration_sec,
+                                  check_bucket=False)
+
+        return [S3Storage(bucket_name,
+                          bucket_region.value,
+                          path,
+                          storage.aws_access_key_id,
+                          storage.aws_secret_access_key,
+                          storage.aws_session_token,
+                          storage.aws_expiration,
+                          storage.aws_federated_user_id,
+                          storage.aws_arn,
+                          storage.aws_policy)
+                for bucket_name, path, bucket_region in locations]
+
+    def provision_storage_many(self,
+                               requests,
+                               max_workers: int = DEFAULT_AWS_BATCH_MAX_WORKERS,
+                               max_pending: int = None):
+        """
+        Provision storage for each of :param requests on a bounded pool of threads, yielding a ProvisionResult for
+        each request as it finishes. Results are not yielded in request order.
+
+        Each distinct (bucket, region) pair among :param requests is checked once. If that check fails, every request
+        for the bucket fails with the same error. A malformed request, e.g: a dict with an unknown key, gets a
+        ProvisionResult whose request is the malformed request and whose error is the exception it raised.
+
+        :param requests: an iterable of ProvisionRequest, or of dicts of provision_storage keyword arguments.
+        It is consumed lazily, so it may be a generator of any length.
+        :param max_workers: the number of threads used to provision storage.
+        :param max_pending: the maximum number of requests queued or in progress at once. 2 * max_workers if None.
+        :return: a generator of ProvisionResult
+        """
+
+        if max_pending is None:
+            max_pending = 2 * max_workers
+
+        bucket_checks = {}
+        pending = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for request in requests:
+                try:
+                    if isinstance(request, dict):
+                        request = ProvisionRequest(**request)
+                    region = AWSS3Region(request.region) if request.region is not None else self.default_region
+                except Exception as e:
+                    # A malformed request fails on its own, without stopping the batch
+                    yield ProvisionResult(request, error=e)
+                    continue
+
+                bucket_key = (request.bucket_name, region.value)
+                bucket_check = bucket_checks.get(bucket_key)
+                if bucket_check is None:
+                    # Queued ahead of every request that waits on it, so it can never be starved by its waiters
+                    bucket_check = executor.submit(self.create_bucket_if_needed, bucket_name=request.bucket_name,
+                                                   region=region)
+                    bucket_checks[bucket_key] = bucket_check
+
+                pending.add(executor.submit(self._provision_batch_request, request, region, bucket_check))
+
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _provision_batch_request(self,
+                                 request: ProvisionRequest,
+                                 region: AWSS3Region,
+                                 bucket_check) -> ProvisionResult:
+        try:
+            bucket_check.result()
+            storage = self._provision(request.user_name,
+                                      request.bucket_name,
+                                      request.path,
+                                      region,
+                                      request.user_policy,
+                                      request.duration_sec,
+                                      check_bucket=False)
+        except Exception as e:
+            return ProvisionResult(request, error=e)
+        return ProvisionResult(request, storage=storage)
+
+    def _provision(self,
+                   user_name: str,
+                   bucket_name: str,
+                   path: str,
+                   region: AWSS3Region,
+                   user_policy: str,
+                   duration_sec: int,
+                   check_bucket: bool = True) -> S3Storage:
         if region is None:
             region = self.default_region
 
-        region_name = region.value
+        with self.instrumentation.trace(user_name, bucket_name, path, region.value):
+            if user_policy is None:
+                user_policy = self.default_policy.render(bucket_name, path)
+            else:
+                validate_policy_size(user_policy)
 
-        session = Session(aws_access_key_id=self.aws_access_key_id,
-                          aws_secret_access_key=self.aws_secret_access_key,
-                          region_name=region_name)
+            loader = functools.partial(self.provision_new_storage,
+                                       user_name, bucket_name, path, region, user_policy, duration_sec, check_bucket)
 
-        if user_policy is None:
-            user_policy = DEFAULT_AWS_S3_POLICY_TEMPLATE.replace('{bucket}', bucket_name).replace('{path}', path)
+            if self.credential_cache is None and not self.credential_pools and not self.coalesce_requests:
+                return loader()
 
-        self.create_bucket_if_needed(bucket_name=bucket_name,
-                                     session=session,
-                                     region=region)
+            key = credential_cache_key(user_name, user_policy, bucket_name, path, region.value, duration_sec)
 
-        token_resp = self.create_federation_token(session=session,
-                                                  user_name=user_name,
+            if self.coalesce_requests:
+                loader = functools.partial(self._provisions.do, key, loader)
+
+            if self.credential_pools:
+                loader = functools.partial(self._take_pooled_storage, key, loader)
+
+            if self.credential_cache is None:
+                return loader()
+
+            return self.credential_cache.get(key, loader)
+
+    def _take_pooled_storage(self, key: tuple, loader) -> S3Storage:
+        for pool in self.credential_pools:
+            storage = pool.take(key)
+            if storage is not None:
+                return storage
+        return loader()
+
+    def add_credential_pool(self, pool: 'CredentialPool', start: bool = True):
+        """
+        Serve matching calls to provision_storage from :param pool.
+
+        :param pool: a CredentialPool created for this provisioner.
+        :param start: if True, start the pool's background refill thread.
+        """
+        self.credential_pools = self.credential_pools + (pool,)
+        if start:
+            pool.start()
+
+    def remove_credential_pool(self, pool: 'CredentialPool'):
+        """
+        Stop serving calls to provision_storage from :param pool, and stop its background refill thread.
+        """
+        self.credential_pools = tuple(p for p in self.credential_pools if p is not pool)
+        pool.stop()
+
+    def provision_new_storage(self,
+                              user_name: str,
+                              bucket_name: str,
+                              path: str,
+                              region: AWSS3Region,
+                              user_policy: str,
+                              duration_sec: int = 129600,
+                              check_bucket: bool = True) -> S3Storage:
+        """
+        Create a new federation token, bypassing any credential cache or pool.
+        Unlike provision_storage, :param region and :param user_policy are required.
+
+        :param check_bucket: if True, create the bucket if necessary.
+        """
+        if check_bucket:
+            self.create_bucket_if_needed(bucket_name=bucket_name,
+                                         region=region)
+
+        token_resp = self.create_federation_token(user_name=user_name,
                                                   user_policy=user_policy,
-                                                  duration_sec=duration_sec)
-
-        token_aws_creds = token_resp['Credentials']
-        token_aws_federated_user = token_resp['FederatedUser']
-
-        return S3Storage(bucket_name,
-                         region_name,
-                         path,
-                         token_aws_creds['AccessKeyId'],
-                         token_aws_creds['SecretAccessKey'],
-                         token_aws_creds['SessionToken'],
-                         token_aws_creds['Expiration'],
-                         token_aws_federated_user['FederatedUserId'],
-                         token_aws_federated_user['Arn'],
-                         user_policy)
+                                                  duration_sec=duration_sec,
+                                                  region=region)
+
+        return s3_storage_from_federation_token(token_resp, bucket_name, region.value, path, user_policy)
 
 # endregion
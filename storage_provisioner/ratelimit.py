@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import functools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# region Adaptive Rate Limiter
+
+# AWS error codes meaning the caller is sending requests faster than the service accepts them
+THROTTLING_ERROR_CODES = frozenset((
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+))
+
+DEFAULT_RATE_LIMIT_PER_SEC = 10.0
+
+DEFAULT_RATE_LIMIT_MAX_ATTEMPTS = 4
+
+
+class RateLimitExceededError(Exception):
+    """
+        Raised instead of waiting for a rate limiter when its wait queue is full, or the wait would be too long.
+    """
+    pass
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """
+    Return True if :param error is a botocore ClientError for a throttled request.
+    """
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+@functools.lru_cache(maxsize=1)
+def connection_errors() -> tuple:
+    """
+    Return the exception types raised when an endpoint can't be reached or doesn't answer in time: built-in and, if
+    botocore is installed, botocore connection errors and timeouts.
+    """
+    errors = (ConnectionError, TimeoutError)
+    try:
+        from botocore.exceptions import ConnectionError as BotocoreConnectionError, HTTPClientError
+    except ImportError:
+        return errors
+    # HTTPClientError covers read timeouts and connections closed mid-response
+    return errors + (BotocoreConnectionError, HTTPClientError)
+
+
+def is_server_error(error: BaseException) -> bool:
+    """
+    Return True if :param error is a connection error or timeout, or a botocore ClientError with a 5xx status.
+    """
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return isinstance(error, connection_errors())
+    return response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+
+class AdaptiveRateLimiter(object):
+    """
+        Thread-safe token bucket shared by all callers of one API, e.g: sts.get_federation_token, whose rate adapts to
+        throttling: each throttled response cuts the rate by :param decrease_factor, and each success raises it by about
+        :param increase_per_sec per second of successful calls, within [:param min_rate, :param max_rate].
+
+        Callers wait their turn in a queue of at most :param max_waiters rather than piling retries onto a service that
+        is already throttling, and throttled calls are retried after a jittered exponential backoff. Calls failing with
+        a server error, see is_server_error, are retried the same way without cutting the rate, so clients whose own
+        retries are disabled lose nothing by going through the limiter.
+    """
+
+    def __init__(self,
+                 rate: float = DEFAULT_RATE_LIMIT_PER_SEC,
+                 burst: float = None,
+                 min_rate: float = 0.5,
+                 max_rate: float = 100.0,
+                 increase_per_sec: float = 1.0,
+                 decrease_factor: float = 0.5,
+                 decrease_interval_sec: float = 1.0,
+                 max_waiters: int = 64,
+                 max_wait_sec: float = 10.0,
+                 max_attempts: int = DEFAULT_RATE_LIMIT_MAX_ATTEMPTS,
+                 backoff_base_sec: float = 0.1,
+                 backoff_max_sec: float = 5.0):
+        """
+        :param rate: the initial number of calls allowed per second.
+        :param burst: the number of calls allowed back to back after a quiet period. :param rate if None.
+        :param min_rate: the rate is never cut below this.
+        :param max_rate: the rate is never raised above this.
+        :param increase_per_sec: how much the rate grows for each second's worth of successful calls.
+        :param decrease_factor: the rate is multiplied by this on throttling.
+        :param decrease_interval_sec: throttles less than this apart cut the rate once, since concurrent calls sent at
+        the old rate are typically throttled together.
+        :param max_waiters: the number of callers allowed to wait for a token. Further callers get a
+        RateLimitExceededError.
+        :param max_wait_sec: callers whose turn is further away than this get a RateLimitExceededError.
+        :param max_attempts: the number of times call makes a throttled, or failing, call before raising its error.
+        :param backoff_base_sec: the backoff after the first throttled or failed attempt is drawn from [0, this].
+        :param backoff_max_sec: the maximum backoff between attempts.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_per_sec = increase_per_sec
+        self.decrease_factor = decrease_factor
+        self.decrease_interval_sec = decrease_interval_sec
+        self.max_waiters = max_waiters
+        self.max_wait_sec = max_wait_sec
+        self.max_attempts = max_attempts
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+
+        self.throttles = 0
+        self.server_errors = 0
+        self.rejections = 0
+
+        # Tokens go negative as callers reserve future tokens, so waiters are served in order
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._decreased_at = float('-inf')
+        self._waiters = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait_sec: float = None) -> float:
+        """
+        Take a token, waiting for one if necessary. Return the number of seconds waited.
+        Raises RateLimitExceededError if too many callers are already waiting, or the wait would exceed
+        :param max_wait_sec, which defaults to the limiter's.
+        """
+        if max_wait_sec is None:
+            max_wait_sec = self.max_wait_sec
+
+        with self._lock:
+            self._refill(time.monotonic())
+            wait_sec = 0.0 if self._tokens >= 1.0 else (1.0 - self._tokens) / self.rate
+            if wait_sec > 0.0 and (self._waiters >= self.max_waiters or wait_sec > max_wait_sec):
+                self.rejections += 1
+                raise RateLimitExceededError('Rate limited to {:.2f}/s with {} callers waiting'.format(
+                    self.rate, self._waiters))
+            self._tokens -= 1.0
+            if wait_sec > 0.0:
+                self._waiters += 1
+
+        if wait_sec > 0.0:
+            try:
+                time.sleep(wait_sec)
+            finally:
+                with self._lock:
+                    self._waiters -= 1
+        return wait_sec
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_per_sec / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self._decreased_at < self.decrease_interval_sec:
+                return
+            self._refill(now)
+            self._decreased_at = now
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            # Drop any burst accumulated at the old rate, keeping reservations already made
+            self._tokens = min(self._tokens, 0.0)
+            rate = self.rate
+        logger.debug('Throttled, rate limit lowered to %.2f/s', rate)
+
+    def backoff_sec(self, attempt: int) -> float:
+        """
+        Return a random backoff before retrying after :param attempt throttled or failed attempts ("full jitter").
+        """
+        return random.uniform(0.0, min(self.backoff_max_sec, self.backoff_base_sec * (2 ** (attempt - 1))))
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call :param fn with :param args and :param kwargs once a token is available, retrying up to max_attempts
+        times in total while it raises throttling or server errors. Any other error is raised immediately.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            attempt += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    self.on_throttle()
+                elif is_server_error(e):
+                    with self._lock:
+                        self.server_errors += 1
+                else:
+                    raise
+                if attempt >= self.max_attempts:
+                    raise
+                time.sleep(self.backoff_sec(attempt))
+                continue
+            self.on_success()
+            return result
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+# endregion
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+logger = logging.getLogger(__name__)
+
+
+# region Renewal Scheduler
+
+DEFAULT_RENEWAL_MARGIN_SEC = 1800
+
+DEFAULT_RENEWAL_JITTER_SEC = 300
+
+# The margin and jitter are limited to these fractions of a storage's lifetime, so short-lived storages are used for
+# at least a quarter of it before being renewed
+DEFAULT_RENEWAL_MARGIN_FRACTION = 0.5
+
+DEFAULT_RENEWAL_JITTER_FRACTION = 0.25
+
+DEFAULT_RENEWAL_MIN_INTERVAL_SEC = 60
+
+DEFAULT_RENEWAL_RETRY_SEC = 30
+
+DEFAULT_RENEWAL_MAX_RETRY_SEC = 600
+
+
+class RenewalHandle(object):
+    """
+        A storage kept valid by a RenewalScheduler. storage is always the latest one provisioned.
+    """
+
+    __slots__ = ('user_name', 'duration_sec', 'storage', 'callback', 'renew_at', 'failures', 'cancelled', '_entry')
+
+    def __init__(self, storage: S3Storage, user_name: str, duration_sec: int, callback=None):
+        self.user_name = user_name
+        self.duration_sec = duration_sec
+        self.storage = storage
+        self.callback = callback
+        self.renew_at = 0.0
+        self.failures = 0
+        self.cancelled = False
+        # The handle's current heap entry; older entries left in the heap are skipped
+        self._entry = None
+
+    @property
+    def region(self) -> AWSS3Region:
+        region = self.storage.s3_bucket_region
+        return region if isinstance(region, AWSS3Region) else AWSS3Region(region)
+
+
+class RenewalScheduler(object):
+    """
+        Re-provisions watched storages :param margin_sec before they expire, spreading renewals over a further
+        :param jitter_sec so that storages provisioned together aren't renewed together. Storages living less than
+        twice the margin are renewed halfway through their lifetime instead, and a storage is renewed at most once
+        every :param min_interval_sec.
+
+        Handles are kept in a heap ordered by renewal time, serviced by one scheduler thread, so watching a handle is
+        O(log n) and an idle scheduler costs nothing. Renewals run on a small pool of worker threads, and subscribers,
+        as well as each handle's callback, are called there with (handle, new storage) after each renewal.
+        Failed renewals are retried with exponential backoff, and reported to error subscribers.
+    """
+
+    def __init__(self,
+                 provisioner: S3StorageProvisioner,
+                 margin_sec: float = DEFAULT_RENEWAL_MARGIN_SEC,
+                 jitter_sec: float = DEFAULT_RENEWAL_JITTER_SEC,
+                 retry_sec: float = DEFAULT_RENEWAL_RETRY_SEC,
+                 max_retry_sec: float = DEFAULT_RENEWAL_MAX_RETRY_SEC,
+                 max_workers: int = 4,
+                 min_interval_sec: float = DEFAULT_RENEWAL_MIN_INTERVAL_SEC):
+        """
+        :param provisioner: the provisioner renewing storages.
+        :param margin_sec: how long before expiration a storage is renewed, at most DEFAULT_RENEWAL_MARGIN_FRACTION of
+        its lifetime.
+        :param jitter_sec: renewals are brought forward by a random time of up to this, at most
+        DEFAULT_RENEWAL_JITTER_FRACTION of the storage's lifetime.
+        :param retry_sec: the delay before retrying a failed renewal, doubled after each consecutive failure.
+        :param max_retry_sec: the maximum delay between retries.
+        :param max_workers: the number of renewals run concurrently.
+        :param min_interval_sec: the minimum time between successful renewals of a storage, bounding the rate of
+        renewals should the provisioner return storages expiring sooner than expected.
+        """
+        self.provisioner = provisioner
+        self.margin_sec = margin_sec
+        self.jitter_sec = jitter_sec
+        self.retry_sec = retry_sec
+        self.max_retry_sec = max_retry_sec
+        self.max_workers = max_workers
+        self.min_interval_sec = min_interval_sec
+
+        self._subscribers = ()
+        self._error_subscribers = ()
+        # (renew_at, sequence, handle)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._handles = 0
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return self._handles
+
+    def subscribe(self, callback, on_error=None):
+        """
+        Call :param callback with (handle, new storage) after every renewal, and :param on_error, if set, with
+        (handle, error) after every failed one. Called on worker threads; must be thread-safe.
+        """
+        self._subscribers = self._subscribers + (callback,)
+        if on_error is not None:
+            self._error_subscribers = self._error_subscribers + (on_error,)
+
+    def watch(self,
+              storage: S3Storage,
+              user_name: str = None,
+              duration_sec: int = 129600,
+              callback=None) -> RenewalHandle:
+        """
+        Start renewing :param storage, returning the handle through which renewed storages are available.
+
+        :param storage: a storage returned by the provisioner.
+        :param user_name: the user name to renew for. The federated user's name, from aws_federated_user_id, if None.
+        :param duration_sec: the duration of renewed storages.
+        :param callback: an optional callable taking (handle, new storage), called after each renewal of this storage.
+        """
+        if user_name is None:
+            user_name = storage.aws_federated_user_id.split(':', 1)[-1]
+        handle = RenewalHandle(storage, user_name, duration_sec, callback)
+        # A storage may be watched well into its life, so its remaining time bounds its lifetime
+        lifetime_sec = min(duration_sec, storage.seconds_until_expiration())
+        with self._condition:
+            self._handles += 1
+            self._schedule(handle, self._renewal_time(storage, lifetime_sec))
+        return handle
+
+    def unwatch(self, handle: RenewalHandle):
+        """
+        Stop renewing :param handle. A renewal already in progress still completes.
+        """
+        with self._condition:
+            if not handle.cancelled:
+                handle.cancelled = True
+                handle._entry = None
+                self._handles -= 1
+
+    def start(self):
+        """
+        Start the scheduler thread.
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._thread = threading.Thread(target=self._run, name='RenewalScheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop the scheduler thread. If :param wait, block until renewals in progress finish.
+        """
+        with self._condition:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            executor, self._executor = self._executor, None
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def run_pending(self, now: float = None) -> int:
+        """
+        Renew, on the calling thread, every handle due by :param now, a time.monotonic() value. Return the number of
+        handles renewed or attempted. Useful when driving the scheduler from an existing loop instead of start().
+        """
+        due = self._pop_due(time.monotonic() if now is None else now)
+        for handle in due:
+            self._renew(handle)
+        return len(due)
+
+    def _renewal_time(self, storage: S3Storage, lifetime_sec: float) -> float:
+        margin_sec = min(self.margin_sec, DEFAULT_RENEWAL_MARGIN_FRACTION * lifetime_sec)
+        jitter_sec = min(self.jitter_sec, DEFAULT_RENEWAL_JITTER_FRACTION * lifetime_sec)
+        seconds_remaining = storage.seconds_until_expiration() - margin_sec - random.uniform(0, jitter_sec)
+        return time.monotonic() + max(0.0, seconds_remaining)
+
+    def _schedule(self, handle: RenewalHandle, renew_at: float):
+        # Must hold self._condition
+        if handle.cancelled:
+            return
+        handle.renew_at = renew_at
+        entry = handle._entry = (renew_at, next(self._sequence), handle)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._condition.notify()
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        with self._condition:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                entry = heapq.heappop(heap)
+                handle = entry[2]
+                if handle._entry is entry:
+                    handle._entry = None
+                    due.append(handle)
+        return due
+
+    def _renew(self, handle: RenewalHandle):
+        storage = handle.storage
+        try:
+            renewed = self.provisioner.provision_new_storage(handle.user_name,
+                                                             storage.s3_bucket_name,
+                                                             storage.s3_bucket_path,
+                                                             handle.region,
+                                                             storage.aws_policy,
+                                                             handle.duration_sec,
+                                                             check_bucket=False)
+        except Exception as e:
+            handle.failures += 1
+            delay_sec = min(self.max_retry_sec, self.retry_sec * (2 ** (handle.failures - 1)))
+            logger.warning('Failed to renew storage for %s in %s/%s, retrying in %.0fs: %s', handle.user_name,
+                           storage.s3_bucket_name, storage.s3_bucket_path, delay_sec, e)
+            with self._condition:
+                self._schedule(handle, time.monotonic() + delay_sec)
+            self._notify(self._error_subscribers, handle, e)
+            return
+
+        handle.storage = renewed
+        handle.failures = 0
+        # STS may grant less than the requested duration, so a fresh storage's remaining time bounds its lifetime
+        lifetime_sec = min(handle.duration_sec, renewed.seconds_until_expiration())
+        renew_at = max(self._renewal_time(renewed, lifetime_sec), time.monotonic() + self.min_interval_sec)
+        with self._condition:
+            self._schedule(handle, renew_at)
+
+        callbacks = self._subscribers
+        if handle.callback is not None:
+            callbacks = callbacks + (handle.callback,)
+        self._notify(callbacks, handle, renewed)
+
+    @staticmethod
+    def _notify(callbacks: tuple, handle: RenewalHandle, value):
+        for callback in callbacks:
+            try:
+                callback(handle, value)
+            except Exception:
+                logger.exception('Renewal callback %r failed', callback)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                timeout = None
+                if self._heap:
+                    timeout = self._heap[0][0] - time.monotonic()
+                if timeout is None or timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                executor = self._executor
+
+            for handle in self._pop_due(time.monotonic()):
+                try:
+                    executor.submit(self._renew, handle)
+                except RuntimeError:
+                    # Stopped meanwhile
+                    return
+
+# endregion
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import re
+
+from storage_provisioner.cache import credential_cache_key
+from storage_provisioner.instrumentation import retry_attempts
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.singleflight import SingleFlight
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+# region Session Tag Policies
+
+DEFAULT_BUCKET_TAG_KEY = 'storage-bucket'
+
+DEFAULT_PATH_TAG_KEY = 'storage-path'
+
+# The default, and without raising the role's MaxSessionDuration the maximum, duration of an assumed role session
+DEFAULT_ASSUMED_ROLE_DURATION_SEC = 3600
+
+# The maximum length of a session tag value
+AWS_STS_MAX_TAG_VALUE_LENGTH = 256
+
+_TAG_VALUE_PATTERN = re.compile(r'[\w .:/=+\-@]*')
+
+_ROLE_SESSION_NAME_INVALID = re.compile(r'[^\w+=,.@-]')
+
+SESSION_TAG_ROLE_POLICY_TEMPLATE = """{
+   "Version":"2012-10-17",
+   "Statement":[
+      {
+         "Effect":"Allow",
+         "Action":[
+            "s3:PutObject",
+            "s3:PutObjectAcl",
+            "s3:PutObjectAclVersion",
+            "s3:GetObject",
+            "s3:GetObjectVersion",
+            "s3:DeleteObject",
+            "s3:DeleteObjectVersion",
+            "s3:ListMultipartUploadParts",
+            "s3:AbortMultipartUpload"
+         ],
+         "Resource":"arn:aws:s3:::${aws:PrincipalTag/{bucket_tag}}/${aws:PrincipalTag/{path_tag}}*"
+      },
+      {
+         "Effect":"Allow",
+         "Action":[
+            "s3:ListBucket"
+         ],
+         "Resource":"arn:aws:s3:::${aws:PrincipalTag/{bucket_tag}}",
+         "Condition":{
+            "StringLike":{
+               "s3:prefix":"${aws:PrincipalTag/{path_tag}}*"
+            }
+         }
+      },
+      {
+         "Effect":"Allow",
+         "Action":[
+            "s3:GetBucketLocation"
+         ],
+         "Resource":"arn:aws:s3:::${aws:PrincipalTag/{bucket_tag}}"
+      }
+   ]
+}
+"""
+
+
+def render_session_tag_role_policy(bucket_tag_key: str = DEFAULT_BUCKET_TAG_KEY,
+                                   path_tag_key: str = DEFAULT_PATH_TAG_KEY) -> str:
+    """
+    Return the permissions policy to attach to the role assumed by TaggedRoleS3StorageProvisioner, scoped to whichever
+    bucket and path the session is tagged with, so one policy serves every tenant.
+
+    Objects under the path get the same access as under DEFAULT_AWS_S3_POLICY. Unlike it, the policy allows
+    s3:ListBucket on the bucket only for prefixes within the path, and doesn't allow s3:ListAllMyBuckets.
+    """
+    policy = SESSION_TAG_ROLE_POLICY_TEMPLATE.replace('{bucket_tag}', bucket_tag_key)
+    policy = policy.replace('{path_tag}', path_tag_key)
+    return json.dumps(json.loads(policy), separators=(',', ':'))
+
+
+def render_session_tag_trust_policy(principal_arn: str) -> str:
+    """
+    Return a trust policy letting :param principal_arn, the IAM user whose keys the provisioner uses, assume the role
+    with session tags.
+    """
+    return json.dumps({
+        'Version': '2012-10-17',
+        'Statement': [{
+            'Effect': 'Allow',
+            'Principal': {'AWS': principal_arn},
+            'Action': ['sts:AssumeRole', 'sts:TagSession'],
+        }],
+    }, separators=(',', ':'))
+
+
+def validate_tag_value(value: str):
+    """
+    Raise ValueError if :param value can't be sent as a session tag value.
+    """
+    if len(value) > AWS_STS_MAX_TAG_VALUE_LENGTH:
+        raise ValueError('Session tag value is {} characters, exceeding the limit of {}'.format(
+            len(value), AWS_STS_MAX_TAG_VALUE_LENGTH))
+    if _TAG_VALUE_PATTERN.fullmatch(value) is None:
+        raise ValueError('Session tag value {!r} contains characters other than letters, digits, spaces and '
+                         '_.:/=+-@'.format(value))
+
+
+def role_session_name(user_name: str) -> str:
+    """
+    Return :param user_name as a valid RoleSessionName: 2 to 64 of the characters allowed, others replaced by '-'.
+    """
+    name = _ROLE_SESSION_NAME_INVALID.sub('-', user_name)[:64]
+    return name if len(name) >= 2 else name.ljust(2, '-')
+
+# endregion
+
+# region Session Tag Provisioner
+
+
+class TaggedRoleS3StorageProvisioner(object):
+    """
+        Provisions S3Storages by assuming one role with session tags for the bucket and path, instead of sending a
+        rendered inline policy with each federation token request.
+
+        The role carries the policy from render_session_tag_role_policy, whose ${aws:PrincipalTag/...} variables scope
+        each session to its tags, so a request only sends two short tags. Its access differs slightly from
+        DEFAULT_AWS_S3_POLICY's, see render_session_tag_role_policy. The returned S3Storage is the same type as
+        S3StorageProvisioner returns, with aws_policy set to None since no inline policy is sent.
+
+        Buckets are checked, credentials cached and identical concurrent requests coalesced through the wrapped
+        provisioner's bucket cache, credential cache and rate limiter. It also provides provision_new_storage, so a
+        RenewalScheduler can renew its storages.
+    """
+
+    def __init__(self,
+                 provisioner: S3StorageProvisioner,
+                 role_arn: str,
+                 bucket_tag_key: str = DEFAULT_BUCKET_TAG_KEY,
+                 path_tag_key: str = DEFAULT_PATH_TAG_KEY,
+                 external_id: str = None):
+        """
+        :param provisioner: the provisioner whose credentials assume the role. They must belong to an IAM user
+        trusted by the role, see render_session_tag_trust_policy, since root credentials can't assume roles.
+        :param role_arn: the ARN of the role carrying render_session_tag_role_policy(bucket_tag_key, path_tag_key).
+        :param bucket_tag_key: the session tag holding the bucket name.
+        :param path_tag_key: the session tag holding the path.
+        :param external_id: the external ID required by the role's trust policy, if any.
+        """
+        self.provisioner = provisioner
+        self.role_arn = role_arn
+        self.bucket_tag_key = bucket_tag_key
+        self.path_tag_key = path_tag_key
+        self.external_id = external_id
+        self._provisions = SingleFlight()
+
+    @property
+    def default_region(self) -> AWSS3Region:
+        return self.provisioner.default_region
+
+    def provision_storage(self,
+                          user_name: str,
+                          bucket_name: str,
+                          path: str = '',
+                          region: AWSS3Region = None,
+                          duration_sec: int = DEFAULT_ASSUMED_ROLE_DURATION_SEC) -> S3Storage:
+        """
+        Provision read/write access to :param path within :param bucket_name, creating the bucket if necessary.
+        Takes the same arguments as S3StorageProvisioner.provision_storage, except for user_policy.
+
+        :param user_name: the role session name, made valid by role_session_name.
+        :param path: a path within the bucket, omitting leading '/'. Sent as a session tag, so limited to 256 letters,
+        digits, spaces and _.:/=+-@ characters.
+        :param duration_sec: the duration of the returned credentials, at most the role's MaxSessionDuration.
+        """
+        if region is None:
+            region = self.provisioner.default_region
+        if path is None:
+            path = ''
+
+        instrumentation = self.provisioner.instrumentation
+        with instrumentation.trace(user_name, bucket_name, path, region.value):
+            validate_tag_value(bucket_name)
+            validate_tag_value(path)
+
+            loader = functools.partial(self.provision_new_storage,
+                                       user_name, bucket_name, path, region, None, duration_sec)
+            # The role and the tags sent take the place of the policy, as they determine what the credentials grant
+            role = (self.role_arn, self.bucket_tag_key, self.path_tag_key, self.external_id)
+            key = credential_cache_key(user_name, role, bucket_name, path, region.value, duration_sec)
+
+            if self.provisioner.coalesce_requests:
+                loader = functools.partial(self._provisions.do, key, loader)
+
+            credential_cache = self.provisioner.credential_cache
+            if credential_cache is None:
+                return loader()
+            return credential_cache.get(key, loader)
+
+    def provision_new_storage(self,
+                              user_name: str,
+                              bucket_name: str,
+                              path: str,
+                              region: AWSS3Region,
+                              user_policy: str = None,
+                              duration_sec: int = DEFAULT_ASSUMED_ROLE_DURATION_SEC,
+                              check_bucket: bool = True) -> S3Storage:
+        """
+        Assume the role for a new session, bypassing any credential cache.
+        Takes the same arguments as S3StorageProvisioner.provision_new_storage. :param user_policy is ignored: access
+        is granted by the role's policy for the session's tags.
+        """
+        if check_bucket:
+            self.provisioner.create_bucket_if_needed(bucket_name=bucket_name, region=region)
+
+        instrumentation = self.provisioner.instrumentation
+        with instrumentation.phase('client'):
+            sts = self.provisioner.client_pool.client('sts', region.value)
+
+        kwargs = {
+            'RoleArn': self.role_arn,
+            'RoleSessionName': role_session_name(user_name),
+            'DurationSeconds': duration_sec,
+            'Tags': [{'Key': self.bucket_tag_key, 'Value': bucket_name},
+                     {'Key': self.path_tag_key, 'Value': path or ''}],
+        }
+        if self.external_id is not None:
+            kwargs['ExternalId'] = self.external_id
+
+        def assume_role() -> dict:
+            with instrumentation.phase('assume_role') as phase:
+                resp = sts.assume_role(**kwargs)
+                phase.retries = retry_attempts(resp)
+            return resp
+
+        rate_limiter = self.provisioner.rate_limiter
+        resp = assume_role() if rate_limiter is None else rate_limiter.call(assume_role)
+
+        credentials = resp['Credentials']
+        assumed_role_user = resp['AssumedRoleUser']
+        return S3Storage(bucket_name,
+                         region.value,
+                         path,
+                         credentials['AccessKeyId'],
+                         credentials['SecretAccessKey'],
+                         credentials['SessionToken'],
+                         credentials['Expiration'],
+                         assumed_role_user['AssumedRoleId'],
+                         assumed_role_user['Arn'],
+                         None)
+
+# endregion
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+import threading
+
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+# region Consistent Hashing
+
+DEFAULT_HASH_RING_VIRTUAL_NODES = 160
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def hash_prefix(path: str, length: int) -> str:
+    """
+    Return :param length hexadecimal characters derived from :param path, spreading paths evenly over 16 ** length
+    prefixes, and so over S3's key partitions.
+    """
+    return hashlib.blake2b(('prefix:' + path).encode('utf-8'), digest_size=(length + 1) // 2).hexdigest()[:length]
+
+
+class HashRing(object):
+    """
+        Thread-safe consistent hash ring mapping keys to nodes, e.g: logical paths to bucket names.
+
+        Each node is placed on the ring :param virtual_nodes times its weight, so keys spread evenly, and adding or
+        removing one node of N only moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes=(), virtual_nodes: int = DEFAULT_HASH_RING_VIRTUAL_NODES):
+        """
+        :param nodes: the initial nodes, each a name or a (name, weight) tuple.
+        :param virtual_nodes: the number of points on the ring for a node of weight 1.
+        """
+        self.virtual_nodes = virtual_nodes
+        self._weights = {}
+        self._points = []
+        self._nodes = []
+        self._lock = threading.Lock()
+
+        for node in nodes:
+            if isinstance(node, tuple):
+                self.add_node(*node)
+            else:
+                self.add_node(node)
+
+    def __len__(self):
+        return len(self._weights)
+
+    @property
+    def nodes(self) -> list:
+        return sorted(self._weights)
+
+    def add_node(self, name: str, weight: int = 1):
+        with self._lock:
+            self._weights[name] = weight
+            self._rebuild()
+
+    def remove_node(self, name: str):
+        with self._lock:
+            if self._weights.pop(name, None) is not None:
+                self._rebuild()
+
+    def node_for(self, key: str) -> str:
+        """
+        Return the node :param key maps to: the first node clockwise of the key's hash on the ring.
+        """
+        points, nodes = self._points, self._nodes
+        if not points:
+            raise ValueError('HashRing has no nodes')
+        index = bisect.bisect(points, _hash(key))
+        return nodes[index if index < len(nodes) else 0]
+
+    def _rebuild(self):
+        ring = sorted((_hash('{}#{}'.format(name, i)), name)
+                      for name, weight in self._weights.items()
+                      for i in range(weight * self.virtual_nodes))
+        # Replaced together, so node_for never sees one updated without the other
+        self._points, self._nodes = [point for point, _ in ring], [name for _, name in ring]
+
+# endregion
+
+# region Sharded Provisioner
+
+
+class ShardedS3StorageProvisioner(object):
+    """
+        Spreads logical paths over several buckets by consistent hashing and, optionally, over S3 key partitions
+        within each bucket by prefixing paths with a short hash.
+
+        The S3Storage returned by provision_storage describes the physical location: its bucket, its prefixed
+        s3_bucket_path and its policy, so keys built from them, and get_url_for_key, point where the data lives.
+        A logical path always maps to the same location while the buckets don't change.
+    """
+
+    def __init__(self,
+                 provisioner: S3StorageProvisioner,
+                 bucket_names,
+                 prefix_length: int = 0,
+                 bucket_regions: dict = None,
+                 virtual_nodes: int = DEFAULT_HASH_RING_VIRTUAL_NODES):
+        """
+        :param provisioner: the provisioner creating storages.
+        :param bucket_names: the buckets to spread paths over, each a name or a (name, weight) tuple.
+        :param prefix_length: the number of hexadecimal characters of the hash prefix added to paths. 0 to leave
+        paths unchanged. Each extra character multiplies the number of prefixes by 16.
+        :param bucket_regions: a dict of bucket name to AWSS3Region, for buckets outside the provisioner's default
+        region.
+        :param virtual_nodes: see HashRing.
+        """
+        self.provisioner = provisioner
+        self.prefix_length = prefix_length
+        self.bucket_regions = dict(bucket_regions or {})
+        self.ring = HashRing(bucket_names, virtual_nodes=virtual_nodes)
+
+    def locate(self, path: str) -> tuple:
+        """
+        Return the (bucket name, physical path) where the logical :param path is stored.
+        """
+        bucket_name = self.ring.node_for(path)
+        if self.prefix_length > 0:
+            path = '{}/{}'.format(hash_prefix(path, self.prefix_length), path)
+        return bucket_name, path
+
+    def region_for_bucket(self, bucket_name: str) -> AWSS3Region:
+        return self.bucket_regions.get(bucket_name, self.provisioner.default_region)
+
+    def provision_storage(self,
+                          user_name: str,
+                          path: str,
+                          user_policy: str = None,
+                          duration_sec: int = 129600) -> S3Storage:
+        """
+        Provision read/write access to the physical location of the logical :param path.
+        Takes the same arguments as S3StorageProvisioner.provision_storage, except that the bucket and region are
+        chosen by the sharding. A custom :param user_policy must grant access to the physical location, see locate.
+        """
+        bucket_name, physical_path = self.locate(path)
+        return self.provisioner.provision_storage(user_name,
+                                                  bucket_name,
+                                                  physical_path,
+                                                  region=self.region_for_bucket(bucket_name),
+                                                  user_policy=user_policy,
+                                                  duration_sec=duration_sec)
+
+# endregion
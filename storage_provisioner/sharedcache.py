@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from storage_provisioner.cache import CredentialCache, DEFAULT_CREDENTIAL_CACHE_MAX_SIZE, \
+    DEFAULT_CREDENTIAL_CACHE_MIN_REMAINING_SEC, DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_SEC, \
+    DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_FRACTION
+from storage_provisioner.storage import S3Storage
+
+logger = logging.getLogger(__name__)
+
+
+# region Shared Credential Cache
+
+DEFAULT_SHARED_CREDENTIAL_CACHE_MAX_SIZE = 200000
+
+DEFAULT_SHARED_CREDENTIAL_CACHE_PURGE_INTERVAL_SEC = 60
+
+DEFAULT_SHARED_CREDENTIAL_CACHE_BUSY_TIMEOUT_SEC = 5.0
+
+# Version of the on-disk schema, stored in the database's user_version
+SHARED_CREDENTIAL_CACHE_SCHEMA_VERSION = 1
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS credentials ('
+    ' key BLOB PRIMARY KEY,'
+    ' expires_us INTEGER NOT NULL,'
+    ' storage BLOB NOT NULL'
+    ') WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS credentials_expires_us ON credentials (expires_us)',
+)
+
+# Keeps the entry expiring last, so a slow writer can't replace fresher credentials minted by another process
+_UPSERT = ('INSERT INTO credentials (key, expires_us, storage) VALUES (?, ?, ?) '
+           'ON CONFLICT (key) DO UPDATE SET expires_us = excluded.expires_us, storage = excluded.storage '
+           'WHERE excluded.expires_us > credentials.expires_us')
+
+
+def shared_cache_key(key: tuple) -> bytes:
+    """
+    Return the database key of :param key, a key returned by credential_cache_key: a digest of the user name,
+    rendered policy, bucket, path, region and duration.
+    """
+    return hashlib.sha256(json.dumps(key, separators=(',', ':')).encode('utf-8')).digest()
+
+
+def _expiration_us(storage: S3Storage) -> int:
+    return int((time.time() + storage.seconds_until_expiration()) * 1000000)
+
+
+class SharedCredentialCache(CredentialCache):
+    """
+        CredentialCache backed by an SQLite database in WAL mode, shared by every process on a host opening the same
+        :param path, so that credentials minted by one worker are reused by all of them until they near expiration.
+
+        Each process keeps its most recently used storages in memory, as CredentialCache does, and only reads the
+        database on a miss or once its copy is due for refresh, picking up credentials refreshed by another process.
+        WAL mode lets any number of processes read while one writes.
+
+        The database holds live credentials, so it is created readable by its owner only. Database errors are logged
+        and treated as misses, so provisioning keeps working if the file is unavailable.
+    """
+
+    def __init__(self,
+                 path: str,
+                 max_size: int = DEFAULT_CREDENTIAL_CACHE_MAX_SIZE,
+                 min_remaining_sec: float = DEFAULT_CREDENTIAL_CACHE_MIN_REMAINING_SEC,
+                 refresh_ahead_sec: float = DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_SEC,
+                 max_refresh_workers: int = 4,
+                 max_shared_size: int = DEFAULT_SHARED_CREDENTIAL_CACHE_MAX_SIZE,
+                 purge_interval_sec: float = DEFAULT_SHARED_CREDENTIAL_CACHE_PURGE_INTERVAL_SEC,
+                 busy_timeout_sec: float = DEFAULT_SHARED_CREDENTIAL_CACHE_BUSY_TIMEOUT_SEC,
+                 refresh_ahead_fraction: float = DEFAULT_CREDENTIAL_CACHE_REFRESH_AHEAD_FRACTION):
+        """
+        :param path: the database file, e.g: '/run/storage_provisioner/credentials.db'. Created if necessary.
+        :param max_size: the maximum number of storages kept in this process's memory.
+        :param min_remaining_sec: the minimum lifetime a cached storage must have left to be returned.
+        :param refresh_ahead_sec: the remaining lifetime below which a cached storage is refreshed in the background.
+        :param max_refresh_workers: the number of threads used for background refreshes.
+        :param max_shared_size: the maximum number of storages in the database. The storages expiring soonest are
+        evicted beyond this.
+        :param purge_interval_sec: how often, at most, each process evicts expired storages from the database.
+        :param busy_timeout_sec: how long to wait for another process's write to finish before giving up.
+        :param refresh_ahead_fraction: caps :param refresh_ahead_sec at this fraction of the duration in the key of a
+        cached storage.
+        """
+        CredentialCache.__init__(self,
+                                 max_size=max_size,
+                                 min_remaining_sec=min_remaining_sec,
+                                 refresh_ahead_sec=refresh_ahead_sec,
+                                 max_refresh_workers=max_refresh_workers,
+                                 refresh_ahead_fraction=refresh_ahead_fraction)
+        self.path = path
+        self.max_shared_size = max_shared_size
+        self.purge_interval_sec = purge_interval_sec
+        self.busy_timeout_sec = busy_timeout_sec
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._purged_at = time.monotonic()
+
+        # Create the file with owner-only permissions before SQLite creates it with the umask's
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        connection = self._connection()
+        if connection.execute('PRAGMA user_version').fetchone()[0] == 0:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            connection.execute('PRAGMA user_version = {}'.format(SHARED_CREDENTIAL_CACHE_SCHEMA_VERSION))
+
+    def shared_len(self) -> int:
+        """
+        Return the number of storages in the database, including expired ones not yet purged.
+        """
+        return self._connection().execute('SELECT COUNT(*) FROM credentials').fetchone()[0]
+
+    def peek(self, key: tuple) -> S3Storage:
+        """
+        Return the storage cached for :param key in this process or, if it is missing or due for refresh, the one in
+        the database expiring last, whatever its remaining lifetime. None if neither exists.
+        """
+        storage = CredentialCache.peek(self, key)
+        if storage is not None and storage.seconds_until_expiration() > self.refresh_ahead_sec_for(key):
+            return storage
+
+        shared = self._load(key)
+        if shared is not None and (storage is None or
+                                   shared.seconds_until_expiration() > storage.seconds_until_expiration()):
+            CredentialCache.put(self, key, shared)
+            return shared
+        return storage
+
+    def put(self, key: tuple, storage: S3Storage):
+        CredentialCache.put(self, key, storage)
+        self._store(key, storage)
+
+    def invalidate(self, key: tuple = None):
+        """
+        Forget the storage cached for :param key, or every cached storage if :param key is None, in this process and
+        in the database.
+        """
+        CredentialCache.invalidate(self, key)
+        try:
+            if key is None:
+                self._connection().execute('DELETE FROM credentials')
+            else:
+                self._connection().execute('DELETE FROM credentials WHERE key = ?', (shared_cache_key(key),))
+        except sqlite3.Error:
+            logger.exception('Failed to invalidate shared credential cache %s', self.path)
+
+    def purge(self) -> int:
+        """
+        Delete storages from the database that have fewer than min_remaining_sec left, then the storages expiring
+        soonest beyond max_shared_size. Return the number of storages deleted.
+        """
+        self._purged_at = time.monotonic()
+        connection = self._connection()
+        min_expires_us = int((time.time() + self.min_remaining_sec) * 1000000)
+        deleted = connection.execute('DELETE FROM credentials WHERE expires_us < ?', (min_expires_us,)).rowcount
+
+        excess = self.shared_len() - self.max_shared_size
+        if excess > 0:
+            deleted += connection.execute('DELETE FROM credentials WHERE key IN '
+                                          '(SELECT key FROM credentials ORDER BY expires_us LIMIT ?)',
+                                          (excess,)).rowcount
+        return deleted
+
+    def close(self, wait: bool = True):
+        """
+        Stop background refreshes, then close this process's database connections.
+        """
+        CredentialCache.close(self, wait)
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def _replace(self, key: tuple, storage: S3Storage) -> bool:
+        if not CredentialCache._replace(self, key, storage):
+            return False
+        self._store(key, storage)
+        return True
+
+    def _refresh(self, key: tuple, loader):
+        def load() -> S3Storage:
+            # Another process may have refreshed these credentials already
+            shared = self._load(key)
+            if shared is not None and shared.seconds_until_expiration() > self.refresh_ahead_sec_for(key):
+                return shared
+            return loader()
+
+        CredentialCache._refresh(self, key, load)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Each thread uses its own connection, closed by close from whichever thread calls it
+            connection = sqlite3.connect(self.path,
+                                         timeout=self.busy_timeout_sec,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode, NORMAL only risks losing the last writes on power loss, which a cache can afford
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _load(self, key: tuple) -> S3Storage:
+        try:
+            row = self._connection().execute('SELECT storage FROM credentials WHERE key = ? AND expires_us > ?',
+                                             (shared_cache_key(key), int(time.time() * 1000000))).fetchone()
+        except sqlite3.Error:
+            logger.exception('Failed to read shared credential cache %s', self.path)
+            return None
+        if row is None:
+            return None
+        try:
+            return S3Storage.from_bytes(row[0])
+        except (ValueError, UnicodeDecodeError, struct.error):
+            # Written by an incompatible version
+            return None
+
+    def _store(self, key: tuple, storage: S3Storage):
+        try:
+            self._connection().execute(_UPSERT, (shared_cache_key(key), _expiration_us(storage), storage.to_bytes()))
+            if time.monotonic() - self._purged_at >= self.purge_interval_sec:
+                self.purge()
+        except sqlite3.Error:
+            logger.exception('Failed to write shared credential cache %s', self.path)
+
+# endregion
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+AWS Signature Version 4 query-string signing ("presigning") of S3 URLs, computed locally from a set of credentials,
+without creating a boto3 client.
+
+See https://docs.aws.amazon.com/AmazonS3/latest/API/sigv4-query-string-auth.html
+"""
+import functools
+import hashlib
+import hmac
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+# region Signature Version 4
+
+SIGV4_ALGORITHM = 'AWS4-HMAC-SHA256'
+
+# The longest validity S3 accepts for a presigned URL, 7 days
+S3_PRESIGN_MAX_EXPIRES_SEC = 604800
+
+DEFAULT_PRESIGN_EXPIRES_SEC = 3600
+
+# Signing keys are valid for one day, so this only needs to cover the credentials in use on one day
+DEFAULT_SIGNING_KEY_CACHE_SIZE = 1024
+
+_UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+def _hmac_sha256(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+@functools.lru_cache(maxsize=DEFAULT_SIGNING_KEY_CACHE_SIZE)
+def signing_key(secret_access_key: str, date_stamp: str, region_name: str, service_name: str = 's3') -> bytes:
+    """
+    Return the SigV4 signing key for :param secret_access_key on :param date_stamp, e.g: '20240131', derived once and
+    cached, since it is the same for every request signed that day in that region.
+    """
+    key = _hmac_sha256(('AWS4' + secret_access_key).encode('utf-8'), date_stamp)
+    key = _hmac_sha256(key, region_name)
+    key = _hmac_sha256(key, service_name)
+    return _hmac_sha256(key, 'aws4_request')
+
+
+def _uri_encode(value: str, safe: str = '') -> str:
+    # SigV4 leaves only unreserved characters unencoded: A-Z a-z 0-9 - _ . ~
+    return quote(value, safe=safe + '~')
+
+
+def s3_endpoint(bucket_name: str, region_name: str) -> tuple:
+    """
+    Return the (host, path prefix) addressing :param bucket_name in :param region_name: a virtual-hosted bucket
+    where possible, or path-style for bucket names containing dots, which don't match S3's TLS certificate.
+    """
+    if '.' in bucket_name:
+        return 's3.{}.amazonaws.com'.format(region_name), '/' + _uri_encode(bucket_name)
+    return '{}.s3.{}.amazonaws.com'.format(bucket_name, region_name), ''
+
+
+class S3Presigner(object):
+    """
+        Presigns S3 URLs for keys in one bucket, with one set of credentials, at one point in time.
+
+        Everything shared by these URLs, from the signing key to the query string, is computed once, leaving one
+        SHA-256 and one HMAC-SHA256 per URL.
+    """
+
+    def __init__(self,
+                 bucket_name: str,
+                 region_name: str,
+                 aws_access_key_id: str,
+                 aws_secret_access_key: str,
+                 aws_session_token: str = None,
+                 expires_sec: int = DEFAULT_PRESIGN_EXPIRES_SEC,
+                 now: datetime = None):
+        """
+        :param bucket_name:
+        :param region_name:
+        :param aws_access_key_id:
+        :param aws_secret_access_key:
+        :param aws_session_token: required for temporary credentials, e.g: those of a federation token.
+        :param expires_sec: how long URLs remain valid after :param now, at most S3_PRESIGN_MAX_EXPIRES_SEC. URLs
+        signed with temporary credentials also stop working when the credentials expire.
+        :param now: the signing time. datetime.now(timezone.utc) if None.
+        """
+        if not 1 <= expires_sec <= S3_PRESIGN_MAX_EXPIRES_SEC:
+            raise ValueError('expires_sec must be between 1 and {}, got {}'.format(
+                S3_PRESIGN_MAX_EXPIRES_SEC, expires_sec))
+        if now is None:
+            now = datetime.now(timezone.utc)
+        elif now.tzinfo is not None:
+            now = now.astimezone(timezone.utc)
+
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date_stamp = amz_date[:8]
+        scope = '{}/{}/s3/aws4_request'.format(date_stamp, region_name)
+
+        self.host, self._path_prefix = s3_endpoint(bucket_name, region_name)
+        self.amz_date = amz_date
+        self.expires_sec = int(expires_sec)
+
+        params = [
+            ('X-Amz-Algorithm', SIGV4_ALGORITHM),
+            ('X-Amz-Credential', '{}/{}'.format(aws_access_key_id, scope)),
+            ('X-Amz-Date', amz_date),
+            ('X-Amz-Expires', str(self.expires_sec)),
+        ]
+        if aws_session_token:
+            params.append(('X-Amz-Security-Token', aws_session_token))
+        params.append(('X-Amz-SignedHeaders', 'host'))
+        # Already in the sorted order SigV4 requires
+        self._query = '&'.join('{}={}'.format(name, _uri_encode(value)) for name, value in params)
+
+        # Canonical request: method \n path \n query \n headers \n signed headers \n payload hash
+        self._canonical_suffix = '\n{}\nhost:{}\n\nhost\n{}'.format(self._query, self.host, _UNSIGNED_PAYLOAD)
+        self._string_to_sign_prefix = '{}\n{}\n{}\n'.format(SIGV4_ALGORITHM, amz_date, scope)
+        self._hmac = hmac.new(signing_key(aws_secret_access_key, date_stamp, region_name), digestmod=hashlib.sha256)
+
+    def presign(self, key: str, method: str = 'GET') -> str:
+        """
+        Return a presigned URL allowing :param method on :param key, e.g: 'some_folder/myfile.ts'.
+        """
+        path = self._path_prefix + '/' + _uri_encode(key, safe='/')
+        canonical_request = method + '\n' + path + self._canonical_suffix
+        string_to_sign = self._string_to_sign_prefix + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+
+        mac = self._hmac.copy()
+        mac.update(string_to_sign.encode('utf-8'))
+        return 'https://{}{}?{}&X-Amz-Signature={}'.format(self.host, path, self._query, mac.hexdigest())
+
+    def presign_many(self, keys, method: str = 'GET'):
+        """
+        Yield a presigned URL for each of :param keys, in order.
+        """
+        presign = self.presign
+        for key in keys:
+            yield presign(key, method)
+
+# endregion
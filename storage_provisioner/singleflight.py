@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Coalesces concurrent calls with the same key into one underlying call, whose result, or error, every caller receives.
+"""
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import asyncio
+
+# region Single Flight
+
+
+class _Call(object):
+
+    __slots__ = ('done', 'result', 'error', 'callers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.callers = 1
+
+
+class SingleFlight(object):
+    """
+        Thread-safe. While a call for a key is in flight, further calls for that key wait for it instead of making
+        their own. Results are not kept once the call returns; use a cache for that.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Return fn(*args, **kwargs), or the result of the call already in flight for :param key.
+        If the call raises, every caller waiting on it raises the same error.
+
+        :param key: a hashable identifying calls that can share a result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.callers += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight(object):
+    """
+        The asyncio counterpart of SingleFlight, for coroutines on one event loop.
+
+        The shared call runs as its own task, so cancelling any one caller, including the first, doesn't cancel it for
+        the others. asyncio is imported on first use, so that threaded users of this module don't pay for it.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def do(self, key, coroutine_fn, *args, **kwargs):
+        """
+        Return await coroutine_fn(*args, **kwargs), or the result of the call already in flight for :param key.
+        If the call raises, every caller waiting on it raises the same error.
+
+        :param key: a hashable identifying calls that can share a result.
+        """
+        import asyncio
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_fn(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: 'asyncio.Future'):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Mark the error as retrieved, in case every caller was cancelled before it was raised
+            task.exception()
+
+# endregion
@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
+import errno
+import mmap
+import os
+import stat
+import struct
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
 from enum import Enum
+from typing import Optional
+
+from storage_provisioner.sigv4 import S3Presigner, DEFAULT_PRESIGN_EXPIRES_SEC
 
 
 class Storage(object):
@@ -7,20 +18,166 @@ class Storage(object):
         Represents the credentials needed to access storage.
     """
 
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 
+# region Local File
+
+DEFAULT_LOCAL_FILE_CHUNK_SIZE = 1024 * 1024
+
+# Errors raised by copy_file_range or sendfile when the kernel or filesystem can't copy between two files
+_ZERO_COPY_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """
+    Copy :param count bytes from :param offset in :param src_fd to the current position of :param dst_fd without
+    passing through userspace. Return the number of bytes copied, which is short only if no zero-copy path is
+    available, in which case the caller copies the rest.
+    """
+    copied = 0
+    for name in ('copy_file_range', 'sendfile'):
+        zero_copy = getattr(os, name, None)
+        if zero_copy is None:
+            continue
+        try:
+            while copied < count:
+                if name == 'copy_file_range':
+                    sent = zero_copy(src_fd, dst_fd, count - copied, offset + copied)
+                else:
+                    sent = zero_copy(dst_fd, src_fd, offset + copied, count - copied)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in _ZERO_COPY_UNSUPPORTED_ERRNOS:
+                raise
+            continue
+        break
+    return copied
+
+
+def _write_all(dst, data: memoryview):
+    while data:
+        written = dst.write(data)
+        data = data[written:]
+
+
 class LocalFileStorage(Storage):
     """
         Represents the credentials needed to access storage on the local filesystem.
+
+        Keys are paths relative to base_path, and may not refer to anything outside it.
     """
 
+    __slots__ = ('base_path',)
+
     def __init__(self, base_path: str=None):
         self.base_path = base_path
         Storage.__init__(self)
         pass
 
+    def path_for_key(self, key: str) -> str:
+        """
+        Return the absolute filesystem path of :param key, raising ValueError if it is outside base_path.
+        """
+        base_path = os.path.realpath(self.base_path)
+        path = os.path.realpath(os.path.join(base_path, key))
+        if os.path.commonpath([base_path, path]) != base_path:
+            raise ValueError('Key {} is outside of {}'.format(key, self.base_path))
+        return path
+
+    def get_url_for_key(self, key: str) -> str:
+        """
+        Return a file:// URL where the specified key would reside.
+        """
+        return 'file://' + self.path_for_key(key)
+
+    def write(self, key: str, data, chunk_size: int = DEFAULT_LOCAL_FILE_CHUNK_SIZE) -> int:
+        """
+        Atomically replace the contents of :param key with :param data, creating directories as needed.
+
+        Regular files are copied from their current position with copy_file_range or sendfile, so the data never
+        passes through Python. Other file objects are copied through a single reused buffer.
+
+        :param key: a path relative to base_path
+        :param data: a bytes-like object, or a binary file object
+        :param chunk_size: the buffer size used when :param data can't be copied without passing through Python.
+        :return: the number of bytes written
+        """
+        path = self.path_for_key(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+        try:
+            with open(fd, 'wb', buffering=0) as dst:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    view = memoryview(data).cast('B')
+                    _write_all(dst, view)
+                    written = len(view)
+                else:
+                    written = self._write_file(dst, data, chunk_size)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return written
+
+    @staticmethod
+    def _write_file(dst, src, chunk_size: int) -> int:
+        written = 0
+
+        try:
+            src_fd = src.fileno()
+        except (AttributeError, OSError):
+            src_fd = None
+
+        if src_fd is not None:
+            src_stat = os.fstat(src_fd)
+            if stat.S_ISREG(src_stat.st_mode):
+                offset = src.tell()
+                written = _copy_file_range(src_fd, dst.fileno(), offset, src_stat.st_size - offset)
+                src.seek(offset + written)
+
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            read = src.readinto(view)
+            if not read:
+                break
+            _write_all(dst, view[:read])
+            written += read
+
+        return written
+
+    def open(self, key: str, mode: str = 'rb', buffering: int = -1):
+        """
+        Open :param key, creating directories as needed if :param mode writes.
+        """
+        path = self.path_for_key(key)
+        if any(c in mode for c in 'wax+'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode, buffering=buffering)
+
+    def read_mmap(self, key: str) -> mmap.mmap:
+        """
+        Return a read-only memory map of :param key. Slicing it, or wrapping it in a memoryview, reads from the page
+        cache without copying the whole file into memory. The caller should close the map when done.
+        Raises ValueError if :param key is empty, as empty files can't be mapped.
+        """
+        with open(self.path_for_key(key), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, key: str):
+        os.remove(self.path_for_key(key))
+
+# endregion
+
 
 # region Amazon AWS
 
@@ -42,8 +199,13 @@ class AWSS3Region(Enum):
 class AWSFederatedUserMixin(object):
     """
         Represents an AWS Federated User obtained by sts.get_federation_token(..)
+
+        Subclasses must declare slots for the attributes set here.
+        Policies are interned, so storages sharing a policy share one copy of it.
     """
 
+    __slots__ = ()
+
     def __init__(self,
                  aws_federated_user_id: str,
                  aws_arn: str,
@@ -51,14 +213,18 @@ class AWSFederatedUserMixin(object):
 
         self.aws_federated_user_id = aws_federated_user_id
         self.aws_arn = aws_arn
-        self.aws_policy = aws_policy
+        self.aws_policy = sys.intern(aws_policy) if aws_policy is not None else None
 
 
 class AWSCredentialMixin(object):
     """
         Represents the credentials needed for an AWS FederationToken
+
+        Subclasses must declare slots for the attributes set here.
     """
 
+    __slots__ = ()
+
     def __init__(self,
                  aws_access_key_id: str,
                  aws_secret_access_key: str,
@@ -70,6 +236,73 @@ class AWSCredentialMixin(object):
         self.aws_session_token = aws_session_token
         self.aws_expiration = aws_expiration
 
+    def seconds_until_expiration(self, now: datetime = None) -> float:
+        """
+        Return the number of seconds these credentials remain valid, negative if they have expired.
+
+        :param now: the current time. datetime.now(timezone.utc) if None.
+        :return:
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+
+        expiration = self.aws_expiration
+        if not isinstance(expiration, datetime):
+            # Expiration given as a POSIX timestamp
+            expiration = datetime.fromtimestamp(expiration, timezone.utc)
+        elif expiration.tzinfo is None:
+            # STS expirations are always UTC
+            expiration = expiration.replace(tzinfo=timezone.utc)
+
+        return (expiration - now).total_seconds()
+
+
+# Version of the S3Storage to_dict and to_bytes formats
+S3_STORAGE_SERIALIZATION_VERSION = 2
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_S3_STORAGE_BYTES_VERSION = struct.Struct('!B')
+
+# Version, flags, expiration
+_S3_STORAGE_BYTES_HEADER = struct.Struct('!BBq')
+
+_S3_STORAGE_BYTES_REGION_ENUM = 0x01
+
+_S3_STORAGE_BYTES_NO_EXPIRATION = 0x02
+
+_S3_STORAGE_BYTES_FIELD_LENGTH = struct.Struct('!I')
+
+# Length written in place of a field that is None
+_S3_STORAGE_BYTES_NONE = 0xFFFFFFFF
+
+
+def _expiration_to_microseconds(expiration) -> Optional[int]:
+    if expiration is None:
+        return None
+    if not isinstance(expiration, datetime):
+        # Expiration given as a POSIX timestamp
+        return int(expiration * 1000000)
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=timezone.utc)
+    return (expiration - _EPOCH) // timedelta(microseconds=1)
+
+
+def _microseconds_to_expiration(microseconds: Optional[int]) -> Optional[datetime]:
+    if microseconds is None:
+        return None
+    return _EPOCH + timedelta(microseconds=microseconds)
+
+
+def _restore_region(region_name: str, is_enum: bool):
+    return AWSS3Region(region_name) if is_enum and region_name is not None else region_name
+
+
+def _transfer_options(part_size: int, max_concurrency: int, max_attempts: int) -> dict:
+    # Options left as None take transfer's defaults
+    options = {'part_size': part_size, 'max_concurrency': max_concurrency, 'max_attempts': max_attempts}
+    return {name: value for name, value in options.items() if value is not None}
+
 
 class S3Storage(Storage, AWSCredentialMixin, AWSFederatedUserMixin):
     """
@@ -88,8 +321,22 @@ class S3Storage(Storage, AWSCredentialMixin, AWSFederatedUserMixin):
             },
             'PackedPolicySize': 123
         }
+
+        S3Storage round-trips through to_dict / from_dict and to_bytes / from_bytes, and pickles through to_bytes.
+        aws_expiration is always restored as a timezone-aware UTC datetime.
     """
 
+    __slots__ = ('s3_bucket_name',
+                 's3_bucket_region',
+                 's3_bucket_path',
+                 'aws_access_key_id',
+                 'aws_secret_access_key',
+                 'aws_session_token',
+                 'aws_expiration',
+                 'aws_federated_user_id',
+                 'aws_arn',
+                 'aws_policy')
+
     def __init__(self,
                  s3_bucket_name: str,
                  s3_bucket_region: AWSS3Region,
@@ -125,4 +372,249 @@ class S3Storage(Storage, AWSCredentialMixin, AWSFederatedUserMixin):
         """
         return "https://{}.s3.amazonaws.com/{}".format(self.s3_bucket_name, key)
 
+    def presigner(self, expires_sec: int = DEFAULT_PRESIGN_EXPIRES_SEC, now: datetime = None) -> S3Presigner:
+        """
+        Return an S3Presigner signing URLs in this storage's bucket with its credentials.
+        Reuse it to sign many URLs valid for the same period.
+        """
+        region = self.s3_bucket_region
+        return S3Presigner(self.s3_bucket_name,
+                           region.value if isinstance(region, AWSS3Region) else region,
+                           self.aws_access_key_id,
+                           self.aws_secret_access_key,
+                           self.aws_session_token,
+                           expires_sec=expires_sec,
+                           now=now)
+
+    def generate_presigned_url(self,
+                               key: str,
+                               method: str = 'GET',
+                               expires_sec: int = DEFAULT_PRESIGN_EXPIRES_SEC) -> str:
+        """
+        Return a URL allowing anyone holding it to :param method, e.g: 'GET' or 'PUT', the object at :param key for
+        :param expires_sec seconds, or until these credentials expire. The URL is signed locally, with no AWS call.
+        :param key: A key describing a file location, leading slash omitted. e.g: "some_folder/myfile.txt"
+        """
+        return self.presigner(expires_sec).presign(key, method)
+
+    def generate_presigned_urls(self,
+                                keys,
+                                method: str = 'GET',
+                                expires_sec: int = DEFAULT_PRESIGN_EXPIRES_SEC):
+        """
+        Yield a presigned URL for each of :param keys, in order, as generate_presigned_url would. All URLs share one
+        signing time, so signing a large batch is much cheaper than calling generate_presigned_url for each key.
+        """
+        return self.presigner(expires_sec).presign_many(keys, method)
+
+    def upload(self,
+               source,
+               key: str,
+               part_size: int = None,
+               max_concurrency: int = None,
+               max_attempts: int = None,
+               state_path: str = None,
+               extra_args: dict = None,
+               client=None):
+        """
+        Upload :param source to :param key with these credentials, returning a transfer.UploadResult.
+
+        Sources larger than :param part_size are sent as a multipart upload, :param max_concurrency parts at a time.
+        Files are memory mapped and parts are sent from memoryviews over the map, or over bytes-like sources, without
+        copying. Each part's SHA-256 is computed on the thread sending it and verified by S3. Failed parts are retried
+        up to :param max_attempts times each.
+        Unset options default to transfer.DEFAULT_PART_SIZE, DEFAULT_TRANSFER_CONCURRENCY and
+        DEFAULT_TRANSFER_MAX_ATTEMPTS.
+
+        :param source: a path, a bytes-like object, or a binary file object read from its current position. Streams
+        that aren't regular files are read one part at a time, holding at most max_concurrency + 1 parts in memory.
+        :param key: the full object key, leading slash omitted, used as given rather than relative to s3_bucket_path.
+        e.g: storage.s3_bucket_path + "myfile.txt"
+        :param state_path: a file where the progress of a multipart upload is saved. If the upload is interrupted,
+        calling upload again with the same source, key, part size and state_path resumes it, skipping the parts
+        already uploaded. If None, a failed multipart upload is aborted. Not supported for streams.
+        :param extra_args: extra arguments for PutObject and CreateMultipartUpload, e.g: {'ContentType': 'video/mp4'}
+        :param client: the S3 client to use. One shared by transfers with the same credentials if None.
+        """
+        from storage_provisioner import transfer
+
+        return transfer.upload(self,
+                               source,
+                               key,
+                               state_path=state_path,
+                               extra_args=extra_args,
+                               client=client,
+                               **_transfer_options(part_size, max_concurrency, max_attempts))
+
+    def download(self,
+                 key: str,
+                 destination: str,
+                 part_size: int = None,
+                 max_concurrency: int = None,
+                 max_attempts: int = None,
+                 verify: bool = True,
+                 client=None):
+        """
+        Download :param key to the file at :param destination with these credentials, returning a
+        transfer.DownloadResult.
+
+        The object is fetched in byte ranges of :param part_size, :param max_concurrency at a time, each written
+        straight into a preallocated, memory-mapped temporary file at its offset. The file replaces
+        :param destination once complete. Every range is fetched with If-Match on the object's ETag, so an object
+        overwritten mid-download fails the download rather than mixing versions. Failed ranges are retried up to
+        :param max_attempts times each.
+        Unset options default to transfer.DEFAULT_PART_SIZE, DEFAULT_TRANSFER_CONCURRENCY and
+        DEFAULT_TRANSFER_MAX_ATTEMPTS.
+
+        :param key: the full object key, leading slash omitted, used as given rather than relative to s3_bucket_path.
+        e.g: storage.s3_bucket_path + "myfile.txt"
+        :param verify: check the data against the object's SHA-256 checksum, or against its ETag if it has none,
+        raising transfer.ChecksumMismatchError if they differ. Objects uploaded in parts are fetched in ranges
+        matching those parts, regardless of :param part_size, so that each range is checked as it arrives.
+        :param client: the S3 client to use. One shared by transfers with the same credentials if None.
+        """
+        from storage_provisioner import transfer
+
+        return transfer.download(self,
+                                 key,
+                                 destination,
+                                 verify=verify,
+                                 client=client,
+                                 **_transfer_options(part_size, max_concurrency, max_attempts))
+
+    def iter_download(self,
+                      key: str,
+                      part_size: int = None,
+                      max_concurrency: int = None,
+                      max_attempts: int = None,
+                      verify: bool = True,
+                      client=None):
+        """
+        Yield the contents of :param key in order, as bytearrays of about :param part_size bytes, so consumers can
+        start processing before the download finishes.
+
+        Ranges are fetched as download fetches them, at most :param max_concurrency ahead of the consumer, so at
+        most max_concurrency + 1 ranges are held in memory. With :param verify, transfer.ChecksumMismatchError is
+        raised after the last chunk if the data doesn't match the object's checksum. Options default as for download.
+        """
+        from storage_provisioner import transfer
+
+        return transfer.iter_download(self,
+                                      key,
+                                      verify=verify,
+                                      client=client,
+                                      **_transfer_options(part_size, max_concurrency, max_attempts))
+
+    def _fields(self) -> tuple:
+        region = self.s3_bucket_region
+        return (self.s3_bucket_name,
+                region.value if isinstance(region, AWSS3Region) else region,
+                self.s3_bucket_path,
+                self.aws_access_key_id,
+                self.aws_secret_access_key,
+                self.aws_session_token,
+                self.aws_federated_user_id,
+                self.aws_arn,
+                self.aws_policy)
+
+    def to_dict(self) -> dict:
+        """
+        Return a JSON-serializable dict representing this storage, readable by from_dict.
+        """
+        fields = self._fields()
+        return {
+            'v': S3_STORAGE_SERIALIZATION_VERSION,
+            'bucket': fields[0],
+            'region': fields[1],
+            'region_enum': isinstance(self.s3_bucket_region, AWSS3Region),
+            'path': fields[2],
+            'key_id': fields[3],
+            'secret': fields[4],
+            'token': fields[5],
+            'expires_us': _expiration_to_microseconds(self.aws_expiration),
+            'user_id': fields[6],
+            'arn': fields[7],
+            'policy': fields[8],
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'S3Storage':
+        """
+        Return the storage represented by :param d, a dict returned by to_dict.
+        """
+        version = d.get('v')
+        if version != S3_STORAGE_SERIALIZATION_VERSION:
+            raise ValueError('Unsupported S3Storage serialization version: {}'.format(version))
+
+        return cls(d['bucket'],
+                   _restore_region(d['region'], d.get('region_enum', False)),
+                   d['path'],
+                   d['key_id'],
+                   d['secret'],
+                   d['token'],
+                   _microseconds_to_expiration(d['expires_us']),
+                   d['user_id'],
+                   d['arn'],
+                   d['policy'])
+
+    def to_bytes(self) -> bytes:
+        """
+        Return a compact binary representation of this storage, readable by from_bytes.
+        """
+        flags = 0
+        if isinstance(self.s3_bucket_region, AWSS3Region):
+            flags |= _S3_STORAGE_BYTES_REGION_ENUM
+        expiration_us = _expiration_to_microseconds(self.aws_expiration)
+        if expiration_us is None:
+            flags |= _S3_STORAGE_BYTES_NO_EXPIRATION
+            expiration_us = 0
+
+        parts = [_S3_STORAGE_BYTES_HEADER.pack(S3_STORAGE_SERIALIZATION_VERSION, flags, expiration_us)]
+        for field in self._fields():
+            if field is None:
+                parts.append(_S3_STORAGE_BYTES_FIELD_LENGTH.pack(_S3_STORAGE_BYTES_NONE))
+            else:
+                encoded = field.encode('utf-8')
+                parts.append(_S3_STORAGE_BYTES_FIELD_LENGTH.pack(len(encoded)))
+                parts.append(encoded)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'S3Storage':
+        """
+        Return the storage represented by :param data, bytes returned by to_bytes.
+        """
+        version, = _S3_STORAGE_BYTES_VERSION.unpack_from(data)
+        if version != S3_STORAGE_SERIALIZATION_VERSION:
+            raise ValueError('Unsupported S3Storage serialization version: {}'.format(version))
+        _, flags, expiration_us = _S3_STORAGE_BYTES_HEADER.unpack_from(data)
+        if flags & _S3_STORAGE_BYTES_NO_EXPIRATION:
+            expiration_us = None
+
+        view = memoryview(data)
+        offset = _S3_STORAGE_BYTES_HEADER.size
+        fields = []
+        for _ in range(9):
+            length, = _S3_STORAGE_BYTES_FIELD_LENGTH.unpack_from(view, offset)
+            offset += _S3_STORAGE_BYTES_FIELD_LENGTH.size
+            if length == _S3_STORAGE_BYTES_NONE:
+                fields.append(None)
+            else:
+                fields.append(str(view[offset:offset + length], 'utf-8'))
+                offset += length
+
+        return cls(fields[0],
+                   _restore_region(fields[1], flags & _S3_STORAGE_BYTES_REGION_ENUM),
+                   fields[2],
+                   fields[3],
+                   fields[4],
+                   fields[5],
+                   _microseconds_to_expiration(expiration_us),
+                   fields[6],
+                   fields[7],
+                   fields[8])
+
+    def __reduce__(self):
+        return self.__class__.from_bytes, (self.to_bytes(),)
+
 # endregion
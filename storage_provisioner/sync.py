@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from storage_provisioner import transfer
+from storage_provisioner.storage import S3Storage
+
+logger = logging.getLogger(__name__)
+
+
+# region Directory Sync
+
+DEFAULT_SYNC_MANIFEST_NAME = '.storage_provisioner_sync.json'
+
+DEFAULT_SYNC_INTERVAL_SEC = 1.0
+
+DEFAULT_SYNC_SETTLE_SEC = 2.0
+
+# Version of the manifest files written by DirectorySync
+SYNC_MANIFEST_VERSION = 1
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class SyncResult(object):
+
+    def __init__(self):
+        # Relative paths uploaded, and the number of bytes uploaded
+        self.uploaded = []
+        self.uploaded_bytes = 0
+        # Files unchanged since the last pass, by size and mtime, or by content hash if only touched
+        self.unchanged = 0
+        # Files still being written, left for a later pass
+        self.unsettled = 0
+        # Relative path -> exception, for uploads that failed and will be retried on the next pass
+        self.failed = {}
+
+
+class SyncManifest(object):
+    """
+        The size, mtime and SHA-256 of every file uploaded from a directory, saved as JSON so later passes, and later
+        processes, upload only what changed.
+
+        A manifest belongs to one bucket and key prefix. Loading one written for another location starts afresh.
+    """
+
+    def __init__(self, path: str, bucket_name: str, prefix: str):
+        self.path = path
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        # relative path -> [size, mtime_ns, base64 SHA-256]
+        self.entries = {}
+
+    def load(self) -> bool:
+        """
+        Load the entries saved for the same bucket and prefix. Return False if there are none.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (manifest.get('v') != SYNC_MANIFEST_VERSION or manifest.get('bucket') != self.bucket_name or
+                manifest.get('prefix') != self.prefix):
+            return False
+        self.entries = manifest['files']
+        return True
+
+    def save(self):
+        manifest = {
+            'v': SYNC_MANIFEST_VERSION,
+            'bucket': self.bucket_name,
+            'prefix': self.prefix,
+            'files': self.entries,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    buffer = bytearray(_HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            read = f.readinto(view)
+            if not read:
+                break
+            digest.update(view[:read])
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+class DirectorySync(object):
+    """
+        Mirrors the files under :param local_dir to the path an S3Storage grants, uploading only what changed.
+
+        Each pass is a stat-first scan: files whose size and mtime match the manifest are skipped without being read,
+        and files whose content hash matches despite a new mtime are only re-recorded. The rest are uploaded by
+        :param max_concurrency workers, with no more than twice that many files queued at once, so a pass over a large
+        directory holds little in memory. Files deleted locally are dropped from the manifest but left in S3.
+
+        Assign a renewed storage to storage, e.g: from a RenewalScheduler callback, to keep a long-running watch going
+        past the expiration of the credentials it started with.
+    """
+
+    def __init__(self,
+                 storage: S3Storage,
+                 local_dir: str,
+                 prefix: str = '',
+                 manifest_path: str = None,
+                 max_concurrency: int = 4,
+                 part_size: int = transfer.DEFAULT_PART_SIZE,
+                 part_concurrency: int = 4,
+                 settle_sec: float = DEFAULT_SYNC_SETTLE_SEC,
+                 include_hidden: bool = False,
+                 client=None):
+        """
+        :param storage: the storage files are uploaded with, under its s3_bucket_path.
+        :param local_dir: the directory mirrored.
+        :param prefix: prepended, after s3_bucket_path, to each file's path relative to :param local_dir.
+        :param manifest_path: where the manifest is kept. A hidden file in :param local_dir if None.
+        :param max_concurrency: the number of files uploaded at once.
+        :param part_concurrency: the number of parts of each multipart upload sent at once.
+        :param settle_sec: in watch mode, files modified less than this long ago are taken to be still open for
+        writing, and are left for a later pass.
+        :param include_hidden: whether to sync files and directories whose names start with '.', such as the
+        temporary files LocalFileStorage.write renames into place.
+        :param client: the S3 client to use. One shared by transfers with the same credentials if None.
+        """
+        self.storage = storage
+        self.local_dir = os.path.abspath(local_dir)
+        self.prefix = prefix
+        self.manifest_path = manifest_path or os.path.join(self.local_dir, DEFAULT_SYNC_MANIFEST_NAME)
+        self.max_concurrency = max_concurrency
+        self.part_size = part_size
+        self.part_concurrency = part_concurrency
+        self.settle_sec = settle_sec
+        self.include_hidden = include_hidden
+        self.client = client
+
+        self._manifest = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def key_for(self, relative_path: str) -> str:
+        return self.storage.s3_bucket_path + self.prefix + relative_path
+
+    def sync(self, settle_sec: float = 0.0) -> SyncResult:
+        """
+        Run one pass, uploading every file changed since the last one, and return what it did.
+
+        :param settle_sec: skip files modified less than this long ago.
+        """
+        with self._lock:
+            manifest = self._load_manifest()
+            result = SyncResult()
+            seen = set()
+            try:
+                self._upload_changed(manifest, result, seen, time.time() - settle_sec if settle_sec else None)
+            finally:
+                for relative_path in set(manifest.entries) - seen:
+                    del manifest.entries[relative_path]
+                manifest.save()
+            return result
+
+    def start(self, interval_sec: float = DEFAULT_SYNC_INTERVAL_SEC):
+        """
+        Start a thread syncing every :param interval_sec, picking up new files once they have been left alone for
+        settle_sec, i.e: closed by the writer.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval_sec,), name='DirectorySync')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, flush: bool = True):
+        """
+        Stop the watch thread. If :param flush, run a last pass uploading every changed file, settled or not.
+        """
+        thread, self._thread = self._thread, None
+        self._stopped.set()
+        if thread is not None:
+            thread.join()
+        if flush:
+            self.sync()
+
+    def _load_manifest(self) -> SyncManifest:
+        # Must hold self._lock
+        bucket_name = self.storage.s3_bucket_name
+        prefix = self.key_for('')
+        manifest = self._manifest
+        if manifest is None or manifest.bucket_name != bucket_name or manifest.prefix != prefix:
+            manifest = self._manifest = SyncManifest(self.manifest_path, bucket_name, prefix)
+            manifest.load()
+        return manifest
+
+    def _scan(self, directory: str = None):
+        """
+        Yield (relative path, stat result) for each regular file under :param directory, without reading any.
+        """
+        directory = directory or self.local_dir
+        manifest_paths = (self.manifest_path, self.manifest_path + '.tmp')
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not self.include_hidden and entry.name.startswith('.'):
+                continue
+            if entry.path in manifest_paths:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(entry.path)
+                    continue
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield os.path.relpath(entry.path, self.local_dir).replace(os.sep, '/'), st
+
+    def _upload_changed(self, manifest: SyncManifest, result: SyncResult, seen: set, settled_before: float):
+        entries = manifest.entries
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = set()
+            for relative_path, st in self._scan():
+                seen.add(relative_path)
+                entry = entries.get(relative_path)
+                if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                    result.unchanged += 1
+                    continue
+                if settled_before is not None and st.st_mtime > settled_before:
+                    result.unsettled += 1
+                    continue
+                if len(pending) >= 2 * self.max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._record(manifest, result, done)
+                pending.add(executor.submit(self._upload, relative_path, st, entry))
+            self._record(manifest, result, wait(pending).done)
+
+    def _upload(self, relative_path: str, st: os.stat_result, entry: list) -> tuple:
+        """
+        Return (relative path, new manifest entry or None if the file changed meanwhile, uploaded, error).
+        """
+        path = os.path.join(self.local_dir, relative_path)
+        try:
+            checksum = _sha256_file(path)
+            uploaded = entry is None or entry[2] != checksum
+            if uploaded:
+                transfer.upload(self.storage, path, self.key_for(relative_path), part_size=self.part_size,
+                                max_concurrency=self.part_concurrency, client=self.client)
+            after = os.stat(path)
+        except Exception as e:
+            return relative_path, None, False, e
+        if after.st_size != st.st_size or after.st_mtime_ns != st.st_mtime_ns:
+            # Written to while being uploaded; the next pass uploads it again
+            return relative_path, None, uploaded, None
+        return relative_path, [st.st_size, st.st_mtime_ns, checksum], uploaded, None
+
+    @staticmethod
+    def _record(manifest: SyncManifest, result: SyncResult, futures):
+        for future in futures:
+            relative_path, entry, uploaded, error = future.result()
+            if error is not None:
+                logger.warning('Failed to sync %s: %s', relative_path, error)
+                result.failed[relative_path] = error
+                continue
+            if uploaded:
+                result.uploaded.append(relative_path)
+                result.uploaded_bytes += entry[0] if entry is not None else 0
+            else:
+                result.unchanged += 1
+            if entry is not None:
+                manifest.entries[relative_path] = entry
+
+    def _run(self, interval_sec: float):
+        while not self._stopped.wait(interval_sec):
+            try:
+                self.sync(self.settle_sec)
+            except Exception:
+                logger.exception('Sync of %s failed', self.local_dir)
+
+# endregion
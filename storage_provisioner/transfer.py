@@ -0,0 +1,727 @@
+# -*- coding: utf-8 -*-
+import base64
+import functools
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from storage_provisioner.ratelimit import connection_errors, is_throttling_error
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+logger = logging.getLogger(__name__)
+
+
+# region Clients
+
+DEFAULT_TRANSFER_CONCURRENCY = 8
+
+DEFAULT_TRANSFER_MAX_ATTEMPTS = 4
+
+DEFAULT_TRANSFER_CLIENT_CACHE_SIZE = 64
+
+
+@functools.lru_cache(maxsize=DEFAULT_TRANSFER_CLIENT_CACHE_SIZE)
+def _create_client(aws_access_key_id: str,
+                   aws_secret_access_key: str,
+                   aws_session_token: str,
+                   region_name: str,
+                   max_pool_connections: int):
+    from boto3.session import Session
+    from botocore.config import Config
+
+    session = Session(aws_access_key_id=aws_access_key_id,
+                      aws_secret_access_key=aws_secret_access_key,
+                      aws_session_token=aws_session_token,
+                      region_name=region_name)
+    return session.client('s3', config=Config(max_pool_connections=max_pool_connections, tcp_keepalive=True))
+
+
+def client_for_storage(storage: S3Storage, max_pool_connections: int = DEFAULT_TRANSFER_CONCURRENCY):
+    """
+    Return an S3 client using :param storage's credentials, shared by all transfers with the same credentials.
+    """
+    region = storage.s3_bucket_region
+    return _create_client(storage.aws_access_key_id,
+                          storage.aws_secret_access_key,
+                          storage.aws_session_token,
+                          region.value if isinstance(region, AWSS3Region) else region,
+                          max_pool_connections)
+
+
+class IncompleteReadError(IOError):
+    """
+        Raised when a response body ends before the number of bytes requested.
+    """
+    pass
+
+
+def _is_retryable(error: Exception) -> bool:
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        # Only connection errors and timeouts; others, such as invalid parameters, fail the same way every time
+        return isinstance(error, (IncompleteReadError,) + connection_errors())
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return status >= 500 or is_throttling_error(error) or _error_code(error) == 'RequestTimeout'
+
+
+def _error_code(error: Exception) -> str:
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    return response.get('Error', {}).get('Code')
+
+
+def _call_with_retries(max_attempts: int, fn, *args, **kwargs):
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_attempts or not _is_retryable(e):
+                raise
+            delay_sec = random.uniform(0.0, min(5.0, 0.1 * (2 ** (attempt - 1))))
+            logger.debug('Retrying %s in %.2fs after attempt %d failed: %s', fn.__name__, delay_sec, attempt, e)
+            time.sleep(delay_sec)
+
+
+# endregion
+
+# region Multipart Upload
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+S3_MAX_PARTS = 10000
+
+# Version of the resume state files written by upload
+UPLOAD_STATE_VERSION = 1
+
+
+class ChecksumMismatchError(ValueError):
+    """
+        Raised when data read back from, or acknowledged by, S3 doesn't match the checksum computed locally.
+    """
+    pass
+
+
+class UploadResult(object):
+
+    def __init__(self, key: str, size: int, etag: str, checksum_sha256: str, parts: int):
+        """
+        :param key: the full object key.
+        :param size: the number of bytes uploaded.
+        :param etag: the object's ETag.
+        :param checksum_sha256: the base64 SHA-256 of the object or, for multipart uploads, S3's composite checksum:
+        the SHA-256 of the parts' SHA-256s, suffixed with '-' and the number of parts.
+        :param parts: the number of parts, 0 if the object was uploaded with a single PutObject.
+        """
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.checksum_sha256 = checksum_sha256
+        self.parts = parts
+
+
+class _MemoryViewReader(io.RawIOBase):
+    """
+        A seekable file object over a memoryview, so botocore can stream, and rewind for retries, a part of a file
+        or buffer without copying it.
+    """
+
+    def __init__(self, view: memoryview):
+        io.RawIOBase.__init__(self)
+        self._view = view
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        count = min(len(b), len(self._view) - self._position)
+        if count <= 0:
+            return 0
+        b[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, min(offset, len(self._view)))
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def _sha256_base64(data) -> str:
+    return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+
+def _composite_checksum(part_checksums: list) -> str:
+    digests = b''.join(base64.b64decode(checksum) for checksum in part_checksums)
+    return '{}-{}'.format(_sha256_base64(digests), len(part_checksums))
+
+
+def _part_size_for(size: int, part_size: int) -> int:
+    # Grow parts so that the object fits in S3's part limit
+    return max(part_size, S3_MIN_PART_SIZE, -(-size // S3_MAX_PARTS))
+
+
+def _read_full(f, view: memoryview) -> int:
+    filled = 0
+    while filled < len(view):
+        read = f.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+def _open_view(source):
+    """
+    Return (memoryview of :param source's remaining data, object to close afterwards), or (None, None) for
+    streams that can't be mapped.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source).cast('B'), None
+
+    if isinstance(source, (str, os.PathLike)):
+        f = open(source, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return memoryview(b''), f
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+        return memoryview(mapped), mapped
+
+    try:
+        fd = source.fileno()
+        offset = source.tell()
+        size = os.fstat(fd).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None, None
+    if size <= offset:
+        return memoryview(b''), None
+    mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset:], mapped
+
+
+class _UploadState(object):
+    """
+        Parts already uploaded for a multipart upload, saved to a file after each part so an interrupted upload can
+        resume.
+    """
+
+    def __init__(self, path: str, bucket_name: str, key: str, size: int, part_size: int):
+        self.path = path
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.upload_id = None
+        # part number -> (ETag, base64 SHA-256)
+        self.parts = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """
+        Load the upload ID and parts saved for the same object, size and part size. Return False if there are none.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (state.get('v') != UPLOAD_STATE_VERSION or state.get('bucket') != self.bucket_name or
+                state.get('key') != self.key or state.get('size') != self.size or
+                state.get('part_size') != self.part_size):
+            return False
+        self.upload_id = state['upload_id']
+        self.parts = {int(number): tuple(part) for number, part in state['parts'].items()}
+        return True
+
+    def add_part(self, number: int, etag: str, checksum: str):
+        with self._lock:
+            self.parts[number] = (etag, checksum)
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        state = {
+            'v': UPLOAD_STATE_VERSION,
+            'bucket': self.bucket_name,
+            'key': self.key,
+            'size': self.size,
+            'part_size': self.part_size,
+            'upload_id': self.upload_id,
+            'parts': {str(number): list(part) for number, part in self.parts.items()},
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _put_object(client, bucket_name: str, key: str, view: memoryview, max_attempts: int,
+                extra_args: dict) -> UploadResult:
+    checksum = _sha256_base64(view)
+    resp = _call_with_retries(max_attempts, _put_object_once, client, bucket_name, key, view, checksum, extra_args)
+    return UploadResult(key, len(view), resp.get('ETag'), checksum, 0)
+
+
+def _put_object_once(client, bucket_name: str, key: str, view: memoryview, checksum: str, extra_args: dict) -> dict:
+    return client.put_object(Bucket=bucket_name, Key=key, Body=_MemoryViewReader(view), ContentLength=len(view),
+                             ChecksumSHA256=checksum, **extra_args)
+
+
+def _upload_part_once(client, bucket_name: str, key: str, upload_id: str, number: int, view: memoryview,
+                      checksum: str) -> dict:
+    return client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=number,
+                              Body=_MemoryViewReader(view), ContentLength=len(view), ChecksumSHA256=checksum)
+
+
+def _upload_part(client, bucket_name: str, key: str, upload_id: str, number: int, view: memoryview,
+                 max_attempts: int) -> tuple:
+    # Hashing runs on the worker thread, and releases the GIL, so parts are hashed in parallel
+    checksum = _sha256_base64(view)
+    try:
+        resp = _call_with_retries(max_attempts, _upload_part_once, client, bucket_name, key, upload_id, number,
+                                  view, checksum)
+    finally:
+        # A traceback holding the part's view would otherwise keep the file's memory map from closing
+        view.release()
+    returned = resp.get('ChecksumSHA256')
+    if returned is not None and returned != checksum:
+        raise ChecksumMismatchError('Part {} of {} was stored with checksum {}, expected {}'.format(
+            number, key, returned, checksum))
+    return number, resp['ETag'], checksum
+
+
+def _list_uploaded_parts(client, bucket_name: str, key: str, upload_id: str) -> dict:
+    parts = {}
+    kwargs = {'Bucket': bucket_name, 'Key': key, 'UploadId': upload_id}
+    while True:
+        resp = client.list_parts(**kwargs)
+        for part in resp.get('Parts', ()):
+            parts[part['PartNumber']] = (part['ETag'], part.get('ChecksumSHA256'))
+        if not resp.get('IsTruncated'):
+            return parts
+        kwargs['PartNumberMarker'] = resp['NextPartNumberMarker']
+
+
+def upload(storage: S3Storage,
+           source,
+           key: str,
+           part_size: int = DEFAULT_PART_SIZE,
+           max_concurrency: int = DEFAULT_TRANSFER_CONCURRENCY,
+           max_attempts: int = DEFAULT_TRANSFER_MAX_ATTEMPTS,
+           state_path: str = None,
+           extra_args: dict = None,
+           client=None) -> UploadResult:
+    """
+    Upload :param source to :param key, used as given, with :param storage's credentials. See S3Storage.upload.
+    """
+    if client is None:
+        client = client_for_storage(storage, max_concurrency)
+    bucket_name = storage.s3_bucket_name
+    extra_args = dict(extra_args or {})
+
+    view, closeable = _open_view(source)
+    try:
+        if view is None:
+            return _upload_stream(client, bucket_name, key, source, max(part_size, S3_MIN_PART_SIZE),
+                                  max_concurrency, max_attempts, extra_args)
+
+        size = len(view)
+        if size <= part_size:
+            return _put_object(client, bucket_name, key, view, max_attempts, extra_args)
+
+        part_size = _part_size_for(size, part_size)
+        state = _UploadState(state_path, bucket_name, key, size, part_size)
+        if state.load():
+            try:
+                uploaded = _list_uploaded_parts(client, bucket_name, key, state.upload_id)
+            except Exception as e:
+                if _error_code(e) != 'NoSuchUpload':
+                    raise
+                state.upload_id, state.parts = None, {}
+            else:
+                # Only keep parts that S3 still has, with the checksums recorded when they were uploaded
+                state.parts = {number: part for number, part in state.parts.items()
+                               if number in uploaded and uploaded[number][0] == part[0]}
+
+        if state.upload_id is None:
+            state.upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key,
+                                                             ChecksumAlgorithm='SHA256', **extra_args)['UploadId']
+            state.parts = {}
+            state.save()
+
+        try:
+            _upload_parts(client, bucket_name, key, state, view, part_size, max_concurrency, max_attempts)
+            result = _complete(client, bucket_name, key, state.upload_id, state.parts, size)
+        except BaseException:
+            if state_path is None:
+                _abort(client, bucket_name, key, state.upload_id)
+            raise
+        state.delete()
+        return result
+    finally:
+        if closeable is not None:
+            view.release()
+            closeable.close()
+
+
+def _upload_parts(client, bucket_name: str, key: str, state: _UploadState, view: memoryview, part_size: int,
+                  max_concurrency: int, max_attempts: int):
+    size = len(view)
+    numbers = [number for number in range(1, -(-size // part_size) + 1)]
+
+    # Parts uploaded before an interruption are checked against the data before being skipped
+    for number in list(state.parts):
+        offset = (number - 1) * part_size
+        if _sha256_base64(view[offset:offset + part_size]) != state.parts[number][1]:
+            del state.parts[number]
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(_upload_part, client, bucket_name, key, state.upload_id, number,
+                                   view[(number - 1) * part_size:number * part_size], max_attempts)
+                   for number in numbers if number not in state.parts]
+        try:
+            for future in futures:
+                number, etag, checksum = future.result()
+                state.add_part(number, etag, checksum)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _upload_stream(client, bucket_name: str, key: str, stream, part_size: int, max_concurrency: int,
+                   max_attempts: int, extra_args: dict) -> UploadResult:
+    """
+    Upload a stream of unknown size, holding at most :param max_concurrency parts in memory at once besides the one
+    being read.
+    """
+    buffer = bytearray(part_size)
+    filled = _read_full(stream, memoryview(buffer))
+    if filled < part_size:
+        return _put_object(client, bucket_name, key, memoryview(buffer)[:filled], max_attempts, extra_args)
+
+    upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key, ChecksumAlgorithm='SHA256',
+                                               **extra_args)['UploadId']
+    parts = {}
+    size = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = set()
+            number = 0
+            while filled:
+                number += 1
+                size += filled
+                if len(pending) >= max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_number, etag, checksum = future.result()
+                        parts[done_number] = (etag, checksum)
+                pending.add(executor.submit(_upload_part, client, bucket_name, key, upload_id, number,
+                                            memoryview(buffer)[:filled], max_attempts))
+                buffer = bytearray(part_size)
+                filled = _read_full(stream, memoryview(buffer))
+                if filled and number >= S3_MAX_PARTS:
+                    raise ValueError('Stream exceeds {} parts of {} bytes'.format(S3_MAX_PARTS, part_size))
+            for future in pending:
+                done_number, etag, checksum = future.result()
+                parts[done_number] = (etag, checksum)
+        return _complete(client, bucket_name, key, upload_id, parts, size)
+    except BaseException:
+        _abort(client, bucket_name, key, upload_id)
+        raise
+
+
+def _complete(client, bucket_name: str, key: str, upload_id: str, parts: dict, size: int) -> UploadResult:
+    numbers = sorted(parts)
+    resp = client.complete_multipart_upload(
+        Bucket=bucket_name,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': parts[number][0], 'ChecksumSHA256': parts[number][1]}
+                                   for number in numbers]})
+    checksum = _composite_checksum([parts[number][1] for number in numbers])
+    returned = resp.get('ChecksumSHA256')
+    if returned is not None and returned != checksum:
+        raise ChecksumMismatchError('{} was stored with checksum {}, expected {}'.format(key, returned, checksum))
+    return UploadResult(key, size, resp.get('ETag'), checksum, len(numbers))
+
+
+def _abort(client, bucket_name: str, key: str, upload_id: str):
+    try:
+        client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+    except Exception:
+        logger.exception('Failed to abort multipart upload of %s', key)
+
+
+# endregion
+
+# region Ranged Download
+
+DEFAULT_READ_CHUNK_SIZE = 256 * 1024
+
+_MD5_ETAG = re.compile(r'^[0-9a-f]{32}(-[0-9]+)?$')
+
+
+class DownloadResult(object):
+
+    def __init__(self, key: str, size: int, etag: str, checksum: str, verified: bool):
+        """
+        :param key: the full object key.
+        :param size: the number of bytes downloaded.
+        :param etag: the object's ETag. Every range was fetched with If-Match on it.
+        :param checksum: the object's SHA-256 checksum, or its ETag for objects stored without one.
+        :param verified: whether the downloaded data was checked against :param checksum. Objects encrypted with
+        SSE-KMS or SSE-C, stored without a SHA-256 checksum, have no checksum that can be computed locally.
+        """
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.checksum = checksum
+        self.verified = verified
+
+
+class _ObjectPlan(object):
+    """
+        The byte ranges to fetch an object in, and how to check the data against its checksum.
+
+        Objects uploaded in parts carry a composite checksum over their parts, so they are fetched in ranges
+        matching those parts and each range is hashed as it arrives. Other objects are hashed as a whole.
+    """
+
+    def __init__(self, size: int, etag: str, range_size: int, algorithm: str, expected: str, parts: int):
+        self.size = size
+        self.etag = etag
+        self.range_size = range_size
+        # 'sha256', 'md5' or None if the data can't be verified
+        self.algorithm = algorithm
+        self.expected = expected
+        self.parts = parts
+
+    @property
+    def ranges(self) -> list:
+        return [(start, min(start + self.range_size, self.size)) for start in range(0, self.size, self.range_size)]
+
+    def digest(self, data) -> bytes:
+        return hashlib.new(self.algorithm, data).digest()
+
+    def encode(self, digest: bytes) -> str:
+        if self.algorithm == 'sha256':
+            return base64.b64encode(digest).decode('ascii')
+        return digest.hex()
+
+    def check(self, key: str, digests: list):
+        """
+        Raise ChecksumMismatchError unless :param digests, of the whole object or of each range in order, match.
+        """
+        if self.algorithm is None:
+            return
+        if self.parts:
+            actual = '{}-{}'.format(self.encode(self.digest(b''.join(digests))), len(digests))
+        else:
+            actual = self.encode(digests[0])
+        if actual != self.expected:
+            raise ChecksumMismatchError('{} was downloaded with checksum {}, expected {}'.format(
+                key, actual, self.expected))
+
+
+def _plan_download(client, bucket_name: str, key: str, part_size: int, verify: bool) -> _ObjectPlan:
+    head = client.head_object(Bucket=bucket_name, Key=key, ChecksumMode='ENABLED')
+    size = head['ContentLength']
+    etag = head['ETag']
+
+    algorithm, expected = None, None
+    if verify:
+        encrypted = (head.get('ServerSideEncryption', '').startswith('aws:kms') or
+                     head.get('SSECustomerAlgorithm') is not None)
+        if head.get('ChecksumSHA256'):
+            algorithm, expected = 'sha256', head['ChecksumSHA256']
+        elif not encrypted and _MD5_ETAG.match(etag.strip('"')):
+            # The ETag of an unencrypted object is the MD5 of its data, or of its parts' MD5s
+            algorithm, expected = 'md5', etag.strip('"')
+
+    parts = int(expected.rsplit('-', 1)[1]) if expected is not None and '-' in expected else 0
+    range_size = max(part_size, 1)
+    if parts:
+        range_size = client.head_object(Bucket=bucket_name, Key=key, PartNumber=1, IfMatch=etag)['ContentLength']
+        if -(-size // range_size) != parts:
+            # Parts of uneven sizes, whose boundaries can't be known without a HEAD for each
+            logger.debug('Not verifying %s, uploaded in %d parts of uneven sizes', key, parts)
+            algorithm, expected, parts, range_size = None, None, 0, max(part_size, 1)
+
+    return _ObjectPlan(size, etag, range_size, algorithm, expected, parts)
+
+
+def _get_range_once(client, bucket_name: str, key: str, etag: str, start: int, view: memoryview):
+    resp = client.get_object(Bucket=bucket_name, Key=key, IfMatch=etag,
+                             Range='bytes={}-{}'.format(start, start + len(view) - 1))
+    body = resp['Body']
+    try:
+        filled = 0
+        while filled < len(view):
+            chunk = body.read(min(DEFAULT_READ_CHUNK_SIZE, len(view) - filled))
+            if not chunk:
+                raise IncompleteReadError('Range at {} of {} ended after {} of {} bytes'.format(
+                    start, key, filled, len(view)))
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+    finally:
+        body.close()
+
+
+def _get_range(client, bucket_name: str, key: str, plan: _ObjectPlan, start: int, view: memoryview,
+               max_attempts: int) -> bytes:
+    """
+    Fill :param view with the object's bytes from :param start, returning their digest if the object's parts are
+    verified, or None.
+    """
+    try:
+        _call_with_retries(max_attempts, _get_range_once, client, bucket_name, key, plan.etag, start, view)
+        # Hashing runs on the worker thread, and releases the GIL, so ranges are hashed in parallel
+        return plan.digest(view) if plan.parts else None
+    finally:
+        view.release()
+
+
+def download(storage: S3Storage,
+             key: str,
+             destination: str,
+             part_size: int = DEFAULT_PART_SIZE,
+             max_concurrency: int = DEFAULT_TRANSFER_CONCURRENCY,
+             max_attempts: int = DEFAULT_TRANSFER_MAX_ATTEMPTS,
+             verify: bool = True,
+             client=None) -> DownloadResult:
+    """
+    Download :param key to the file at :param destination. See S3Storage.download.
+    """
+    if client is None:
+        client = client_for_storage(storage, max_concurrency)
+    bucket_name = storage.s3_bucket_name
+    plan = _plan_download(client, bucket_name, key, part_size, verify)
+
+    directory = os.path.dirname(os.path.abspath(destination))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(destination) + '.')
+    try:
+        with open(fd, 'r+b') as f:
+            f.truncate(plan.size)
+            if plan.size:
+                if hasattr(os, 'posix_fallocate'):
+                    try:
+                        # Reserve the blocks up front, so a full disk fails here rather than mid-download
+                        os.posix_fallocate(f.fileno(), 0, plan.size)
+                    except OSError:
+                        pass
+                with mmap.mmap(f.fileno(), plan.size, access=mmap.ACCESS_WRITE) as mapped:
+                    _download_ranges(client, bucket_name, key, plan, memoryview(mapped), max_concurrency,
+                                     max_attempts)
+                    mapped.flush()
+            elif plan.algorithm is not None:
+                plan.check(key, [plan.digest(b'')])
+        os.replace(tmp_path, destination)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return DownloadResult(key, plan.size, plan.etag, plan.expected or plan.etag, plan.algorithm is not None)
+
+
+def _download_ranges(client, bucket_name: str, key: str, plan: _ObjectPlan, view: memoryview, max_concurrency: int,
+                     max_attempts: int):
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(_get_range, client, bucket_name, key, plan, start, view[start:end],
+                                       max_attempts)
+                       for start, end in plan.ranges]
+            try:
+                digests = [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        if plan.algorithm is not None:
+            plan.check(key, digests if plan.parts else [plan.digest(view)])
+    finally:
+        view.release()
+
+
+def iter_download(storage: S3Storage,
+                  key: str,
+                  part_size: int = DEFAULT_PART_SIZE,
+                  max_concurrency: int = DEFAULT_TRANSFER_CONCURRENCY,
+                  max_attempts: int = DEFAULT_TRANSFER_MAX_ATTEMPTS,
+                  verify: bool = True,
+                  client=None):
+    """
+    Yield the contents of :param key in order. See S3Storage.iter_download.
+    """
+    if client is None:
+        client = client_for_storage(storage, max_concurrency)
+    bucket_name = storage.s3_bucket_name
+    plan = _plan_download(client, bucket_name, key, part_size, verify)
+
+    def fetch(start: int, end: int) -> tuple:
+        buffer = bytearray(end - start)
+        return buffer, _get_range(client, bucket_name, key, plan, start, memoryview(buffer), max_attempts)
+
+    ranges = deque(plan.ranges)
+    digests = []
+    whole = hashlib.new(plan.algorithm) if plan.algorithm is not None and not plan.parts else None
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    pending = deque()
+    try:
+        while ranges or pending:
+            # Keep max_concurrency ranges in flight, in order, ahead of the consumer
+            while ranges and len(pending) < max_concurrency:
+                pending.append(executor.submit(fetch, *ranges.popleft()))
+            buffer, digest = pending.popleft().result()
+            if whole is not None:
+                whole.update(buffer)
+            else:
+                digests.append(digest)
+            yield buffer
+        if plan.algorithm is not None:
+            plan.check(key, digests if plan.parts else [whole.digest()])
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+# endregion
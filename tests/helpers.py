@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the tests.
+"""
+import asyncio
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from storage_provisioner.storage import S3Storage
+
+
+def make_storage(seconds_remaining: float = 3600,
+                 access_key_id: str = 'ASIATEST',
+                 path: str = 'path/',
+                 region_name: str = 'us-west-1') -> S3Storage:
+    """
+    Return an S3Storage for :param path in 'bucket', expiring :param seconds_remaining from now, or that long ago
+    if negative.
+    """
+    expiration = datetime.now(timezone.utc) + timedelta(seconds=seconds_remaining)
+    return S3Storage('bucket', region_name, path, access_key_id, 'secret', 'token', expiration,
+                     '123456789012:user', 'arn:aws:sts::123456789012:federated-user/user', 'policy')
+
+
+class AsyncTestCase(unittest.TestCase):
+    """
+    Runs coroutine test methods, and asyncSetUp and asyncTearDown, on a new event loop for each test. Stands in for
+    unittest.IsolatedAsyncioTestCase, which needs Python 3.8.
+    """
+
+    def __init__(self, methodName: str = 'runTest'):
+        unittest.TestCase.__init__(self, methodName)
+        method = getattr(self, methodName, None)
+        if asyncio.iscoroutinefunction(method):
+            setattr(self, methodName, lambda: self.loop.run_until_complete(method()))
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.asyncSetUp())
+
+    def tearDown(self):
+        try:
+            self.loop.run_until_complete(self.asyncTearDown())
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            self.loop.close()
+
+    async def asyncSetUp(self):
+        pass
+
+    async def asyncTearDown(self):
+        pass
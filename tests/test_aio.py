@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_aio
+----------------------------------
+
+Tests for `aio` module.
+"""
+import asyncio
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from aiobotocore.stub import AioStubber
+from storage_provisioner.aio import AsyncS3StorageProvisioner
+from storage_provisioner.storage import AWSS3Region
+from tests.helpers import AsyncTestCase
+
+
+class TestAsyncS3StorageProvisioner(AsyncTestCase):
+    """
+    Offline tests of the asyncio provisioner, using aiobotocore's AioStubber in place of S3 and STS.
+    """
+
+    test_region = AWSS3Region.USWest2
+    test_user_name = 'test_user'
+    test_bucket_name = 'test-bucket'
+
+    async def asyncSetUp(self):
+        self.s3_provisioner = AsyncS3StorageProvisioner('AKIATEST', 'secret',
+                                                        default_region=self.test_region,
+                                                        region_max_concurrency={self.test_region: 2})
+        self.s3_stub = AioStubber(await self.s3_provisioner.client('s3', self.test_region.value))
+        self.sts_stub = AioStubber(await self.s3_provisioner.client('sts', self.test_region.value))
+        self.s3_stub.activate()
+        self.sts_stub.activate()
+
+    async def asyncTearDown(self):
+        self.s3_stub.deactivate()
+        self.sts_stub.deactivate()
+        await self.s3_provisioner.close()
+
+    def add_federation_token_response(self):
+        self.sts_stub.add_response('get_federation_token', {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:{}'.format(self.test_user_name),
+                'Arn': 'arn:aws:sts::123456789012:federated-user/{}'.format(self.test_user_name),
+            },
+        })
+
+    async def test_client_reused(self):
+        client = await self.s3_provisioner.client('s3', self.test_region.value)
+        self.assertIs(client, await self.s3_provisioner.client('s3', self.test_region.value))
+        self.assertEqual(self.s3_provisioner.region_concurrency(self.test_region.value), 2)
+        self.assertEqual(self.s3_provisioner.region_concurrency('us-east-1'), 100)
+
+    async def test_provision_storage(self):
+        self.s3_stub.add_client_error('head_bucket', service_error_code='404', http_status_code=404)
+        self.s3_stub.add_response('create_bucket', {})
+        for _ in range(4):
+            self.add_federation_token_response()
+
+        await self.s3_provisioner.create_bucket_if_needed(self.test_bucket_name, self.test_region)
+        storages = await asyncio.gather(*[self.s3_provisioner.provision_storage(self.test_user_name,
+                                                                                self.test_bucket_name,
+                                                                                'path/{}/'.format(i))
+                                          for i in range(4)])
+
+        self.assertEqual([storage.s3_bucket_path for storage in storages], ['path/{}/'.format(i) for i in range(4)])
+        for storage in storages:
+            self.assertEqual(storage.s3_bucket_name, self.test_bucket_name)
+            self.assertEqual(storage.s3_bucket_region, self.test_region.value)
+            self.assertEqual(self.test_user_name, storage.aws_federated_user_id.split(':')[1])
+            self.assertIn('arn:aws:s3:::{}/{}'.format(self.test_bucket_name, storage.s3_bucket_path),
+                          storage.aws_policy)
+        self.s3_stub.assert_no_pending_responses()
+        self.sts_stub.assert_no_pending_responses()
+
+    async def test_concurrent_provisions_coalesced(self):
+        self.s3_stub.add_response('head_bucket', {})
+        self.add_federation_token_response()
+
+        storages = await asyncio.gather(*[self.s3_provisioner.provision_storage(self.test_user_name,
+                                                                                self.test_bucket_name,
+                                                                                'path/')
+                                          for _ in range(4)])
+
+        self.assertEqual(len(set(id(storage) for storage in storages)), 1)
+        self.s3_stub.assert_no_pending_responses()
+        self.sts_stub.assert_no_pending_responses()
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_backends
+----------------------------------
+
+Tests for `backends` module.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from storage_provisioner import backends
+from storage_provisioner.provisioner import LocalFileStorageProvisioner, S3StorageProvisioner
+from storage_provisioner.storage import LocalFileStorage
+
+# Cumulative time, in seconds, that importing storage_provisioner.provisioner may take without boto3.
+# Generous enough for slow CI machines; importing boto3 alone takes several times longer.
+IMPORT_TIME_BUDGET_SEC = 0.15
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(code: str, *options) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable] + list(options) + ['-c', code],
+                          cwd=PROJECT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+class TestBackends(unittest.TestCase):
+
+    def tearDown(self):
+        backends._BACKENDS.pop('test', None)
+
+    def test_builtin_backends(self):
+        self.assertEqual(backends.get_provisioner_class('local'), LocalFileStorageProvisioner)
+        self.assertEqual(backends.get_provisioner_class('s3'), S3StorageProvisioner)
+        self.assertIn('aio_s3', backends.available_backends())
+
+    def test_create_provisioner(self):
+        with tempfile.TemporaryDirectory() as base_path:
+            provisioner = backends.create_provisioner('local', base_path)
+            self.assertIsInstance(provisioner.provision_storage('path'), LocalFileStorage)
+
+    def test_register_backend(self):
+        backends.register_backend('test', 'storage_provisioner.provisioner:LocalFileStorageProvisioner')
+        self.assertEqual(backends.get_provisioner_class('test'), LocalFileStorageProvisioner)
+
+        backends.register_backend('test', S3StorageProvisioner)
+        self.assertEqual(backends.get_provisioner_class('test'), S3StorageProvisioner)
+
+        with self.assertRaises(ValueError):
+            backends.register_backend('test', 'storage_provisioner.provisioner')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            backends.get_provisioner_class('ftp')
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Importing storage_provisioner must not import boto3 or botocore until an S3 provisioner is created.
+    """
+
+    def test_import_does_not_load_boto3(self):
+        result = run_python(
+            'import json, sys\n'
+            'import storage_provisioner.backends, storage_provisioner.provisioner, storage_provisioner.pool\n'
+            'before = sorted(m for m in sys.modules if m.split(".")[0] in ("boto3", "botocore"))\n'
+            'storage_provisioner.backends.create_provisioner("s3", "AKIATEST", "secret")\n'
+            'after = "botocore" in sys.modules\n'
+            'print(json.dumps([before, after]))\n')
+        before, after = json.loads(result.stdout)
+        self.assertEqual(before, [])
+        self.assertTrue(after)
+
+    def test_import_time_budget(self):
+        result = run_python('import storage_provisioner.provisioner', '-X', 'importtime')
+        cumulative_us = None
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = [field.strip() for field in line.split(':', 1)[-1].split('|')]
+            if len(fields) == 3 and fields[2] == 'storage_provisioner.provisioner':
+                cumulative_us = int(fields[1])
+        self.assertIsNotNone(cumulative_us)
+        self.assertLess(cumulative_us / 1e6, IMPORT_TIME_BUDGET_SEC)
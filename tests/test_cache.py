@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cache
+----------------------------------
+
+Tests for `cache` module.
+"""
+import time
+import unittest
+
+from storage_provisioner.cache import BucketCache, CredentialCache, credential_cache_key
+from tests.helpers import make_storage
+
+
+class TestBucketCache(unittest.TestCase):
+
+    def test_add_and_contains(self):
+        cache = BucketCache(ttl_sec=60)
+        self.assertFalse(cache.contains('bucket', 'us-west-1'))
+
+        cache.add('bucket', 'us-west-1')
+        self.assertTrue(cache.contains('bucket', 'us-west-1'))
+        self.assertFalse(cache.contains('bucket', 'us-east-1'))
+        self.assertFalse(cache.contains('other', 'us-west-1'))
+
+    def test_expiration(self):
+        cache = BucketCache(ttl_sec=0.05)
+        cache.add('bucket', 'us-west-1')
+        time.sleep(0.1)
+        self.assertFalse(cache.contains('bucket', 'us-west-1'))
+        self.assertEqual(len(cache), 0)
+
+    def test_zero_ttl_disables_cache(self):
+        cache = BucketCache(ttl_sec=0)
+        cache.add('bucket', 'us-west-1')
+        self.assertFalse(cache.contains('bucket', 'us-west-1'))
+
+    def test_invalidate(self):
+        cache = BucketCache(ttl_sec=60)
+        cache.add('a', 'us-west-1')
+        cache.add('a', 'us-east-1')
+        cache.add('b', 'us-west-1')
+
+        cache.invalidate(bucket_name='a', region_name='us-east-1')
+        self.assertTrue(cache.contains('a', 'us-west-1'))
+        self.assertFalse(cache.contains('a', 'us-east-1'))
+
+        cache.invalidate(region_name='us-west-1')
+        self.assertFalse(cache.contains('a', 'us-west-1'))
+        self.assertFalse(cache.contains('b', 'us-west-1'))
+
+        cache.add('c', 'us-west-2')
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+
+class TestCredentialCache(unittest.TestCase):
+
+    key = credential_cache_key('user', 'policy', 'bucket', 'path/', 'us-west-1', 3600)
+
+    def setUp(self):
+        self.cache = CredentialCache(max_size=2, min_remaining_sec=60, refresh_ahead_sec=600)
+        self.loads = 0
+
+    def tearDown(self):
+        self.cache.close()
+
+    def loader(self, seconds_remaining: float = 3600):
+        def load():
+            self.loads += 1
+            return make_storage(seconds_remaining, 'ASIA{}'.format(self.loads))
+        return load
+
+    def test_key_truncates_user_name(self):
+        self.assertEqual(credential_cache_key('u' * 40, 'policy', 'bucket', 'path/', 'us-west-1', 3600),
+                         credential_cache_key('u' * 32, 'policy', 'bucket', 'path/', 'us-west-1', 3600))
+
+    def test_hit(self):
+        storage = self.cache.get(self.key, self.loader())
+        self.assertIs(storage, self.cache.get(self.key, self.loader()))
+        self.assertEqual(self.loads, 1)
+
+    def test_nearly_expired_entry_reloaded(self):
+        self.cache.put(self.key, make_storage(30))
+        storage = self.cache.get(self.key, self.loader())
+        self.assertEqual(storage.aws_access_key_id, 'ASIA1')
+        self.assertEqual(self.loads, 1)
+
+    def test_refresh_ahead(self):
+        stale_storage = make_storage(300)
+        self.cache.put(self.key, stale_storage)
+
+        # The stale entry is returned immediately while a replacement is provisioned in the background
+        self.assertIs(self.cache.get(self.key, self.loader()), stale_storage)
+        self.cache.close()
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.cache.peek(self.key).aws_access_key_id, 'ASIA1')
+
+    def test_short_lived_entry_not_refreshed_on_every_hit(self):
+        cache = CredentialCache(min_remaining_sec=300, refresh_ahead_sec=1800)
+        key = credential_cache_key('user', 'policy', 'bucket', 'path/', 'us-west-1', 900)
+        try:
+            for _ in range(200):
+                cache.get(key, self.loader(900))
+            self.assertEqual(self.loads, 1)
+            self.assertEqual(cache.refresh_ahead_sec_for(key), 450)
+
+            # Refreshed once under half its duration remains
+            cache.put(key, make_storage(400))
+            cache.get(key, self.loader(900))
+            cache.close()
+            self.assertEqual(self.loads, 2)
+        finally:
+            cache.close()
+
+    def test_failed_refresh_keeps_entry(self):
+        stale_storage = make_storage(300)
+        self.cache.put(self.key, stale_storage)
+
+        def failing_loader():
+            raise RuntimeError('STS unavailable')
+
+        self.assertIs(self.cache.get(self.key, failing_loader), stale_storage)
+        self.cache.close()
+        self.assertIs(self.cache.peek(self.key), stale_storage)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', make_storage(3600))
+        self.cache.put('b', make_storage(3600))
+        self.cache.peek('a')
+        self.cache.put('c', make_storage(3600))
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNotNone(self.cache.peek('a'))
+        self.assertIsNone(self.cache.peek('b'))
+        self.assertIsNotNone(self.cache.peek('c'))
+
+    def test_invalidate(self):
+        self.cache.get(self.key, self.loader())
+        self.cache.invalidate(self.key)
+        self.cache.get(self.key, self.loader())
+        self.assertEqual(self.loads, 2)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
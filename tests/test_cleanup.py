@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cleanup
+----------------------------------
+
+Tests for `cleanup` module.
+"""
+import threading
+import unittest
+
+from storage_provisioner.cache import BucketCache
+from storage_provisioner.cleanup import S3Cleaner
+from storage_provisioner.ratelimit import AdaptiveRateLimiter
+from storage_provisioner.storage import S3Storage, AWSS3Region
+from tests.helpers import make_storage
+from tests.test_transfer import FakeClientError
+
+
+class FakeS3Client(object):
+    """
+    Lists and deletes keys of one bucket in pages of :param page_size, like S3 with a small MaxKeys.
+    """
+
+    def __init__(self, keys, page_size: int = 7, errors: list = None):
+        self.keys = set(keys)
+        self.page_size = page_size
+        # Per-key errors returned by the next delete_objects calls, as {key: code}
+        self.errors = list(errors or ())
+        self.uploads = [{'Key': 'live/a/partial.ts', 'UploadId': 'upload-1'}]
+        self.batches = []
+        self.bucket_exists = True
+        self._lock = threading.Lock()
+
+    def _check_bucket(self):
+        if not self.bucket_exists:
+            raise FakeClientError('NoSuchBucket', 404)
+
+    def _page(self, Prefix, Delimiter, marker):
+        self._check_bucket()
+        with self._lock:
+            matching = sorted(key for key in self.keys if key.startswith(Prefix))
+        objects, common = [], []
+        for key in matching:
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefix = Prefix + rest[:rest.index(Delimiter) + 1]
+                if common_prefix not in common:
+                    common.append(common_prefix)
+            else:
+                objects.append(key)
+        # Continue after the last key returned, so keys deleted meanwhile don't shift pages
+        remaining = [key for key in objects if marker is None or key > marker]
+        page = remaining[:self.page_size]
+        truncated = len(remaining) > self.page_size
+        return page, [{'Prefix': prefix} for prefix in common] if marker is None else [], truncated, \
+            page[-1] if page else None
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, ContinuationToken=None):
+        page, common, truncated, marker = self._page(Prefix, Delimiter, ContinuationToken)
+        return {'Contents': [{'Key': key} for key in page], 'CommonPrefixes': common, 'IsTruncated': truncated,
+                'NextContinuationToken': marker}
+
+    def list_object_versions(self, Bucket, Prefix, Delimiter=None, KeyMarker=None, VersionIdMarker=None):
+        page, common, truncated, marker = self._page(Prefix, Delimiter, KeyMarker)
+        return {'Versions': [{'Key': key, 'VersionId': 'null'} for key in page], 'CommonPrefixes': common,
+                'IsTruncated': truncated, 'NextKeyMarker': marker, 'NextVersionIdMarker': 'null'}
+
+    def delete_objects(self, Bucket, Delete):
+        assert Delete['Quiet']
+        assert len(Delete['Objects']) <= 1000
+        with self._lock:
+            self.batches.append(len(Delete['Objects']))
+            failing = self.errors.pop(0) if self.errors else {}
+        errors = []
+        for identifier in Delete['Objects']:
+            key = identifier['Key']
+            if key in failing:
+                errors.append({'Key': key, 'Code': failing[key], 'Message': failing[key]})
+            else:
+                with self._lock:
+                    self.keys.discard(key)
+        return {'Errors': errors}
+
+    def list_multipart_uploads(self, Bucket, Prefix):
+        return {'Uploads': [upload for upload in self.uploads if upload['Key'].startswith(Prefix)],
+                'IsTruncated': False}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads = [upload for upload in self.uploads if upload['UploadId'] != UploadId]
+
+    def delete_bucket(self, Bucket):
+        self._check_bucket()
+        assert not self.keys
+        self.bucket_exists = False
+
+
+class FakeClientPool(object):
+
+    def __init__(self, client):
+        self.clients = {}
+        self._client = client
+
+    def client(self, service_name: str, region_name: str):
+        self.clients[(service_name, region_name)] = self._client
+        return self._client
+
+
+class FakeProvisioner(object):
+    """
+    Stands in for S3StorageProvisioner, handing out one S3 client.
+    """
+
+    def __init__(self, client):
+        self.default_region = AWSS3Region.USWest1
+        self.client_pool = FakeClientPool(client)
+        self.bucket_cache = BucketCache()
+
+
+def make_expired_storage(path: str, expired_sec_ago: float) -> S3Storage:
+    return make_storage(-expired_sec_ago, path=path, region_name='us-east-1')
+
+
+class TestS3Cleaner(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['live/{}/{:05d}.ts'.format(stream, segment) for stream in 'abcd' for segment in range(700)]
+        self.keys += ['live/index.m3u8', 'vod/a/00000.ts']
+        self.client = FakeS3Client(self.keys)
+        self.provisioner = FakeProvisioner(self.client)
+        self.cleaner = S3Cleaner(self.provisioner, max_concurrency=4,
+                                 rate_limiter=AdaptiveRateLimiter(rate=1000, backoff_base_sec=0.001))
+
+    def test_iter_objects_lists_sub_prefixes(self):
+        keys = [identifier['Key'] for objects in self.cleaner.iter_objects('bucket', 'live/') for identifier in objects]
+        self.assertEqual(sorted(keys), sorted(key for key in self.keys if key.startswith('live/')))
+
+    def test_delete_prefix_in_batches(self):
+        progress = []
+        result = self.cleaner.delete_prefix('bucket', 'live/', progress=lambda r: progress.append(r.deleted))
+
+        self.assertEqual(result.listed, 2801)
+        self.assertEqual(result.deleted, 2801)
+        self.assertEqual(result.failed, {})
+        self.assertEqual(result.aborted_uploads, 1)
+        self.assertEqual(self.client.keys, {'vod/a/00000.ts'})
+        self.assertEqual(sorted(self.client.batches), [801, 1000, 1000])
+        self.assertEqual(progress[-1], 2801)
+
+    def test_retries_throttled_keys(self):
+        self.client.errors = [{'live/a/00000.ts': 'SlowDown', 'live/a/00001.ts': 'AccessDenied'}]
+        result = self.cleaner.delete_prefix('bucket', 'live/a/')
+
+        self.assertEqual(result.deleted, 699)
+        self.assertEqual(result.failed, {'live/a/00001.ts': 'AccessDenied'})
+        self.assertNotIn('live/a/00000.ts', self.client.keys)
+        self.assertEqual(self.client.batches, [700, 1])
+        self.assertEqual(self.cleaner.rate_limiter.throttles, 1)
+
+    def test_delete_bucket(self):
+        self.provisioner.bucket_cache.add('bucket', 'us-west-1')
+        result = self.cleaner.delete_bucket('bucket')
+
+        self.assertTrue(result.bucket_deleted)
+        self.assertEqual(result.deleted, len(self.keys))
+        self.assertFalse(self.provisioner.bucket_cache.contains('bucket', 'us-west-1'))
+
+        # Already gone
+        self.assertFalse(self.cleaner.delete_bucket('bucket').bucket_deleted)
+
+    def test_sweep_expired(self):
+        storages = [make_expired_storage('live/a/', 3600),
+                    make_expired_storage('live/a/', 7200),
+                    make_expired_storage('live/b/', 60),
+                    make_expired_storage('', 3600)]
+        results = self.cleaner.sweep_expired(storages, retention_sec=600)
+
+        self.assertEqual([result.prefix for result in results], ['live/a/'])
+        self.assertFalse(any(key.startswith('live/a/') for key in self.client.keys))
+        self.assertIn('live/b/00000.ts', self.client.keys)
+        self.assertIn(('s3', 'us-east-1'), self.provisioner.client_pool.clients)
+
+    def test_sweep_expired_spares_sibling_prefixes(self):
+        self.client.keys.update(['streams/1/00000.ts', 'streams/10/00000.ts', 'streams/12/00000.ts', 'streams/1.m3u8'])
+        storages = [make_expired_storage('streams/1', 3600), make_expired_storage('streams/1/', 3600)]
+        results = self.cleaner.sweep_expired(storages, retention_sec=600)
+
+        self.assertEqual([result.prefix for result in results], ['streams/1/'])
+        self.assertNotIn('streams/1/00000.ts', self.client.keys)
+        for key in ('streams/10/00000.ts', 'streams/12/00000.ts', 'streams/1.m3u8'):
+            self.assertIn(key, self.client.keys)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_hedging
+----------------------------------
+
+Tests for `hedging` module.
+"""
+import threading
+import time
+import unittest
+
+from botocore.exceptions import EndpointConnectionError, NoCredentialsError, ParamValidationError, \
+    ReadTimeoutError
+from botocore.stub import Stubber
+from storage_provisioner.hedging import HedgedCaller, is_endpoint_failure
+from storage_provisioner.storage import AWSS3Region
+from tests.test_provisioner_stubbed import StubbedProvisionerTestCase
+from tests.test_transfer import FakeClientError
+
+
+class FakeEndpoints(object):
+    """
+    Stands in for regional STS endpoints, each answering after a set delay, or raising a set error.
+    """
+
+    def __init__(self, delays: dict, errors: dict = None):
+        self.delays = dict(delays)
+        self.errors = dict(errors or {})
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, region_name: str) -> str:
+        with self._lock:
+            self.calls.append(region_name)
+        time.sleep(self.delays[region_name])
+        error = self.errors.get(region_name)
+        if error is not None:
+            raise error
+        return region_name
+
+
+class TestHedgedCaller(unittest.TestCase):
+
+    def setUp(self):
+        self.hedger = HedgedCaller(['us-west-1', 'us-east-1', 'us-west-2'], min_samples=5, initial_delay_sec=0.05,
+                                   min_delay_sec=0.01, failure_threshold=2, cooldown_sec=60)
+
+    def tearDown(self):
+        self.hedger.close()
+
+    def test_fast_primary_is_not_hedged(self):
+        endpoints = FakeEndpoints({'us-west-1': 0.0, 'us-east-1': 0.0, 'us-west-2': 0.0})
+        self.assertEqual(self.hedger.call(endpoints), 'us-west-1')
+        self.assertEqual(endpoints.calls, ['us-west-1'])
+        self.assertEqual(self.hedger.hedges, 0)
+
+    def test_slow_primary_is_hedged(self):
+        endpoints = FakeEndpoints({'us-west-1': 1.0, 'us-east-1': 0.0, 'us-west-2': 0.0})
+        start = time.monotonic()
+        self.assertEqual(self.hedger.call(endpoints), 'us-east-1')
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(endpoints.calls, ['us-west-1', 'us-east-1'])
+        self.assertEqual((self.hedger.hedges, self.hedger.hedge_wins), (1, 1))
+
+    def test_fastest_endpoint_becomes_primary(self):
+        endpoints = FakeEndpoints({'us-west-1': 0.2, 'us-east-1': 0.0, 'us-west-2': 0.0})
+        self.hedger.call(endpoints)
+        # Wait for the losing call to be recorded
+        time.sleep(0.3)
+
+        self.assertEqual([endpoint.name for endpoint in self.hedger.ranked()][:2], ['us-east-1', 'us-west-1'])
+        endpoints.calls = []
+        self.hedger.call(endpoints)
+        self.assertEqual(endpoints.calls, ['us-east-1'])
+
+    def test_hedge_delay_follows_percentile(self):
+        endpoints = FakeEndpoints({'us-west-1': 0.0, 'us-east-1': 0.0, 'us-west-2': 0.0})
+        primary = self.hedger.endpoints[0]
+        self.assertEqual(self.hedger.hedge_delay_sec(primary), 0.05)
+        for _ in range(5):
+            self.hedger.call(endpoints)
+        self.assertEqual(self.hedger.hedge_delay_sec(primary), 0.01)
+
+    def test_failure_falls_back_and_opens_circuit(self):
+        endpoints = FakeEndpoints({'us-west-1': 0.0, 'us-east-1': 0.0, 'us-west-2': 0.0},
+                                  errors={'us-west-1': ConnectionError('reset')})
+        self.assertEqual(self.hedger.call(endpoints), 'us-east-1')
+        self.assertEqual(self.hedger.ranked()[0].name, 'us-east-1')
+
+        # us-east-1 fails too, falling back to us-west-1 again
+        endpoints.errors['us-east-1'] = ConnectionError('reset')
+        with self.assertRaises(ConnectionError):
+            self.hedger.call(endpoints)
+        del endpoints.errors['us-east-1']
+
+        # us-west-1's circuit is open after two failures, so it is routed around
+        endpoints.calls = []
+        self.assertEqual(self.hedger.call(endpoints), 'us-east-1')
+        self.assertEqual(endpoints.calls, ['us-east-1'])
+        self.assertNotIn('us-west-1', [endpoint.name for endpoint in self.hedger.ranked()])
+
+        # After the cooldown, it is probed again
+        self.assertIn('us-west-1', [endpoint.name for endpoint in self.hedger.ranked(time.monotonic() + 61)])
+
+    def test_request_errors_are_raised(self):
+        error = FakeClientError('AccessDenied', 403)
+        endpoints = FakeEndpoints({'us-west-1': 0.0, 'us-east-1': 0.0, 'us-west-2': 0.0}, errors={'us-west-1': error})
+        with self.assertRaises(FakeClientError):
+            self.hedger.call(endpoints)
+        self.assertEqual(endpoints.calls, ['us-west-1'])
+        self.assertEqual(self.hedger.endpoints[0].consecutive_failures, 0)
+
+    def test_invalid_parameters_do_not_open_circuit(self):
+        error = ParamValidationError(report='Invalid length for parameter Name')
+        endpoints = FakeEndpoints({'us-west-1': 0.0, 'us-east-1': 0.0, 'us-west-2': 0.0}, errors={'us-west-1': error})
+        for _ in range(3):
+            with self.assertRaises(ParamValidationError):
+                self.hedger.call(endpoints)
+
+        self.assertEqual(endpoints.calls, ['us-west-1'] * 3)
+        self.assertEqual(self.hedger.endpoints[0].consecutive_failures, 0)
+        self.assertEqual(self.hedger.ranked()[0].name, 'us-west-1')
+        self.assertEqual(self.hedger.hedges, 0)
+
+    def test_all_failing(self):
+        endpoints = FakeEndpoints({'us-west-1': 0.0, 'us-east-1': 0.0, 'us-west-2': 0.0},
+                                  errors={'us-west-1': FakeClientError('InternalError', 500),
+                                          'us-east-1': FakeClientError('InternalError', 503)})
+        with self.assertRaises(FakeClientError) as context:
+            self.hedger.call(endpoints)
+        self.assertEqual(context.exception.response['ResponseMetadata']['HTTPStatusCode'], 500)
+
+    def test_is_endpoint_failure(self):
+        self.assertTrue(is_endpoint_failure(ConnectionError()))
+        endpoint_url = 'https://sts.us-west-1.amazonaws.com'
+        self.assertTrue(is_endpoint_failure(ReadTimeoutError(endpoint_url=endpoint_url)))
+        self.assertTrue(is_endpoint_failure(EndpointConnectionError(endpoint_url=endpoint_url)))
+        self.assertFalse(is_endpoint_failure(NoCredentialsError()))
+        self.assertFalse(is_endpoint_failure(TypeError()))
+        self.assertTrue(is_endpoint_failure(FakeClientError('ServiceUnavailable', 503)))
+        self.assertFalse(is_endpoint_failure(FakeClientError('Throttling', 400)))
+
+
+class TestHedgedFederationToken(StubbedProvisionerTestCase):
+    """
+    Offline tests of S3StorageProvisioner's hedged federation token requests.
+    """
+
+    def setUp(self):
+        StubbedProvisionerTestCase.setUp(self)
+        # Hedged calls go to the regional endpoints' clients
+        self.sts_stub.deactivate()
+        self.sts_stub = Stubber(self.s3_provisioner.regional_sts(self.test_region.value))
+        self.sts_stub.activate()
+
+    def test_hedged_federation_token(self):
+        self.s3_stub.add_response('head_bucket', {})
+        self.add_federation_token_response('user')
+        hedger = HedgedCaller([self.test_region.value, AWSS3Region.USEast1.value])
+        self.s3_provisioner.hedger = hedger
+        try:
+            storage = self.s3_provisioner.provision_storage('user', 'bucket', 'path/')
+        finally:
+            hedger.close()
+
+        self.assertEqual(storage.aws_access_key_id, 'ASIA' + 'X' * 16)
+        self.assertEqual(hedger.endpoints[0].requests, 1)
+        self.assertEqual(hedger.hedges, 0)
+        self.sts_stub.assert_no_pending_responses()
+
+    def test_regional_endpoints(self):
+        for region in (self.test_region, AWSS3Region.USEast1, AWSS3Region.EUWest1):
+            sts = self.s3_provisioner.regional_sts(region.value)
+            self.assertEqual(sts.meta.endpoint_url, 'https://sts.{}.amazonaws.com'.format(region.value))
+            self.assertIs(sts, self.s3_provisioner.regional_sts(region.value))
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_instrumentation
+----------------------------------
+
+Tests for `instrumentation` module.
+"""
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from storage_provisioner.instrumentation import Instrumentation, ProvisionHook, HistogramCollector, \
+    SlowCallProfiler, PhaseTiming, ProvisionTrace
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.storage import AWSS3Region
+
+
+class RecordingHook(ProvisionHook):
+
+    def __init__(self):
+        self.started = []
+        self.phases = []
+        self.provisions = []
+
+    def on_start(self, trace: ProvisionTrace):
+        self.started.append(trace)
+
+    def on_phase(self, trace: ProvisionTrace, phase: PhaseTiming):
+        self.phases.append((trace, phase))
+
+    def on_provision(self, trace: ProvisionTrace):
+        self.provisions.append(trace)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_disabled_returns_null_context(self):
+        instrumentation = Instrumentation()
+        self.assertFalse(instrumentation.enabled)
+        with instrumentation.trace('user', 'bucket', 'path/', 'us-west-2') as trace:
+            with instrumentation.phase('head_bucket') as phase:
+                phase.retries = 2
+        self.assertIs(trace, phase)
+
+    def test_phases_attributed_to_trace(self):
+        hook = RecordingHook()
+        instrumentation = Instrumentation([hook])
+
+        with instrumentation.trace('user', 'bucket', 'path/', 'us-west-2'):
+            with instrumentation.phase('client'):
+                pass
+            with self.assertRaises(ClientError):
+                with instrumentation.phase('head_bucket'):
+                    raise ClientError({'Error': {'Code': '404'}, 'ResponseMetadata': {'RetryAttempts': 1}},
+                                      'HeadBucket')
+
+        self.assertEqual(len(hook.started), 1)
+        self.assertEqual(len(hook.provisions), 1)
+        trace = hook.provisions[0]
+        self.assertEqual([(p.name, p.outcome, p.retries) for p in trace.phases],
+                         [('client', 'ok', 0), ('head_bucket', '404', 1)])
+        self.assertEqual(trace.outcome, 'ok')
+        self.assertGreaterEqual(trace.duration_sec, sum(p.duration_sec for p in trace.phases))
+
+    def test_phase_outside_trace(self):
+        hook = RecordingHook()
+        instrumentation = Instrumentation([hook])
+        with instrumentation.phase('client'):
+            pass
+        self.assertIsNone(hook.phases[0][0])
+
+    def test_failing_hook_ignored(self):
+        class FailingHook(ProvisionHook):
+            def on_phase(self, trace, phase):
+                raise RuntimeError
+
+        hook = RecordingHook()
+        instrumentation = Instrumentation([FailingHook(), hook])
+        with instrumentation.phase('client'):
+            pass
+        self.assertEqual(len(hook.phases), 1)
+
+
+class TestHistogramCollector(unittest.TestCase):
+
+    def test_export_prometheus(self):
+        collector = HistogramCollector(buckets=(0.1, 1.0))
+
+        trace = ProvisionTrace('user', 'bucket', 'path/', 'us-west-2')
+        for duration_sec, outcome, retries in ((0.05, 'ok', 0), (0.5, 'ok', 2), (2.0, 'Throttling', 3)):
+            phase = PhaseTiming('get_federation_token')
+            phase.duration_sec = duration_sec
+            phase.outcome = outcome
+            phase.retries = retries
+            collector.on_phase(trace, phase)
+        trace.duration_sec = 0.5
+        collector.on_provision(trace)
+
+        text = collector.export_prometheus()
+
+        self.assertIn('# TYPE storage_provisioner_phase_duration_seconds histogram', text)
+        prefix = 'storage_provisioner_phase_duration_seconds_bucket{phase="get_federation_token",outcome="ok",'
+        self.assertIn(prefix + 'le="0.1"} 1', text)
+        self.assertIn(prefix + 'le="1.0"} 2', text)
+        self.assertIn(prefix + 'le="+Inf"} 2', text)
+        self.assertIn('storage_provisioner_phase_duration_seconds_count'
+                      '{phase="get_federation_token",outcome="Throttling"} 1', text)
+        self.assertIn('storage_provisioner_provision_duration_seconds_bucket{outcome="ok",le="1.0"} 1', text)
+        self.assertIn('storage_provisioner_phase_retries_total{phase="get_federation_token",outcome="ok"} 2', text)
+
+        collector.reset()
+        self.assertNotIn('_count{', collector.export_prometheus())
+
+
+class TestSlowCallProfiler(unittest.TestCase):
+
+    def test_reports_slow_sampled_calls(self):
+        reported = []
+        profiler = SlowCallProfiler(sample_rate=1.0, slow_call_sec=0.0, on_slow_call=lambda t, r: reported.append(r))
+        instrumentation = Instrumentation([profiler])
+
+        with instrumentation.trace('user', 'bucket', 'path/', 'us-west-2'):
+            with instrumentation.phase('client'):
+                sum(range(1000))
+
+        self.assertEqual(len(profiler.reports), 1)
+        self.assertEqual(reported, list(profiler.reports))
+        self.assertIn('Slow provision of bucket/path/', reported[0])
+        self.assertIn('client:', reported[0])
+
+    def test_unsampled_calls_not_reported(self):
+        profiler = SlowCallProfiler(sample_rate=0.0, slow_call_sec=0.0)
+        instrumentation = Instrumentation([profiler])
+        with instrumentation.trace('user', 'bucket', 'path/', 'us-west-2'):
+            pass
+        self.assertEqual(len(profiler.reports), 0)
+
+
+class TestS3StorageProvisionerInstrumentation(unittest.TestCase):
+    """
+    Offline tests of provision_storage timings, using botocore's Stubber in place of S3 and STS.
+    """
+
+    test_region = AWSS3Region.USWest2
+
+    def setUp(self):
+        self.hook = RecordingHook()
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', default_region=self.test_region,
+                                                   hooks=[self.hook])
+        self.s3_stub = Stubber(self.s3_provisioner.client_pool.client('s3', self.test_region.value))
+        self.sts_stub = Stubber(self.s3_provisioner.client_pool.client('sts', self.test_region.value))
+        self.s3_stub.activate()
+        self.sts_stub.activate()
+
+    def tearDown(self):
+        self.s3_stub.deactivate()
+        self.sts_stub.deactivate()
+
+    def test_provision_storage_phases(self):
+        self.s3_stub.add_client_error('head_bucket', service_error_code='404', http_status_code=404)
+        self.s3_stub.add_response('create_bucket', {})
+        self.sts_stub.add_response('get_federation_token', {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:user',
+                'Arn': 'arn:aws:sts::123456789012:federated-user/user',
+            },
+        })
+
+        self.s3_provisioner.provision_storage('user', 'test-bucket', 'path/')
+
+        self.assertEqual(len(self.hook.provisions), 1)
+        trace = self.hook.provisions[0]
+        self.assertEqual((trace.bucket_name, trace.path, trace.region_name, trace.outcome),
+                         ('test-bucket', 'path/', self.test_region.value, 'ok'))
+        self.assertEqual([(p.name, p.outcome) for p in trace.phases],
+                         [('client', 'ok'), ('head_bucket', '404'), ('create_bucket', 'ok'),
+                          ('client', 'ok'), ('get_federation_token', 'ok')])
+
+    def test_failed_provision_outcome(self):
+        self.s3_provisioner.bucket_cache.add('test-bucket', self.test_region.value)
+        self.sts_stub.add_client_error('get_federation_token', service_error_code='Throttling',
+                                       http_status_code=400)
+
+        with self.assertRaises(ClientError):
+            self.s3_provisioner.provision_storage('user', 'test-bucket', 'path/')
+
+        trace = self.hook.provisions[0]
+        self.assertEqual(trace.outcome, 'Throttling')
+        self.assertEqual(trace.phases[-1].outcome, 'Throttling')
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_local
+----------------------------------
+
+Tests for `LocalFileStorage` and `LocalFileStorageProvisioner`, which need no AWS credentials.
+"""
+import io
+import os
+import tempfile
+import unittest
+
+from storage_provisioner.provisioner import LocalFileStorageProvisioner
+from storage_provisioner.storage import LocalFileStorage
+
+
+class TestLocalFileStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = LocalFileStorage(self.tmp_dir.name)
+        self.contents = os.urandom(3 * 1024 * 1024 + 17)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_contents(self, key: str, contents: bytes):
+        with self.storage.open(key) as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_path_for_key(self):
+        self.assertEqual(self.storage.path_for_key('a/b.txt'),
+                         os.path.join(os.path.realpath(self.tmp_dir.name), 'a', 'b.txt'))
+        self.assertTrue(self.storage.get_url_for_key('a/b.txt').startswith('file:///'))
+        for key in ('../outside.txt', 'a/../../outside.txt', '/etc/passwd'):
+            with self.assertRaises(ValueError):
+                self.storage.path_for_key(key)
+
+    def test_write_bytes(self):
+        self.assertEqual(self.storage.write('dir/bytes.bin', self.contents), len(self.contents))
+        self.assert_contents('dir/bytes.bin', self.contents)
+
+    def test_write_regular_file_from_position(self):
+        with tempfile.TemporaryFile() as src:
+            src.write(self.contents)
+            src.seek(100)
+            self.assertEqual(self.storage.write('file.bin', src), len(self.contents) - 100)
+            self.assertEqual(src.tell(), len(self.contents))
+        self.assert_contents('file.bin', self.contents[100:])
+
+    def test_write_stream(self):
+        self.assertEqual(self.storage.write('stream.bin', io.BytesIO(self.contents), chunk_size=4096),
+                         len(self.contents))
+        self.assert_contents('stream.bin', self.contents)
+
+    def test_write_replaces_atomically(self):
+        self.storage.write('replaced.bin', b'old')
+        self.storage.write('replaced.bin', b'new')
+        self.assert_contents('replaced.bin', b'new')
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['replaced.bin'])
+
+    def test_read_mmap(self):
+        self.storage.write('mapped.bin', self.contents)
+        mapped = self.storage.read_mmap('mapped.bin')
+        try:
+            self.assertEqual(len(mapped), len(self.contents))
+            self.assertEqual(mapped[1000:2000], self.contents[1000:2000])
+        finally:
+            mapped.close()
+
+    def test_delete(self):
+        self.storage.write('deleted.bin', b'x')
+        self.storage.delete('deleted.bin')
+        self.assertFalse(os.path.exists(self.storage.path_for_key('deleted.bin')))
+
+
+class TestLocalFileStorageProvisioner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base_path = os.path.join(self.tmp_dir.name, 'base')
+        self.provisioner = LocalFileStorageProvisioner(self.base_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_provision_storage(self):
+        storage = self.provisioner.provision_storage('path/to/test/')
+        self.assertTrue(os.path.isdir(storage.base_path))
+        self.assertEqual(storage.base_path, os.path.join(os.path.realpath(self.base_path), 'path', 'to', 'test'))
+
+        storage.write('test.txt', b'hello.')
+        with open(os.path.join(self.base_path, 'path', 'to', 'test', 'test.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'hello.')
+
+        # Storage is scoped to its path
+        with self.assertRaises(ValueError):
+            storage.write('../test.txt', b'hello.')
+
+    def test_provision_storage_outside_base_path(self):
+        with self.assertRaises(ValueError):
+            self.provisioner.provision_storage('../outside/')
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_policy
+----------------------------------
+
+Tests for `policy` module.
+"""
+import json
+import unittest
+
+from storage_provisioner.policy import PolicyTemplate, PolicyTooLargeError, DEFAULT_AWS_S3_POLICY, \
+    DEFAULT_AWS_S3_POLICY_TEMPLATE, AWS_STS_MAX_POLICY_LENGTH, estimate_packed_policy_size, minify_policy, \
+    validate_policy_size
+
+
+class TestPolicyTemplate(unittest.TestCase):
+
+    def test_render_matches_str_replace(self):
+        expected = DEFAULT_AWS_S3_POLICY_TEMPLATE.replace('{bucket}', 'my-bucket').replace('{path}', 'path/to/')
+        rendered = DEFAULT_AWS_S3_POLICY.render('my-bucket', 'path/to/')
+
+        self.assertEqual(json.loads(rendered), json.loads(expected))
+        self.assertEqual(rendered, minify_policy(expected))
+        self.assertNotIn(' ', rendered)
+        self.assertNotIn('\n', rendered)
+
+    def test_render_allows_multipart_uploads(self):
+        # Resuming an upload lists its parts, and abandoning one aborts it
+        actions = json.loads(DEFAULT_AWS_S3_POLICY.render('bucket', 'path/'))['Statement'][0]['Action']
+        self.assertIn('s3:ListMultipartUploadParts', actions)
+        self.assertIn('s3:AbortMultipartUpload', actions)
+
+    def test_render_memoized(self):
+        template = PolicyTemplate(DEFAULT_AWS_S3_POLICY_TEMPLATE)
+        self.assertIs(template.render('bucket', 'a/'), template.render('bucket', 'a/'))
+        self.assertNotEqual(template.render('bucket', 'a/'), template.render('bucket', 'b/'))
+
+    def test_render_escapes_values(self):
+        rendered = DEFAULT_AWS_S3_POLICY.render('bucket', 'quote"/')
+        statement = json.loads(rendered)['Statement'][0]
+        self.assertEqual(statement['Resource'], 'arn:aws:s3:::bucket/quote"/*')
+
+    def test_render_requires_path(self):
+        with self.assertRaises(ValueError):
+            DEFAULT_AWS_S3_POLICY.render('bucket', None)
+
+    def test_invalid_template(self):
+        with self.assertRaises(ValueError):
+            PolicyTemplate('{"Resource": "arn:aws:s3:::{bucket}/{path}"')
+
+    def test_oversized_template(self):
+        with self.assertRaises(PolicyTooLargeError):
+            PolicyTemplate(DEFAULT_AWS_S3_POLICY_TEMPLATE, max_length=100)
+
+    def test_oversized_render(self):
+        with self.assertRaises(PolicyTooLargeError):
+            DEFAULT_AWS_S3_POLICY.render('bucket', 'p' * AWS_STS_MAX_POLICY_LENGTH)
+
+    def test_packed_size_limit(self):
+        policy = DEFAULT_AWS_S3_POLICY.render('bucket', 'path/')
+        packed_size = estimate_packed_policy_size(policy)
+        self.assertLess(packed_size, len(policy))
+
+        validate_policy_size(policy, max_packed_bytes=packed_size)
+        with self.assertRaises(PolicyTooLargeError):
+            validate_policy_size(policy, max_packed_bytes=packed_size - 1)
+
+    def test_render_many_single_grant_matches_render(self):
+        self.assertEqual(DEFAULT_AWS_S3_POLICY.render_many([('bucket', 'path/')]),
+                         DEFAULT_AWS_S3_POLICY.render('bucket', 'path/'))
+
+    def test_render_many_compacts_resources(self):
+        rendered = DEFAULT_AWS_S3_POLICY.render_many([('bucket', 'live/'),
+                                                      ('bucket', 'live/a/'),
+                                                      ('bucket', 'thumbs/'),
+                                                      ('bucket', 'thumbs/'),
+                                                      ('other', 'live/a/')])
+        statements = json.loads(rendered)['Statement']
+        self.assertEqual(statements[0]['Resource'], ['arn:aws:s3:::bucket/live/*',
+                                                     'arn:aws:s3:::bucket/thumbs/*',
+                                                     'arn:aws:s3:::other/live/a/*'])
+        # Resources without a wildcard only cover themselves
+        self.assertEqual(statements[1]['Resource'], ['arn:aws:s3:::bucket/live/',
+                                                     'arn:aws:s3:::bucket/live/a/',
+                                                     'arn:aws:s3:::bucket/thumbs/',
+                                                     'arn:aws:s3:::other/live/a/'])
+        self.assertNotIn(' ', rendered)
+
+    def test_render_many_escapes_values(self):
+        rendered = DEFAULT_AWS_S3_POLICY.render_many([('bucket', 'quote"/'), ('bucket', 'b/')])
+        self.assertEqual(json.loads(rendered)['Statement'][0]['Resource'][0], 'arn:aws:s3:::bucket/quote"/*')
+
+    def test_render_many_rejects_placeholders_outside_resources(self):
+        template = PolicyTemplate('{"Statement":[{"Effect":"Allow","Action":"s3:ListBucket",'
+                                  '"Resource":"arn:aws:s3:::{bucket}",'
+                                  '"Condition":{"StringLike":{"s3:prefix":"{path}*"}}}]}')
+        with self.assertRaises(ValueError):
+            template.render_many([('bucket', 'a/'), ('bucket', 'b/')])
+
+    def test_render_many_size_limit(self):
+        grants = [('bucket', 'path/{}/'.format(i)) for i in range(100)]
+        with self.assertRaises(PolicyTooLargeError):
+            DEFAULT_AWS_S3_POLICY.render_many(grants)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
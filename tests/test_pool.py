@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pool
+----------------------------------
+
+Tests for `pool` module.
+"""
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from botocore.stub import Stubber
+from storage_provisioner.pool import CredentialPool
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.storage import AWSS3Region
+
+
+class TestCredentialPool(unittest.TestCase):
+    """
+    Offline tests of credential pooling, using botocore's Stubber in place of STS.
+    """
+
+    test_region = AWSS3Region.USWest2
+    test_user_name = 'test_user'
+    test_bucket_name = 'test-bucket'
+
+    def setUp(self):
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', default_region=self.test_region)
+        self.s3_provisioner.bucket_cache.add(self.test_bucket_name, self.test_region.value)
+        self.sts_stub = Stubber(self.s3_provisioner.client_pool.client('sts', self.test_region.value))
+        self.sts_stub.activate()
+
+        self.pool = CredentialPool(self.s3_provisioner,
+                                   self.test_user_name,
+                                   self.test_bucket_name,
+                                   lambda count: ['streams/{}/'.format(i) for i in range(count)],
+                                   depth=3,
+                                   min_remaining_sec=60)
+        self.s3_provisioner.add_credential_pool(self.pool, start=False)
+
+    def tearDown(self):
+        self.s3_provisioner.remove_credential_pool(self.pool)
+        self.sts_stub.deactivate()
+
+    def add_federation_token_response(self, lifetime_sec: float = 3600):
+        self.sts_stub.add_response('get_federation_token', {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(seconds=lifetime_sec),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:{}'.format(self.test_user_name),
+                'Arn': 'arn:aws:sts::123456789012:federated-user/{}'.format(self.test_user_name),
+            },
+        })
+
+    def test_refill_and_take(self):
+        for _ in range(3):
+            self.add_federation_token_response()
+        self.pool.refill()
+        self.sts_stub.assert_no_pending_responses()
+        self.assertEqual(len(self.pool), 3)
+
+        storage = self.s3_provisioner.provision_storage(self.test_user_name, self.test_bucket_name, 'streams/1/')
+        self.assertEqual(storage.s3_bucket_path, 'streams/1/')
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 0))
+        self.assertEqual(len(self.pool), 2)
+
+        # Pooled storages are handed out once
+        self.add_federation_token_response()
+        self.s3_provisioner.provision_storage(self.test_user_name, self.test_bucket_name, 'streams/1/')
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+
+        # Requests outside the pool's scope are not counted
+        self.add_federation_token_response()
+        self.s3_provisioner.provision_storage('other_user', self.test_bucket_name, 'streams/2/')
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+        self.sts_stub.assert_no_pending_responses()
+
+    def test_refill_discards_expiring_storages(self):
+        for _ in range(3):
+            self.add_federation_token_response(lifetime_sec=30)
+        self.pool.refill()
+
+        for _ in range(3):
+            self.add_federation_token_response()
+        self.pool.refill()
+        self.sts_stub.assert_no_pending_responses()
+
+        storage = self.pool.take(self.pool.key_for_path('streams/0/'))
+        self.assertGreater(storage.seconds_until_expiration(), 60)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
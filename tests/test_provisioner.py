@@ -9,8 +9,9 @@ Tests for `provisioner` module.
 """
 import os
 import unittest
-from boto3.session import Session, botocore
+from boto3.session import Session
 from botocore.exceptions import ClientError
+from storage_provisioner.cleanup import S3Cleaner
 from storage_provisioner.provisioner import S3StorageProvisioner
 from storage_provisioner.storage import S3Storage
 
@@ -26,7 +27,6 @@ except ImportError:
 
 class TestS3StorageProvisioner(unittest.TestCase):
     s3_provisioner = None
-    master_session = None  # Used to perform administrative AWS actions
 
     test_user_name = 'test_user'
     test_bucket_name = '9a5bb25e-783a-11e5-86ba-b8f6b11601af'
@@ -37,13 +37,11 @@ class TestS3StorageProvisioner(unittest.TestCase):
     def setUp(self):
         print('setup')
         self.s3_provisioner = S3StorageProvisioner(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
-        self.master_session = Session(aws_access_key_id=AWS_ACCESS_KEY_ID,
-                                      aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
 
     def tearDown(self):
         print('tearDown')
         # Ensure test bucket from previous test is deleted
-        self.delete_bucket(self.master_session, self.test_bucket_name)
+        self.delete_bucket(self.test_bucket_name)
 
     def test_provision_storage_default_policy(self):
         """
@@ -167,31 +165,16 @@ class TestS3StorageProvisioner(unittest.TestCase):
         except ClientError as err:
             print('Got ClientError writing outside storage_path, as expected: ', err)
 
-    def delete_bucket(self, session: Session, bucket_name: str):
-
-        s3 = session.resource('s3')
-
-        bucket_exists = True
+    def delete_bucket(self, bucket_name: str):
         try:
-            s3.meta.client.head_bucket(Bucket=bucket_name)
-        except botocore.exceptions.ClientError as e:
-            # If a client error is thrown, then check that it was a 404 error.
-            # If it was a 404 error, then the bucket does not exist.
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                bucket_exists = False
-
-        if bucket_exists:
-            bucket = s3.Bucket(bucket_name)
-
-            try:
-                for key in bucket.objects.all():
-                    key.delete()
-
-                bucket.delete()
-                print('Deleted bucket {0}'.format(bucket_name))
-            except ClientError as err:
-                print('Unable to delete bucket:', err)
+            result = S3Cleaner(self.s3_provisioner).delete_bucket(bucket_name)
+        except ClientError as err:
+            print('Unable to delete bucket:', err)
+            return
+        if result.bucket_deleted:
+            print('Deleted bucket {0}'.format(bucket_name))
+        elif result.failed:
+            print('Unable to delete bucket:', result.failed)
 
     if __name__ == '__main__':
         import sys
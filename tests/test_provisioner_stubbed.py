@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_provisioner_stubbed
+----------------------------------
+
+Offline tests for `provisioner` module, using fake keys and botocore's Stubber in place of AWS.
+"""
+import json
+import threading
+import unittest
+import warnings
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from storage_provisioner.provisioner import S3StorageProvisioner, AWSClientPool, ProvisionRequest, \
+    AWS_SINGLE_ATTEMPT_RETRIES
+from storage_provisioner.ratelimit import AdaptiveRateLimiter
+from storage_provisioner.storage import AWSS3Region
+
+
+class TestAWSClientPool(unittest.TestCase):
+    """
+    Offline tests of client pooling. Clients are constructed but never used to make requests.
+    """
+
+    def setUp(self):
+        self.client_pool = AWSClientPool('AKIATEST', 'secret', max_pool_connections=32)
+
+    def test_client_reused_per_region(self):
+        sts = self.client_pool.client('sts', 'us-west-1')
+        self.assertIs(sts, self.client_pool.client('sts', 'us-west-1'))
+        self.assertIsNot(sts, self.client_pool.client('sts', 'us-east-1'))
+        self.assertIsNot(sts, self.client_pool.client('s3', 'us-west-1'))
+        self.assertEqual(sts.meta.region_name, 'us-west-1')
+        self.assertEqual(sts.meta.config.max_pool_connections, 32)
+
+    def test_client_shared_between_threads(self):
+        clients = []
+
+        def get_client():
+            clients.append(self.client_pool.client('s3', 'eu-west-1'))
+
+        threads = [threading.Thread(target=get_client) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(clients), 16)
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+
+    def test_clear(self):
+        s3 = self.client_pool.client('s3', 'us-west-2')
+        self.client_pool.clear()
+        self.assertIsNot(s3, self.client_pool.client('s3', 'us-west-2'))
+
+    def test_service_retries(self):
+        client_pool = AWSClientPool('AKIATEST', 'secret', service_retries={'sts': AWS_SINGLE_ATTEMPT_RETRIES})
+        sts = client_pool.client('sts', 'us-west-1')
+        self.assertEqual(sts.meta.config.retries, AWS_SINGLE_ATTEMPT_RETRIES)
+        self.assertEqual(sts.meta.config.max_pool_connections, client_pool.config.max_pool_connections)
+        self.assertNotIn('total_max_attempts', client_pool.client('s3', 'us-west-1').meta.config.retries)
+
+    def test_rate_limited_sts_single_attempt(self):
+        s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', rate_limiter=AdaptiveRateLimiter())
+        sts = s3_provisioner.client_pool.client('sts', 'us-west-1')
+        self.assertEqual(sts.meta.config.retries['total_max_attempts'], 1)
+
+        sts = S3StorageProvisioner('AKIATEST', 'secret').client_pool.client('sts', 'us-west-1')
+        self.assertNotIn('total_max_attempts', sts.meta.config.retries)
+
+
+class TestS3StorageProvisionerBucketCache(unittest.TestCase):
+    """
+    Offline tests of bucket existence caching, using botocore's Stubber in place of S3.
+    """
+
+    test_bucket_name = 'test-bucket'
+    test_region = AWSS3Region.USWest2
+
+    def setUp(self):
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret')
+        self.s3_stub = Stubber(self.s3_provisioner.client_pool.client('s3', self.test_region.value))
+        self.s3_stub.activate()
+
+    def tearDown(self):
+        self.s3_stub.deactivate()
+
+    def test_existing_bucket_checked_once(self):
+        self.s3_stub.add_response('head_bucket', {}, {'Bucket': self.test_bucket_name})
+
+        for _ in range(3):
+            self.s3_provisioner.create_bucket_if_needed(bucket_name=self.test_bucket_name, region=self.test_region)
+
+        self.s3_stub.assert_no_pending_responses()
+
+    def test_missing_bucket_created_once(self):
+        self.s3_stub.add_client_error('head_bucket', service_error_code='404', http_status_code=404)
+        self.s3_stub.add_response('create_bucket', {})
+
+        for _ in range(3):
+            self.s3_provisioner.create_bucket_if_needed(bucket_name=self.test_bucket_name, region=self.test_region)
+
+        self.s3_stub.assert_no_pending_responses()
+
+    def test_bucket_already_owned_by_you(self):
+        self.s3_stub.add_client_error('head_bucket', service_error_code='404', http_status_code=404)
+        self.s3_stub.add_client_error('create_bucket', service_error_code='BucketAlreadyOwnedByYou',
+                                      http_status_code=409)
+
+        self.s3_provisioner.create_bucket_if_needed(bucket_name=self.test_bucket_name, region=self.test_region)
+
+        self.assertTrue(self.s3_provisioner.bucket_cache.contains(self.test_bucket_name, self.test_region.value))
+
+    def test_invalidate(self):
+        self.s3_stub.add_response('head_bucket', {})
+        self.s3_stub.add_response('head_bucket', {})
+
+        self.s3_provisioner.create_bucket_if_needed(bucket_name=self.test_bucket_name, region=self.test_region)
+        self.s3_provisioner.bucket_cache.invalidate(self.test_bucket_name)
+        self.s3_provisioner.create_bucket_if_needed(bucket_name=self.test_bucket_name, region=self.test_region)
+
+        self.s3_stub.assert_no_pending_responses()
+
+
+class StubbedProvisionerTestCase(unittest.TestCase):
+    """
+    Base for offline tests of provisioning, using botocore's Stubber in place of S3 and STS.
+    """
+
+    test_region = AWSS3Region.USWest2
+
+    def setUp(self):
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', default_region=self.test_region)
+        self.s3_stub = Stubber(self.s3_provisioner.client_pool.client('s3', self.test_region.value))
+        self.sts_stub = Stubber(self.s3_provisioner.client_pool.client('sts', self.test_region.value))
+        self.s3_stub.activate()
+        self.sts_stub.activate()
+
+    def tearDown(self):
+        self.s3_stub.deactivate()
+        self.sts_stub.deactivate()
+
+    def add_federation_token_response(self, user_name: str):
+        self.sts_stub.add_response('get_federation_token', {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:{}'.format(user_name),
+                'Arn': 'arn:aws:sts::123456789012:federated-user/{}'.format(user_name),
+            },
+        })
+
+
+class TestS3StorageProvisionerBatch(StubbedProvisionerTestCase):
+    """
+    Offline tests of provision_storage_many.
+    """
+
+    def test_provision_storage_many(self):
+        # One bucket check per distinct bucket, then one federation token per request
+        self.s3_stub.add_response('head_bucket', {})
+        self.s3_stub.add_response('head_bucket', {})
+        for _ in range(6):
+            self.add_federation_token_response('user')
+
+        requests = [ProvisionRequest('user', 'bucket-{}'.format(i % 2), 'path/{}/'.format(i)) for i in range(5)]
+        requests.append({'user_name': 'user', 'bucket_name': 'bucket-0', 'path': 'path/5/'})
+
+        results = list(self.s3_provisioner.provision_storage_many(requests, max_workers=3, max_pending=2))
+
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(sorted(result.storage.s3_bucket_path for result in results),
+                         ['path/{}/'.format(i) for i in range(6)])
+        for result in results:
+            self.assertEqual(result.storage.s3_bucket_name, result.request.bucket_name)
+        self.s3_stub.assert_no_pending_responses()
+        self.sts_stub.assert_no_pending_responses()
+
+    def test_provision_storage_many_bucket_error(self):
+        self.s3_stub.add_client_error('head_bucket', service_error_code='404', http_status_code=404)
+        self.s3_stub.add_client_error('create_bucket', service_error_code='BucketAlreadyExists',
+                                      http_status_code=409)
+
+        requests = [ProvisionRequest('user', 'taken-bucket', 'path/{}/'.format(i)) for i in range(3)]
+        results = list(self.s3_provisioner.provision_storage_many(requests))
+
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsNone(result.storage)
+            self.assertIsInstance(result.error, ClientError)
+
+    def test_provision_storage_many_malformed_request(self):
+        self.s3_stub.add_response('head_bucket', {})
+        self.add_federation_token_response('user')
+
+        malformed = {'user_name': 'user', 'bucket': 'bucket-0'}
+        requests = [malformed, ProvisionRequest('user', 'bucket-0', 'path/', region='us-west-2'),
+                    ProvisionRequest('user', 'bucket-0', 'path/', region='nowhere-1')]
+        results = list(self.s3_provisioner.provision_storage_many(requests))
+
+        self.assertEqual(len(results), 3)
+        errors = {type(result.error) for result in results if result.error is not None}
+        self.assertEqual(errors, {TypeError, ValueError})
+        self.assertIs(results[0].request, malformed)
+        storage, = [result.storage for result in results if result.storage is not None]
+        self.assertEqual(storage.s3_bucket_region, 'us-west-2')
+        self.sts_stub.assert_no_pending_responses()
+
+
+class TestS3StorageProvisionerForPaths(StubbedProvisionerTestCase):
+    """
+    Offline tests of provision_storage_for_paths.
+    """
+
+    def test_provision_storage_for_paths(self):
+        # One bucket check per distinct bucket, then one federation token for every path
+        self.s3_stub.add_response('head_bucket', {})
+        self.s3_stub.add_response('head_bucket', {})
+        self.add_federation_token_response('user')
+
+        grants = [('bucket-0', 'uploads/user/'), ('bucket-0', 'thumbnails/user/'), ('bucket-1', 'assets/')]
+        storages = self.s3_provisioner.provision_storage_for_paths('user', grants)
+
+        self.assertEqual([(storage.s3_bucket_name, storage.s3_bucket_path) for storage in storages], grants)
+        self.assertEqual(len({storage.aws_access_key_id for storage in storages}), 1)
+        resources = json.loads(storages[0].aws_policy)['Statement'][0]['Resource']
+        self.assertEqual(resources, ['arn:aws:s3:::bucket-0/uploads/user/*', 'arn:aws:s3:::bucket-0/thumbnails/user/*',
+                                     'arn:aws:s3:::bucket-1/assets/*'])
+        self.s3_stub.assert_no_pending_responses()
+        self.sts_stub.assert_no_pending_responses()
+
+    def test_grant_region_name(self):
+        for _ in range(3):
+            self.s3_stub.add_response('head_bucket', {})
+        self.add_federation_token_response('user')
+
+        grants = [('bucket-0', 'uploads/user/', self.test_region.value),
+                  ('bucket-1', 'assets/', self.test_region),
+                  ('bucket-2', 'shared/', self.test_region.name)]
+        storages = self.s3_provisioner.provision_storage_for_paths('user', grants)
+
+        self.assertEqual([storage.s3_bucket_region for storage in storages], [self.test_region.value] * 3)
+        self.assertTrue(self.s3_provisioner.bucket_cache.contains('bucket-0', self.test_region.value))
+        self.s3_stub.assert_no_pending_responses()
+
+    def test_no_grants(self):
+        with self.assertRaises(ValueError):
+            self.s3_provisioner.provision_storage_for_paths('user', [])
+
+    def test_unknown_grant_region(self):
+        with self.assertRaises(ValueError):
+            self.s3_provisioner.provision_storage_for_paths('user', [('bucket', 'path/', 'mars-north-1')])
+
+
+class TestS3StorageProvisionerSession(unittest.TestCase):
+
+    def test_session_argument_deprecated(self):
+        s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret')
+        s3_provisioner.bucket_cache.add('bucket', AWSS3Region.USWest2.value)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            s3_provisioner.create_bucket_if_needed(bucket_name='bucket', region=AWSS3Region.USWest2, session=object())
+            # As called before clients were pooled, with the session first
+            s3_provisioner.create_bucket_if_needed(object(), 'bucket', AWSS3Region.USWest2)
+        self.assertEqual([warning.category for warning in caught], [DeprecationWarning] * 2)
+
+    def test_session_argument_positional(self):
+        s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret')
+        sts_stub = Stubber(s3_provisioner.client_pool.client('sts', s3_provisioner.default_region.value))
+        federated_user = {'FederatedUserId': '123456789012:user',
+                          'Arn': 'arn:aws:sts::123456789012:federated-user/user'}
+        sts_stub.add_response('get_federation_token', {'FederatedUser': federated_user},
+                              {'Name': 'user', 'Policy': '{}', 'DurationSeconds': 900})
+        with sts_stub, warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            s3_provisioner.create_federation_token(object(), 'user', '{}', 900)
+        sts_stub.assert_no_pending_responses()
+
+        with self.assertRaises(TypeError):
+            s3_provisioner.create_federation_token(user_name='user')
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_ratelimit
+----------------------------------
+
+Tests for `ratelimit` module.
+"""
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.ratelimit import AdaptiveRateLimiter, RateLimitExceededError, is_throttling_error
+from storage_provisioner.storage import AWSS3Region
+
+
+def throttling_error() -> ClientError:
+    return ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'GetFederationToken')
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+
+    def test_burst_then_paced(self):
+        limiter = AdaptiveRateLimiter(rate=100.0, burst=2)
+        self.assertEqual(limiter.acquire(), 0.0)
+        self.assertEqual(limiter.acquire(), 0.0)
+        self.assertGreater(limiter.acquire(), 0.0)
+
+    def test_concurrent_callers_paced(self):
+        limiter = AdaptiveRateLimiter(rate=50.0, burst=1)
+        threads = [threading.Thread(target=limiter.acquire) for _ in range(5)]
+
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The first caller takes the burst token, the rest wait 1 / 50 s each in turn
+        self.assertGreaterEqual(time.monotonic() - start, 0.07)
+
+    def test_bounded_wait_queue(self):
+        limiter = AdaptiveRateLimiter(rate=5.0, burst=1, max_waiters=1)
+        limiter.acquire()
+
+        waiter = threading.Thread(target=limiter.acquire)
+        waiter.start()
+        time.sleep(0.05)
+        with self.assertRaises(RateLimitExceededError):
+            limiter.acquire()
+        waiter.join()
+        self.assertEqual(limiter.rejections, 1)
+
+    def test_max_wait(self):
+        limiter = AdaptiveRateLimiter(rate=1.0, burst=1)
+        limiter.acquire()
+        with self.assertRaises(RateLimitExceededError):
+            limiter.acquire(max_wait_sec=0.1)
+
+    def test_throttle_decreases_rate_once_per_interval(self):
+        limiter = AdaptiveRateLimiter(rate=8.0, min_rate=1.0, decrease_interval_sec=60)
+        limiter.on_throttle()
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 4.0)
+        self.assertEqual(limiter.throttles, 2)
+
+    def test_success_increases_rate(self):
+        limiter = AdaptiveRateLimiter(rate=1.0, max_rate=1.5, increase_per_sec=1.0)
+        limiter.on_success()
+        limiter.on_success()
+        self.assertEqual(limiter.rate, 1.5)
+
+    def test_call_retries_throttling(self):
+        limiter = AdaptiveRateLimiter(rate=1000.0, backoff_base_sec=0.001)
+        errors = [throttling_error(), throttling_error()]
+
+        def fn(value):
+            if errors:
+                raise errors.pop()
+            return value
+
+        self.assertEqual(limiter.call(fn, 'ok'), 'ok')
+        self.assertEqual(limiter.throttles, 2)
+
+    def test_call_gives_up(self):
+        limiter = AdaptiveRateLimiter(rate=1000.0, max_attempts=2, backoff_base_sec=0.001)
+        calls = []
+
+        def fn():
+            calls.append(1)
+            raise throttling_error()
+
+        with self.assertRaises(ClientError):
+            limiter.call(fn)
+        self.assertEqual(len(calls), 2)
+
+    def test_call_retries_server_errors(self):
+        limiter = AdaptiveRateLimiter(rate=50.0, backoff_base_sec=0.001)
+        rate = limiter.rate
+        errors = [ClientError({'Error': {'Code': 'InternalError'}, 'ResponseMetadata': {'HTTPStatusCode': 500}},
+                              'GetFederationToken'),
+                  EndpointConnectionError(endpoint_url='https://sts.us-west-2.amazonaws.com')]
+
+        def fn():
+            if errors:
+                raise errors.pop()
+            return 'ok'
+
+        self.assertEqual(limiter.call(fn), 'ok')
+        self.assertEqual((limiter.server_errors, limiter.throttles), (2, 0))
+        self.assertGreaterEqual(limiter.rate, rate)
+
+    def test_call_raises_other_errors(self):
+        limiter = AdaptiveRateLimiter()
+        error = ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetFederationToken')
+        self.assertFalse(is_throttling_error(error))
+
+        def fn():
+            raise error
+
+        with self.assertRaises(ClientError):
+            limiter.call(fn)
+        self.assertEqual(limiter.throttles, 0)
+
+    def test_backoff_bounds(self):
+        limiter = AdaptiveRateLimiter(backoff_base_sec=0.1, backoff_max_sec=0.3)
+        for attempt in range(1, 6):
+            backoff_sec = limiter.backoff_sec(attempt)
+            self.assertGreaterEqual(backoff_sec, 0.0)
+            self.assertLessEqual(backoff_sec, min(0.3, 0.1 * 2 ** (attempt - 1)))
+
+
+class TestS3StorageProvisionerRateLimit(unittest.TestCase):
+    """
+    Offline tests of rate limited federation tokens, using botocore's Stubber in place of STS.
+    """
+
+    test_region = AWSS3Region.USWest2
+
+    def setUp(self):
+        self.rate_limiter = AdaptiveRateLimiter(rate=1000.0, backoff_base_sec=0.001)
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', default_region=self.test_region,
+                                                   rate_limiter=self.rate_limiter)
+        self.s3_provisioner.bucket_cache.add('test-bucket', self.test_region.value)
+        self.sts_stub = Stubber(self.s3_provisioner.client_pool.client('sts', self.test_region.value))
+        self.sts_stub.activate()
+
+    def tearDown(self):
+        self.sts_stub.deactivate()
+
+    @staticmethod
+    def federation_token_response() -> dict:
+        return {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:user',
+                'Arn': 'arn:aws:sts::123456789012:federated-user/user',
+            },
+        }
+
+    def test_throttled_federation_token_retried(self):
+        self.sts_stub.add_client_error('get_federation_token', service_error_code='Throttling',
+                                       http_status_code=400)
+        self.sts_stub.add_response('get_federation_token', self.federation_token_response())
+
+        storage = self.s3_provisioner.provision_storage('user', 'test-bucket', 'path/')
+
+        self.assertEqual(storage.aws_access_key_id, 'ASIA' + 'X' * 16)
+        self.assertEqual(self.rate_limiter.throttles, 1)
+        self.sts_stub.assert_no_pending_responses()
+
+    def test_failed_federation_token_retried(self):
+        # botocore makes one attempt, so the limiter retries the server error
+        self.sts_stub.add_client_error('get_federation_token', service_error_code='ServiceUnavailable',
+                                       http_status_code=503)
+        self.sts_stub.add_response('get_federation_token', self.federation_token_response())
+
+        storage = self.s3_provisioner.provision_storage('user', 'test-bucket', 'path/')
+
+        self.assertEqual(storage.aws_access_key_id, 'ASIA' + 'X' * 16)
+        self.assertEqual(self.rate_limiter.server_errors, 1)
+        self.sts_stub.assert_no_pending_responses()
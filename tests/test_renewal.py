@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_renewal
+----------------------------------
+
+Tests for `renewal` module.
+"""
+import threading
+import time
+import unittest
+
+from storage_provisioner.renewal import RenewalScheduler
+from storage_provisioner.storage import AWSS3Region
+from tests.helpers import make_storage
+
+
+class RecordingProvisioner(object):
+    """
+    Stands in for S3StorageProvisioner.provision_new_storage, minting storages valid for :param lifetime_sec.
+    """
+
+    def __init__(self, lifetime_sec: float = 3600, errors: list = None):
+        self.lifetime_sec = lifetime_sec
+        self.errors = list(errors or ())
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def provision_new_storage(self, user_name, bucket_name, path, region, user_policy, duration_sec,
+                              check_bucket=True):
+        with self._lock:
+            self.calls.append((user_name, bucket_name, path, region, user_policy, duration_sec, check_bucket))
+            if self.errors:
+                raise self.errors.pop(0)
+            return make_storage(self.lifetime_sec, 'ASIA{}'.format(len(self.calls)), path)
+
+
+class TestRenewalScheduler(unittest.TestCase):
+
+    def test_renews_within_margin(self):
+        provisioner = RecordingProvisioner()
+        scheduler = RenewalScheduler(provisioner, margin_sec=600, jitter_sec=0)
+        renewed = []
+        handle = scheduler.watch(make_storage(300), callback=lambda h, storage: renewed.append(storage))
+        scheduler.watch(make_storage(3600, path='other/'))
+
+        # The margin is capped at half the 300s remaining
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 151), 1)
+        self.assertEqual(provisioner.calls, [('user', 'bucket', 'path/', AWSS3Region.USWest1, 'policy', 129600,
+                                              False)])
+        self.assertIs(handle.storage, renewed[0])
+        self.assertEqual(handle.storage.aws_access_key_id, 'ASIA1')
+
+        # The renewed storage is good for an hour, so it isn't due again yet
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 3000), 2)
+
+    def test_jitter_spreads_renewals(self):
+        scheduler = RenewalScheduler(RecordingProvisioner(), margin_sec=600, jitter_sec=300)
+        handles = [scheduler.watch(make_storage(3600)) for _ in range(100)]
+        renew_ats = [handle.renew_at - time.monotonic() for handle in handles]
+        self.assertGreater(max(renew_ats) - min(renew_ats), 100)
+        for renew_at in renew_ats:
+            self.assertGreater(renew_at, 3600 - 600 - 300 - 1)
+            self.assertLess(renew_at, 3600 - 600 + 1)
+
+    def test_short_lived_storage(self):
+        provisioner = RecordingProvisioner(lifetime_sec=900)
+        scheduler = RenewalScheduler(provisioner)
+        handle = scheduler.watch(make_storage(300), duration_sec=900)
+
+        # The default margin exceeds the lifetime, so the storage is renewed halfway through it instead
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 151), 1)
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertGreater(handle.renew_at - time.monotonic(), 900 * 0.25 - 1)
+        self.assertLess(handle.renew_at - time.monotonic(), 900 * 0.5 + 1)
+        self.assertEqual(len(provisioner.calls), 1)
+
+    def test_watch_short_lived_storage(self):
+        # Watched with less time left than the requested duration, which would put every margin past expiration
+        scheduler = RenewalScheduler(RecordingProvisioner(), margin_sec=600, jitter_sec=300)
+        handle = scheduler.watch(make_storage(300), duration_sec=3600)
+
+        self.assertGreater(handle.renew_at - time.monotonic(), 300 - 150 - 75 - 1)
+        self.assertLess(handle.renew_at - time.monotonic(), 300 - 150 + 1)
+        self.assertEqual(scheduler.run_pending(), 0)
+
+    def test_min_interval(self):
+        # Storages expire sooner than the margin, however short the requested duration
+        provisioner = RecordingProvisioner(lifetime_sec=5)
+        scheduler = RenewalScheduler(provisioner, min_interval_sec=30)
+        handle = scheduler.watch(make_storage(5))
+
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 3), 1)
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 20), 0)
+        self.assertGreater(handle.renew_at - time.monotonic(), 29)
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 31), 1)
+        self.assertEqual(len(provisioner.calls), 2)
+
+    def test_unwatch(self):
+        provisioner = RecordingProvisioner()
+        scheduler = RenewalScheduler(provisioner, margin_sec=600)
+        handle = scheduler.watch(make_storage(300))
+        scheduler.unwatch(handle)
+
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertEqual(provisioner.calls, [])
+
+    def test_failed_renewal_retried(self):
+        provisioner = RecordingProvisioner(errors=[RuntimeError('throttled')])
+        scheduler = RenewalScheduler(provisioner, margin_sec=600, jitter_sec=0, retry_sec=10)
+        errors = []
+        scheduler.subscribe(lambda h, storage: None, on_error=lambda h, error: errors.append(error))
+        handle = scheduler.watch(make_storage(300, 'ASIAOLD'))
+
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 151), 1)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(handle.failures, 1)
+        self.assertEqual(handle.storage.aws_access_key_id, 'ASIAOLD')
+
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertEqual(scheduler.run_pending(time.monotonic() + 11), 1)
+        self.assertEqual(handle.failures, 0)
+        self.assertEqual(handle.storage.aws_access_key_id, 'ASIA2')
+
+    def test_background_thread(self):
+        provisioner = RecordingProvisioner()
+        scheduler = RenewalScheduler(provisioner, margin_sec=600, jitter_sec=0)
+        renewed = threading.Event()
+        scheduler.subscribe(lambda h, storage: renewed.set())
+        scheduler.start()
+        try:
+            scheduler.watch(make_storage(3600))
+            scheduler.watch(make_storage(1))
+            self.assertTrue(renewed.wait(5))
+        finally:
+            scheduler.stop()
+        self.assertEqual(len(provisioner.calls), 1)
+
+    def test_many_handles(self):
+        scheduler = RenewalScheduler(RecordingProvisioner(), margin_sec=600)
+        start = time.perf_counter()
+        for i in range(100000):
+            scheduler.watch(make_storage(3600 + i % 1000))
+        self.assertEqual(len(scheduler), 100000)
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(scheduler.run_pending(), 0)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_serialization
+----------------------------------
+
+Tests for `S3Storage` serialization, using fake keys.
+"""
+import pickle
+import unittest
+from datetime import datetime, timezone
+
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+
+class TestS3StorageSerialization(unittest.TestCase):
+
+    S3_BUCKET_NAME = 'MrBucket'
+    S3_BUCKET_REGION = AWSS3Region.APSouthEast1
+    S3_BUCKET_PATH = 'path/to/'
+    AWS_ACCESS_KEY_ID = 'ASIATEST'
+    AWS_SECRET_ACCESS_KEY = 'secret'
+    AWS_SESSION_TOKEN = 'TOKE_SESSION'
+    AWS_FEDERATED_USER_ID = 'FED_USER_ID'
+    AWS_ARN = 'ARN'
+
+    def make_storage(self, aws_expiration: datetime, region=None) -> S3Storage:
+        return S3Storage(self.S3_BUCKET_NAME,
+                         region if region is not None else self.S3_BUCKET_REGION.value,
+                         self.S3_BUCKET_PATH,
+                         self.AWS_ACCESS_KEY_ID,
+                         self.AWS_SECRET_ACCESS_KEY,
+                         self.AWS_SESSION_TOKEN,
+                         aws_expiration,
+                         self.AWS_FEDERATED_USER_ID,
+                         self.AWS_ARN,
+                         ''.join(['pol', 'icy']))
+
+    def round_trips(self, storage: S3Storage) -> tuple:
+        return (S3Storage.from_dict(storage.to_dict()),
+                S3Storage.from_bytes(storage.to_bytes()),
+                pickle.loads(pickle.dumps(storage)))
+
+    def assert_storages_equal(self, storage: S3Storage, other: S3Storage):
+        for attr in S3Storage.__slots__:
+            self.assertEqual(getattr(storage, attr), getattr(other, attr), attr)
+
+    def test_policy_interned(self):
+        self.assertIs(self.make_storage(None).aws_policy, self.make_storage(None).aws_policy)
+
+    def test_serialization_round_trip(self):
+        storage = self.make_storage(datetime(2026, 10, 17, 12, 30, 15, 250, tzinfo=timezone.utc))
+
+        for restored in self.round_trips(storage):
+            self.assert_storages_equal(storage, restored)
+            self.assertIsNotNone(restored.aws_expiration.tzinfo)
+
+        self.assertLess(len(storage.to_bytes()), len(pickle.dumps(storage.to_dict())))
+
+    def test_serialization_naive_expiration_and_none_fields(self):
+        storage = self.make_storage(datetime(2026, 10, 17, 12, 30, 15))
+        storage.s3_bucket_path = None
+        storage.aws_policy = None
+
+        restored = S3Storage.from_bytes(storage.to_bytes())
+        self.assertIsNone(restored.s3_bucket_path)
+        self.assertIsNone(restored.aws_policy)
+        self.assertEqual(restored.aws_expiration, datetime(2026, 10, 17, 12, 30, 15, tzinfo=timezone.utc))
+
+    def test_serialization_no_expiration(self):
+        for restored in self.round_trips(self.make_storage(None)):
+            self.assertIsNone(restored.aws_expiration)
+
+    def test_serialization_region_enum(self):
+        storage = self.make_storage(datetime.now(timezone.utc), region=self.S3_BUCKET_REGION)
+        self.assertEqual(storage.to_dict()['region'], self.S3_BUCKET_REGION.value)
+
+        for restored in self.round_trips(storage):
+            self.assertIs(restored.s3_bucket_region, self.S3_BUCKET_REGION)
+
+        # A region given as a string stays a string
+        for restored in self.round_trips(self.make_storage(datetime.now(timezone.utc))):
+            self.assertEqual(restored.s3_bucket_region, self.S3_BUCKET_REGION.value)
+
+    def test_serialization_version_checked(self):
+        storage = self.make_storage(datetime.now(timezone.utc))
+        for version in (0, 1):
+            serialized = storage.to_dict()
+            serialized['v'] = version
+            with self.assertRaises(ValueError):
+                S3Storage.from_dict(serialized)
+
+            data = bytes([version]) + storage.to_bytes()[1:]
+            with self.assertRaises(ValueError):
+                S3Storage.from_bytes(data)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
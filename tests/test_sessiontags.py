@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sessiontags
+----------------------------------
+
+Tests for `sessiontags` module.
+"""
+import json
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from storage_provisioner.cache import BucketCache, CredentialCache
+from storage_provisioner.instrumentation import Instrumentation
+from storage_provisioner.sessiontags import TaggedRoleS3StorageProvisioner, render_session_tag_role_policy, \
+    render_session_tag_trust_policy, role_session_name, validate_tag_value
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/storage-tenant'
+
+
+class FakeSTSClient(object):
+    """
+    Answers assume_role like STS, recording each request.
+    """
+
+    def __init__(self, delay_sec: float = 0.0):
+        self.delay_sec = delay_sec
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def assume_role(self, **kwargs) -> dict:
+        with self._lock:
+            self.requests.append(kwargs)
+            count = len(self.requests)
+        time.sleep(self.delay_sec)
+        return {
+            'Credentials': {
+                'AccessKeyId': 'ASIATEST{}'.format(count),
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(seconds=kwargs['DurationSeconds']),
+            },
+            'AssumedRoleUser': {
+                'AssumedRoleId': 'AROATEST:' + kwargs['RoleSessionName'],
+                'Arn': 'arn:aws:sts::123456789012:assumed-role/storage-tenant/' + kwargs['RoleSessionName'],
+            },
+            'PackedPolicySize': 6,
+            'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0},
+        }
+
+
+class FakeClientPool(object):
+
+    def __init__(self, client):
+        self.clients = {}
+        self._client = client
+
+    def client(self, service_name: str, region_name: str):
+        self.clients[(service_name, region_name)] = self._client
+        return self._client
+
+
+class FakeProvisioner(object):
+    """
+    Stands in for S3StorageProvisioner, handing out one STS client and recording bucket checks.
+    """
+
+    def __init__(self, client, credential_cache: CredentialCache = None, coalesce_requests: bool = True):
+        self.default_region = AWSS3Region.USWest1
+        self.client_pool = FakeClientPool(client)
+        self.bucket_cache = BucketCache()
+        self.credential_cache = credential_cache
+        self.coalesce_requests = coalesce_requests
+        self.instrumentation = Instrumentation()
+        self.rate_limiter = None
+        self.bucket_checks = []
+
+    def create_bucket_if_needed(self, bucket_name: str, region: AWSS3Region):
+        self.bucket_checks.append((bucket_name, region.value))
+
+
+class TestTaggedRoleS3StorageProvisioner(unittest.TestCase):
+
+    def setUp(self):
+        self.sts = FakeSTSClient()
+        self.provisioner = FakeProvisioner(self.sts)
+        self.tagged = TaggedRoleS3StorageProvisioner(self.provisioner, ROLE_ARN)
+
+    def test_provision_storage(self):
+        storage = self.tagged.provision_storage('user', 'bucket', 'live/stream/', duration_sec=900)
+
+        self.assertIsInstance(storage, S3Storage)
+        self.assertEqual((storage.s3_bucket_name, storage.s3_bucket_region, storage.s3_bucket_path),
+                         ('bucket', 'us-west-1', 'live/stream/'))
+        self.assertEqual(storage.aws_access_key_id, 'ASIATEST1')
+        self.assertEqual(storage.aws_federated_user_id, 'AROATEST:user')
+        self.assertIsNone(storage.aws_policy)
+        self.assertEqual(self.provisioner.bucket_checks, [('bucket', 'us-west-1')])
+        self.assertEqual(self.provisioner.client_pool.clients, {('sts', 'us-west-1'): self.sts})
+
+        request, = self.sts.requests
+        self.assertEqual(request, {
+            'RoleArn': ROLE_ARN,
+            'RoleSessionName': 'user',
+            'DurationSeconds': 900,
+            'Tags': [{'Key': 'storage-bucket', 'Value': 'bucket'}, {'Key': 'storage-path', 'Value': 'live/stream/'}],
+        })
+        self.assertNotIn('Policy', request)
+
+    def test_storage_roundtrips(self):
+        storage = self.tagged.provision_storage('user', 'bucket', 'live/stream/', region=AWSS3Region.USEast1)
+        self.assertEqual(S3Storage.from_bytes(storage.to_bytes()).to_dict(), storage.to_dict())
+
+    def test_external_id_and_tag_keys(self):
+        tagged = TaggedRoleS3StorageProvisioner(self.provisioner, ROLE_ARN, bucket_tag_key='b', path_tag_key='p',
+                                                external_id='tenant-external-id')
+        tagged.provision_storage('user', 'bucket')
+
+        request, = self.sts.requests
+        self.assertEqual(request['ExternalId'], 'tenant-external-id')
+        self.assertEqual(request['Tags'], [{'Key': 'b', 'Value': 'bucket'}, {'Key': 'p', 'Value': ''}])
+
+    def test_credential_cache(self):
+        provisioner = FakeProvisioner(self.sts, credential_cache=CredentialCache())
+        tagged = TaggedRoleS3StorageProvisioner(provisioner, ROLE_ARN)
+
+        first = tagged.provision_storage('user', 'bucket', 'a/')
+        self.assertIs(tagged.provision_storage('user', 'bucket', 'a/'), first)
+        self.assertIsNot(tagged.provision_storage('user', 'bucket', 'b/'), first)
+        self.assertEqual(len(self.sts.requests), 2)
+
+    def test_credential_cache_key_includes_tags(self):
+        provisioner = FakeProvisioner(self.sts, credential_cache=CredentialCache())
+        tagged = TaggedRoleS3StorageProvisioner(provisioner, ROLE_ARN)
+        retagged = TaggedRoleS3StorageProvisioner(provisioner, ROLE_ARN, bucket_tag_key='b', path_tag_key='p')
+        external = TaggedRoleS3StorageProvisioner(provisioner, ROLE_ARN, external_id='tenant-external-id')
+
+        storages = [wrapper.provision_storage('user', 'bucket', 'a/') for wrapper in (tagged, retagged, external)]
+        self.assertEqual(len({storage.aws_access_key_id for storage in storages}), 3)
+        self.assertIs(retagged.provision_storage('user', 'bucket', 'a/'), storages[1])
+        self.assertEqual(len(self.sts.requests), 3)
+
+    def test_concurrent_requests_are_coalesced(self):
+        self.sts.delay_sec = 0.2
+        storages = []
+        threads = [threading.Thread(target=lambda: storages.append(
+            self.tagged.provision_storage('user', 'bucket', 'a/'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(storages), 8)
+        self.assertEqual(len(self.sts.requests), 1)
+
+    def test_provision_new_storage_for_renewal(self):
+        storage = self.tagged.provision_new_storage('user', 'bucket', 'a/', AWSS3Region.USEast1, 'ignored',
+                                                    duration_sec=1800, check_bucket=False)
+        self.assertEqual(storage.s3_bucket_region, 'us-east-1')
+        self.assertEqual(self.provisioner.bucket_checks, [])
+        self.assertEqual(self.sts.requests[0]['DurationSeconds'], 1800)
+
+    def test_invalid_tag_values(self):
+        with self.assertRaises(ValueError):
+            self.tagged.provision_storage('user', 'bucket', 'a' * 257)
+        with self.assertRaises(ValueError):
+            self.tagged.provision_storage('user', 'bucket', 'streams/{id}/')
+        self.assertEqual(self.sts.requests, [])
+
+
+class TestSessionTagPolicies(unittest.TestCase):
+
+    def test_role_policy(self):
+        policy = json.loads(render_session_tag_role_policy())
+        objects, listing, location = policy['Statement']
+        self.assertEqual(objects['Resource'],
+                         'arn:aws:s3:::${aws:PrincipalTag/storage-bucket}/${aws:PrincipalTag/storage-path}*')
+        self.assertEqual(listing['Condition'], {'StringLike': {'s3:prefix': '${aws:PrincipalTag/storage-path}*'}})
+        self.assertEqual(location['Resource'], 'arn:aws:s3:::${aws:PrincipalTag/storage-bucket}')
+
+        self.assertNotIn('s3:ListAllMyBuckets', json.dumps(policy))
+        self.assertIn('s3:ListMultipartUploadParts', objects['Action'])
+        self.assertIn('s3:AbortMultipartUpload', objects['Action'])
+
+        policy = render_session_tag_role_policy('b', 'p')
+        self.assertIn('${aws:PrincipalTag/b}/${aws:PrincipalTag/p}*', policy)
+        self.assertNotIn(' ', policy)
+
+    def test_trust_policy(self):
+        statement, = json.loads(render_session_tag_trust_policy('arn:aws:iam::123456789012:user/provisioner'))[
+            'Statement']
+        self.assertEqual(statement['Principal'], {'AWS': 'arn:aws:iam::123456789012:user/provisioner'})
+        self.assertEqual(statement['Action'], ['sts:AssumeRole', 'sts:TagSession'])
+
+    def test_validate_tag_value(self):
+        validate_tag_value('')
+        validate_tag_value('live/stream-1/a_b.c:d=e+f@g h')
+        validate_tag_value('a' * 256)
+        for value in ('a' * 257, 'a*', 'a${b}', 'a\n'):
+            with self.assertRaises(ValueError):
+                validate_tag_value(value)
+
+    def test_role_session_name(self):
+        self.assertEqual(role_session_name('user@example.com'), 'user@example.com')
+        self.assertEqual(role_session_name('a b/c'), 'a-b-c')
+        self.assertEqual(role_session_name('a'), 'a-')
+        self.assertEqual(len(role_session_name('u' * 100)), 64)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
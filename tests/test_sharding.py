@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sharding
+----------------------------------
+
+Tests for `sharding` module.
+"""
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from botocore.stub import Stubber
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.sharding import HashRing, ShardedS3StorageProvisioner, hash_prefix
+from storage_provisioner.storage import AWSS3Region
+
+PATHS = ['streams/{}/'.format(i) for i in range(10000)]
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_even_spread(self):
+        ring = HashRing(['bucket-{}'.format(i) for i in range(4)])
+        counts = Counter(ring.node_for(path) for path in PATHS)
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertAlmostEqual(count / len(PATHS), 0.25, delta=0.05)
+
+    def test_adding_node_moves_few_keys(self):
+        ring = HashRing(['bucket-{}'.format(i) for i in range(4)])
+        before = {path: ring.node_for(path) for path in PATHS}
+        ring.add_node('bucket-4')
+
+        moved = [path for path in PATHS if ring.node_for(path) != before[path]]
+        # About 1/5 of paths move, all of them to the new bucket
+        self.assertLess(len(moved) / len(PATHS), 0.3)
+        self.assertEqual(set(ring.node_for(path) for path in moved), {'bucket-4'})
+
+    def test_weights(self):
+        ring = HashRing([('big', 3), 'small'])
+        counts = Counter(ring.node_for(path) for path in PATHS)
+        self.assertAlmostEqual(counts['big'] / len(PATHS), 0.75, delta=0.07)
+
+    def test_remove_node(self):
+        ring = HashRing(['a', 'b'])
+        ring.remove_node('a')
+        self.assertEqual(ring.nodes, ['b'])
+        self.assertEqual(ring.node_for('path'), 'b')
+
+        ring.remove_node('b')
+        with self.assertRaises(ValueError):
+            ring.node_for('path')
+
+    def test_hash_prefix(self):
+        self.assertEqual(hash_prefix('streams/1/', 4), hash_prefix('streams/1/', 4))
+        self.assertEqual(len(hash_prefix('streams/1/', 3)), 3)
+        self.assertEqual(len(set(hash_prefix(path, 2) for path in PATHS)), 256)
+
+
+class TestShardedS3StorageProvisioner(unittest.TestCase):
+    """
+    Offline tests of sharded provisioning, using botocore's Stubber in place of STS.
+    """
+
+    def setUp(self):
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', default_region=AWSS3Region.USWest2)
+        self.sharded = ShardedS3StorageProvisioner(self.s3_provisioner,
+                                                   ['bucket-a', 'bucket-b'],
+                                                   prefix_length=4,
+                                                   bucket_regions={'bucket-b': AWSS3Region.EUWest1})
+
+    def test_locate(self):
+        bucket_name, physical_path = self.sharded.locate('streams/1/')
+        self.assertIn(bucket_name, ('bucket-a', 'bucket-b'))
+        self.assertEqual(physical_path, hash_prefix('streams/1/', 4) + '/streams/1/')
+        self.assertEqual(self.sharded.locate('streams/1/'), (bucket_name, physical_path))
+
+    def test_provision_storage(self):
+        path = next(path for path in PATHS if self.sharded.locate(path)[0] == 'bucket-b')
+        bucket_name, physical_path = self.sharded.locate(path)
+        self.s3_provisioner.bucket_cache.add(bucket_name, AWSS3Region.EUWest1.value)
+
+        sts_stub = Stubber(self.s3_provisioner.client_pool.client('sts', AWSS3Region.EUWest1.value))
+        sts_stub.add_response('get_federation_token', {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:user',
+                'Arn': 'arn:aws:sts::123456789012:federated-user/user',
+            },
+        }, {'Name': 'user', 'Policy': self.s3_provisioner.default_policy.render(bucket_name, physical_path),
+            'DurationSeconds': 129600})
+
+        with sts_stub:
+            storage = self.sharded.provision_storage('user', path)
+
+        self.assertEqual(storage.s3_bucket_name, 'bucket-b')
+        self.assertEqual(storage.s3_bucket_region, AWSS3Region.EUWest1.value)
+        self.assertEqual(storage.s3_bucket_path, physical_path)
+        self.assertIn('arn:aws:s3:::bucket-b/{}*'.format(physical_path), storage.aws_policy)
+        self.assertEqual(storage.get_url_for_key(physical_path + 'index.m3u8'),
+                         'https://bucket-b.s3.amazonaws.com/{}index.m3u8'.format(physical_path))
+        sts_stub.assert_no_pending_responses()
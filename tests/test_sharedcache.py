@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sharedcache
+----------------------------------
+
+Tests for `sharedcache` module.
+"""
+import multiprocessing
+import os
+import stat
+import tempfile
+import unittest
+
+from storage_provisioner.cache import credential_cache_key
+from storage_provisioner.sharedcache import SharedCredentialCache
+from storage_provisioner.storage import S3Storage
+from tests.helpers import make_storage
+
+
+def provision_in_child(path: str, key: tuple):
+    cache = SharedCredentialCache(path)
+    cache.get(key, lambda: make_storage(3600, 'ASIACHILD'))
+    cache.close()
+
+
+class TestSharedCredentialCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'credentials.db')
+        self.key = credential_cache_key('user', 'policy', 'bucket', 'path/', 'us-west-1', 3600)
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.temp_dir.cleanup()
+
+    def make_cache(self, **kwargs) -> SharedCredentialCache:
+        cache = SharedCredentialCache(self.path, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def test_shared_between_caches(self):
+        first = self.make_cache()
+        second = self.make_cache()
+
+        storage = first.get(self.key, lambda: make_storage(3600, 'ASIAFIRST'))
+        shared = second.get(self.key, lambda: self.fail('loader should not be called'))
+
+        self.assertEqual(shared.aws_access_key_id, storage.aws_access_key_id)
+        self.assertEqual(shared.aws_expiration, storage.aws_expiration)
+
+    def test_shared_between_processes(self):
+        process = multiprocessing.get_context('spawn').Process(target=provision_in_child, args=(self.path, self.key))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+        storage = self.make_cache().get(self.key, lambda: self.fail('loader should not be called'))
+        self.assertEqual(storage.aws_access_key_id, 'ASIACHILD')
+
+    def test_owner_only_permissions(self):
+        self.make_cache()
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_expired_entries_ignored(self):
+        first = self.make_cache()
+        second = self.make_cache()
+        first.put(self.key, make_storage(-10, 'ASIAEXPIRED'))
+
+        storage = second.get(self.key, lambda: make_storage(3600, 'ASIANEW'))
+        self.assertEqual(storage.aws_access_key_id, 'ASIANEW')
+
+    def test_fresher_entry_kept(self):
+        first = self.make_cache()
+        first.put(self.key, make_storage(3600, 'ASIAFRESH'))
+        first.put(self.key, make_storage(1200, 'ASIASTALE'))
+
+        self.assertEqual(self.make_cache().peek(self.key).aws_access_key_id, 'ASIAFRESH')
+
+    def test_refreshed_by_other_process(self):
+        first = self.make_cache(refresh_ahead_sec=1800)
+        second = self.make_cache(refresh_ahead_sec=1800)
+        first.put(self.key, make_storage(1000, 'ASIAOLD'))
+        self.assertEqual(second.peek(self.key).aws_access_key_id, 'ASIAOLD')
+
+        # first refreshes; second's copy is due for refresh, so it checks the database before minting its own
+        first.put(self.key, make_storage(3600, 'ASIANEW'))
+        storage = second.get(self.key, lambda: self.fail('loader should not be called'))
+        self.assertEqual(storage.aws_access_key_id, 'ASIANEW')
+
+    def test_short_lived_entry_not_refreshed_on_every_hit(self):
+        key = credential_cache_key('user', 'policy', 'bucket', 'path/', 'us-west-1', 900)
+        loads = []
+
+        def loader() -> S3Storage:
+            loads.append(1)
+            return make_storage(900)
+
+        first = self.make_cache()
+        second = self.make_cache()
+        for _ in range(100):
+            first.get(key, loader)
+            second.get(key, loader)
+        first.close()
+        second.close()
+        self.assertEqual(len(loads), 1)
+
+    def test_purge(self):
+        cache = self.make_cache(min_remaining_sec=300, max_shared_size=2)
+        for i, seconds_remaining in enumerate((100, 1000, 2000, 3000)):
+            key = credential_cache_key('user', 'policy', 'bucket', 'path/{}/'.format(i), 'us-west-1', 3600)
+            cache.put(key, make_storage(seconds_remaining, 'ASIA{}'.format(i)))
+        self.assertEqual(cache.shared_len(), 4)
+
+        # One storage too close to expiring, then the one expiring soonest beyond max_shared_size
+        self.assertEqual(cache.purge(), 2)
+        self.assertEqual(cache.shared_len(), 2)
+
+    def test_invalidate(self):
+        first = self.make_cache()
+        second = self.make_cache()
+        first.put(self.key, make_storage(3600))
+
+        first.invalidate(self.key)
+        self.assertIsNone(second.peek(self.key))
+
+        first.put(self.key, make_storage(3600))
+        first.invalidate()
+        self.assertEqual(first.shared_len(), 0)
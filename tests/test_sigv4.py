@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sigv4
+----------------------------------
+
+Tests for `sigv4` module.
+"""
+import unittest
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qsl
+
+from boto3.session import Session
+from botocore.config import Config
+from storage_provisioner.sigv4 import S3Presigner, signing_key
+from storage_provisioner.storage import S3Storage, AWSS3Region
+
+
+class TestS3Presigner(unittest.TestCase):
+    """
+    Checks presigned URLs against those generated by botocore for the same credentials and time.
+
+    botocore's choice of endpoint varies between versions, so the oracle is given the regional endpoint and
+    addressing style explicitly, and the host is also checked against one built here.
+    """
+
+    test_region = AWSS3Region.USWest2
+    test_access_key_id = 'ASIA' + 'X' * 16
+    test_secret_access_key = 'secret/with+special='
+    test_session_token = 'token/with+special='
+
+    def setUp(self):
+        self.session = Session(aws_access_key_id=self.test_access_key_id,
+                               aws_secret_access_key=self.test_secret_access_key,
+                               aws_session_token=self.test_session_token,
+                               region_name=self.test_region.value)
+
+    def assert_matches_botocore(self, bucket_name: str, key: str, method: str):
+        regional_host = 's3.{}.amazonaws.com'.format(self.test_region.value)
+        if '.' in bucket_name:
+            addressing_style, expected_host = 'path', regional_host
+        else:
+            addressing_style, expected_host = 'virtual', '{}.{}'.format(bucket_name, regional_host)
+        s3 = self.session.client('s3',
+                                 endpoint_url='https://' + regional_host,
+                                 config=Config(signature_version='s3v4', s3={'addressing_style': addressing_style}))
+
+        operation_name = {'GET': 'get_object', 'PUT': 'put_object'}[method]
+        expected = s3.generate_presigned_url(operation_name,
+                                             Params={'Bucket': bucket_name, 'Key': key},
+                                             ExpiresIn=900)
+        expected_query = dict(parse_qsl(urlsplit(expected).query))
+        now = datetime.strptime(expected_query['X-Amz-Date'], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+
+        url = S3Presigner(bucket_name,
+                          self.test_region.value,
+                          self.test_access_key_id,
+                          self.test_secret_access_key,
+                          self.test_session_token,
+                          expires_sec=900,
+                          now=now).presign(key, method)
+
+        self.assertEqual(urlsplit(url).netloc, expected_host)
+        self.assertEqual(urlsplit(url)[:3], urlsplit(expected)[:3])
+        self.assertEqual(dict(parse_qsl(urlsplit(url).query)), expected_query)
+
+    def test_get_matches_botocore(self):
+        self.assert_matches_botocore('test-bucket', 'streams/1/segment 00~1+x.ts', 'GET')
+
+    def test_put_matches_botocore(self):
+        self.assert_matches_botocore('test-bucket', 'streams/1/index.m3u8', 'PUT')
+
+    def test_dotted_bucket_path_style(self):
+        self.assert_matches_botocore('test.bucket', 'streams/1/index.m3u8', 'GET')
+
+    def test_invalid_expires(self):
+        for expires_sec in (0, 604801):
+            with self.assertRaises(ValueError):
+                S3Presigner('test-bucket', self.test_region.value, 'AKIA', 'secret', expires_sec=expires_sec)
+
+    def test_signing_key_cached(self):
+        signing_key.cache_clear()
+        presigners = [S3Presigner('test-bucket', self.test_region.value, 'AKIA', 'secret') for _ in range(3)]
+        self.assertEqual(signing_key.cache_info().misses, 1)
+        self.assertEqual(len(set(p.amz_date[:8] for p in presigners)), 1)
+
+
+class TestS3StoragePresignedURLs(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = S3Storage('test-bucket',
+                                 AWSS3Region.USWest2,
+                                 'streams/1/',
+                                 'ASIA' + 'X' * 16,
+                                 'secret',
+                                 'token',
+                                 datetime.now(timezone.utc) + timedelta(hours=1),
+                                 '123456789012:user',
+                                 'arn:aws:sts::123456789012:federated-user/user',
+                                 '{}')
+
+    def test_generate_presigned_url(self):
+        url = self.storage.generate_presigned_url('streams/1/index.m3u8', method='PUT', expires_sec=60)
+        self.assertTrue(url.startswith('https://test-bucket.s3.us-west-2.amazonaws.com/streams/1/index.m3u8?'))
+        query = dict(parse_qsl(urlsplit(url).query))
+        self.assertEqual(query['X-Amz-Expires'], '60')
+        self.assertEqual(query['X-Amz-Security-Token'], 'token')
+
+    def test_generate_presigned_urls(self):
+        keys = ['streams/1/segment{}.ts'.format(i) for i in range(100)]
+        urls = list(self.storage.generate_presigned_urls(keys))
+        self.assertEqual(len(set(urls)), len(keys))
+        for key, url in zip(keys, urls):
+            self.assertEqual(urlsplit(url).path, '/' + key)
+
+    def test_region_as_string(self):
+        storage = S3Storage.from_dict(self.storage.to_dict())
+        self.assertEqual(storage.generate_presigned_url('key').split('?')[0],
+                         'https://test-bucket.s3.us-west-2.amazonaws.com/key')
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_singleflight
+----------------------------------
+
+Tests for `singleflight` module.
+"""
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from botocore.stub import Stubber
+from storage_provisioner.provisioner import S3StorageProvisioner
+from storage_provisioner.singleflight import SingleFlight, AsyncSingleFlight
+from storage_provisioner.storage import AWSS3Region
+from tests.helpers import AsyncTestCase
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_coalesced(self):
+        single_flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def fn(value):
+            calls.append(value)
+            release.wait()
+            return value
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(single_flight.do, 'key', fn, i) for i in range(8)]
+            time.sleep(0.1)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [calls[0]] * 8)
+        self.assertEqual(len(single_flight), 0)
+
+    def test_error_shared(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+
+        def fn():
+            release.wait()
+            raise KeyError('missing')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(single_flight.do, 'key', fn) for _ in range(4)]
+            time.sleep(0.1)
+            release.set()
+            for future in futures:
+                with self.assertRaises(KeyError):
+                    future.result()
+
+    def test_sequential_calls_not_coalesced(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do('key', lambda: 1), 1)
+        self.assertEqual(single_flight.do('key', lambda: 2), 2)
+
+
+class TestAsyncSingleFlight(AsyncTestCase):
+
+    async def test_concurrent_calls_coalesced(self):
+        single_flight = AsyncSingleFlight()
+        calls = []
+
+        async def fn(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value
+
+        results = await asyncio.gather(*[single_flight.do('key', fn, i) for i in range(8)])
+
+        self.assertEqual(calls, [0])
+        self.assertEqual(results, [0] * 8)
+        self.assertEqual(len(single_flight), 0)
+
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        single_flight = AsyncSingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            return 'done'
+
+        first = asyncio.ensure_future(single_flight.do('key', fn))
+        second = asyncio.ensure_future(single_flight.do('key', fn))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        self.assertEqual(await second, 'done')
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+
+class TestS3StorageProvisionerSingleFlight(unittest.TestCase):
+    """
+    Offline tests of coalesced provisioning, using botocore's Stubber in place of S3 and STS.
+    Each stubbed call is delayed, so that concurrent callers overlap.
+    """
+
+    test_region = AWSS3Region.USWest2
+
+    def setUp(self):
+        self.s3_provisioner = S3StorageProvisioner('AKIATEST', 'secret', default_region=self.test_region)
+        s3 = self.s3_provisioner.client_pool.client('s3', self.test_region.value)
+        sts = self.s3_provisioner.client_pool.client('sts', self.test_region.value)
+        for client in (s3, sts):
+            client.meta.events.register('before-parameter-build', lambda **kwargs: time.sleep(0.1))
+        self.s3_stub = Stubber(s3)
+        self.sts_stub = Stubber(sts)
+        self.s3_stub.activate()
+        self.sts_stub.activate()
+
+    def tearDown(self):
+        self.s3_stub.deactivate()
+        self.sts_stub.deactivate()
+
+    def test_concurrent_provisions_coalesced(self):
+        self.s3_stub.add_response('head_bucket', {})
+        self.sts_stub.add_response('get_federation_token', {
+            'Credentials': {
+                'AccessKeyId': 'ASIA' + 'X' * 16,
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            'FederatedUser': {
+                'FederatedUserId': '123456789012:user',
+                'Arn': 'arn:aws:sts::123456789012:federated-user/user',
+            },
+        })
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            storages = list(executor.map(lambda _: self.s3_provisioner.provision_storage('user', 'test-bucket',
+                                                                                         'path/'),
+                                         range(8)))
+
+        self.assertEqual(len(set(id(storage) for storage in storages)), 1)
+        self.s3_stub.assert_no_pending_responses()
+        self.sts_stub.assert_no_pending_responses()
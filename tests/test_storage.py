@@ -27,6 +27,7 @@ class TestS3Storage(unittest.TestCase):
 
     S3_BUCKET_NAME = 'MrBucket'
     S3_BUCKET_REGION = AWSS3Region.APSouthEast1
+    S3_BUCKET_PATH = 'path/to/'
     # provided by import:
     # AWS_ACCESS_KEY_ID
     # AWS_SECRET_ACCESS_KEY
@@ -41,6 +42,7 @@ class TestS3Storage(unittest.TestCase):
     def setUp(self):
         self.s3_storage = S3Storage(self.S3_BUCKET_NAME,
                                     self.S3_BUCKET_REGION,
+                                    self.S3_BUCKET_PATH,
                                     AWS_ACCESS_KEY_ID,
                                     AWS_SECRET_ACCESS_KEY,
                                     self.AWS_SESSION_TOKEN,
@@ -56,12 +58,15 @@ class TestS3Storage(unittest.TestCase):
     def test_s3_storage(self):
         self.assertEqual(self.s3_storage.s3_bucket_name, self.S3_BUCKET_NAME)
         self.assertEqual(self.s3_storage.s3_bucket_region, self.S3_BUCKET_REGION)
+        self.assertEqual(self.s3_storage.s3_bucket_path, self.S3_BUCKET_PATH)
         self.assertEqual(self.s3_storage.aws_access_key_id, AWS_ACCESS_KEY_ID)
         self.assertEqual(self.s3_storage.aws_secret_access_key, AWS_SECRET_ACCESS_KEY)
         self.assertEqual(self.s3_storage.aws_session_token, self.AWS_SESSION_TOKEN)
         self.assertEqual(self.s3_storage.aws_expiration, self.AWS_EXPIRATION)
         self.assertEqual(self.s3_storage.aws_federated_user_id, self.AWS_FEDERATED_USER_ID)
         self.assertEqual(self.s3_storage.aws_arn, self.AWS_ARN)
+        self.assertFalse(hasattr(self.s3_storage, '__dict__'))
+
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sync
+----------------------------------
+
+Tests for `sync` module.
+"""
+import os
+import tempfile
+import time
+import unittest
+
+from storage_provisioner.sync import DirectorySync
+from tests.helpers import make_storage
+from tests.test_transfer import FakeClientError, FakeS3Client
+
+
+class TestDirectorySync(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.local_dir = self.tempdir.name
+        self.client = FakeS3Client()
+        self.storage = make_storage()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, relative_path: str, data: bytes, mtime: float = None):
+        path = os.path.join(self.local_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def make_sync(self, **kwargs) -> DirectorySync:
+        return DirectorySync(self.storage, self.local_dir, prefix='live/', client=self.client, **kwargs)
+
+    def test_uploads_only_changes(self):
+        self.write('a.ts', b'a')
+        self.write('nested/b.ts', b'b')
+        self.write('.hidden.tmp', b'x')
+
+        result = self.make_sync().sync()
+        self.assertEqual(sorted(result.uploaded), ['a.ts', 'nested/b.ts'])
+        self.assertEqual(self.client.objects['path/live/nested/b.ts'], b'b')
+        self.assertNotIn('path/live/.hidden.tmp', self.client.objects)
+
+        # A new process picks up the manifest, and only uploads the new and modified files
+        self.write('c.ts', b'c')
+        self.write('a.ts', b'aa')
+        result = self.make_sync().sync()
+        self.assertEqual(sorted(result.uploaded), ['a.ts', 'c.ts'])
+        self.assertEqual(result.unchanged, 1)
+        self.assertEqual(self.client.objects['path/live/a.ts'], b'aa')
+
+    def test_touched_file_is_not_uploaded_again(self):
+        self.write('a.ts', b'a', mtime=1000)
+        sync = self.make_sync()
+        sync.sync()
+
+        self.write('a.ts', b'a', mtime=2000)
+        del self.client.objects['path/live/a.ts']
+        result = sync.sync()
+        self.assertEqual(result.uploaded, [])
+        self.assertEqual(result.unchanged, 1)
+        self.assertNotIn('path/live/a.ts', self.client.objects)
+
+    def test_failed_upload_is_retried_next_pass(self):
+        self.write('a.ts', b'a')
+        put_object = self.client.put_object
+
+        def fail(**kwargs):
+            raise FakeClientError('AccessDenied', 403)
+
+        self.client.put_object = fail
+        sync = self.make_sync()
+        result = sync.sync()
+        self.assertEqual(list(result.failed), ['a.ts'])
+
+        self.client.put_object = put_object
+        self.assertEqual(sync.sync().uploaded, ['a.ts'])
+
+    def test_unsettled_files_wait(self):
+        self.write('old.ts', b'old', mtime=time.time() - 60)
+        self.write('open.ts', b'open')
+
+        result = self.make_sync().sync(settle_sec=30)
+        self.assertEqual(result.uploaded, ['old.ts'])
+        self.assertEqual(result.unsettled, 1)
+
+    def test_manifest_for_another_storage_is_ignored(self):
+        self.write('a.ts', b'a')
+        self.make_sync().sync()
+
+        self.storage = make_storage()
+        self.storage.s3_bucket_path = 'other/'
+        self.assertEqual(self.make_sync().sync().uploaded, ['a.ts'])
+        self.assertIn('other/live/a.ts', self.client.objects)
+
+    def test_watch(self):
+        sync = self.make_sync(settle_sec=0.05)
+        sync.start(interval_sec=0.01)
+        try:
+            self.write('a.ts', b'a')
+            deadline = time.monotonic() + 5
+            while 'path/live/a.ts' not in self.client.objects and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            sync.stop()
+        self.assertEqual(self.client.objects['path/live/a.ts'], b'a')
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())
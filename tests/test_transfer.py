@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_transfer
+----------------------------------
+
+Tests for `transfer` module.
+"""
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from botocore.exceptions import EndpointConnectionError, ParamValidationError, ReadTimeoutError
+from storage_provisioner import transfer
+from tests.helpers import make_storage
+
+MiB = 1024 * 1024
+
+
+class FakeClientError(Exception):
+
+    def __init__(self, code: str, status: int):
+        Exception.__init__(self, code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+
+class FakeS3Client(object):
+    """
+    Keeps multipart uploads and objects in memory, checking each body against its ChecksumSHA256 like S3 does.
+    """
+
+    def __init__(self, failures: dict = None, get_failures: list = None):
+        # part number -> errors raised by the next upload_part calls for it
+        self.failures = {number: list(errors) for number, errors in (failures or {}).items()}
+        # errors raised by the next get_object calls
+        self.get_failures = list(get_failures or ())
+        self.uploads = {}
+        self.objects = {}
+        self.metadata = {}
+        self.range_calls = []
+        self.aborted = []
+        self.part_calls = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(body, length: int) -> bytes:
+        data = body.read()
+        assert len(data) == length
+        return data
+
+    @staticmethod
+    def _checksum(data: bytes) -> str:
+        return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+    def put_object(self, Bucket, Key, Body, ContentLength, ChecksumSHA256, **kwargs):
+        data = self._read(Body, ContentLength)
+        assert self._checksum(data) == ChecksumSHA256
+        self._store(Key, data, [len(data)], hashlib.md5(data).hexdigest(), ChecksumSHA256)
+        return {'ETag': self.metadata[Key]['ETag'], 'ChecksumSHA256': ChecksumSHA256}
+
+    def create_multipart_upload(self, Bucket, Key, ChecksumAlgorithm, **kwargs):
+        with self._lock:
+            upload_id = 'upload-{}'.format(len(self.uploads) + 1)
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentLength, ChecksumSHA256):
+        with self._lock:
+            self.part_calls.append(PartNumber)
+            errors = self.failures.get(PartNumber)
+            if errors:
+                raise errors.pop(0)
+        data = self._read(Body, ContentLength)
+        assert self._checksum(data) == ChecksumSHA256
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = (etag, ChecksumSHA256, data)
+        return {'ETag': etag, 'ChecksumSHA256': ChecksumSHA256}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        if UploadId not in self.uploads:
+            raise FakeClientError('NoSuchUpload', 404)
+        parts = [{'PartNumber': number, 'ETag': part[0], 'ChecksumSHA256': part[1]}
+                 for number, part in sorted(self.uploads[UploadId].items())]
+        return {'Parts': parts, 'IsTruncated': False}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        assert numbers == sorted(parts)
+        for part in MultipartUpload['Parts']:
+            assert parts[part['PartNumber']][:2] == (part['ETag'], part['ChecksumSHA256'])
+        md5s = b''.join(hashlib.md5(parts[number][2]).digest() for number in numbers)
+        sha256s = b''.join(base64.b64decode(parts[number][1]) for number in numbers)
+        self._store(Key, b''.join(parts[number][2] for number in numbers),
+                    [len(parts[number][2]) for number in numbers],
+                    '{}-{}'.format(hashlib.md5(md5s).hexdigest(), len(numbers)),
+                    '{}-{}'.format(self._checksum(sha256s), len(numbers)))
+        return {'ETag': self.metadata[Key]['ETag'], 'ChecksumSHA256': self.metadata[Key]['ChecksumSHA256']}
+
+    def _store(self, key: str, data: bytes, part_sizes: list, etag: str, checksum: str):
+        self.objects[key] = data
+        self.metadata[key] = {'ETag': '"{}"'.format(etag), 'ChecksumSHA256': checksum, 'PartSizes': part_sizes}
+
+    def head_object(self, Bucket, Key, ChecksumMode=None, PartNumber=None, IfMatch=None):
+        metadata = self.metadata[Key]
+        assert IfMatch in (None, metadata['ETag'])
+        head = {'ETag': metadata['ETag'], 'ContentLength': len(self.objects[Key])}
+        if PartNumber is not None:
+            head['ContentLength'] = metadata['PartSizes'][PartNumber - 1]
+        if ChecksumMode == 'ENABLED' and metadata['ChecksumSHA256'] is not None:
+            head['ChecksumSHA256'] = metadata['ChecksumSHA256']
+        return head
+
+    def get_object(self, Bucket, Key, IfMatch, Range):
+        with self._lock:
+            self.range_calls.append(Range)
+            errors = self.get_failures
+            if errors:
+                raise errors.pop(0)
+        if IfMatch != self.metadata[Key]['ETag']:
+            raise FakeClientError('PreconditionFailed', 412)
+        start, end = (int(offset) for offset in Range[len('bytes='):].split('-'))
+        return {'Body': io.BytesIO(self.objects[Key][start:end + 1])}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+        self.uploads.pop(UploadId, None)
+
+
+class TestUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = make_storage()
+        self.data = os.urandom(12 * MiB + 123)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'recording.mp4')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_small_source_uses_put_object(self):
+        client = FakeS3Client()
+        result = self.storage.upload(b'hello', 'path/hello.txt', client=client)
+
+        self.assertEqual(client.objects['path/hello.txt'], b'hello')
+        self.assertEqual(result.parts, 0)
+        self.assertEqual(result.size, 5)
+        self.assertEqual(result.checksum_sha256, base64.b64encode(hashlib.sha256(b'hello').digest()).decode('ascii'))
+
+    def test_file_multipart(self):
+        client = FakeS3Client()
+        result = self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, max_concurrency=4,
+                                     client=client)
+
+        self.assertEqual(client.objects['path/recording.mp4'], self.data)
+        self.assertEqual(result.parts, 3)
+        self.assertEqual(result.size, len(self.data))
+        self.assertTrue(result.checksum_sha256.endswith('-3'))
+
+    def test_buffer_and_file_object_multipart(self):
+        client = FakeS3Client()
+        self.storage.upload(bytearray(self.data), 'path/buffer', part_size=5 * MiB, client=client)
+        with open(self.path, 'rb') as f:
+            f.seek(MiB)
+            self.storage.upload(f, 'path/file', part_size=5 * MiB, client=client)
+
+        self.assertEqual(client.objects['path/buffer'], self.data)
+        self.assertEqual(client.objects['path/file'], self.data[MiB:])
+
+    def test_stream_multipart(self):
+        client = FakeS3Client()
+        result = self.storage.upload(io.BufferedReader(io.BytesIO(self.data)), 'path/stream', part_size=5 * MiB,
+                                     max_concurrency=2, client=client)
+
+        self.assertEqual(client.objects['path/stream'], self.data)
+        self.assertEqual(result.parts, 3)
+
+    def test_retries_failed_parts(self):
+        client = FakeS3Client(failures={2: [FakeClientError('InternalError', 500), ConnectionError()]})
+        self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, client=client)
+
+        self.assertEqual(client.objects['path/recording.mp4'], self.data)
+        self.assertEqual(client.part_calls.count(2), 3)
+
+    def test_does_not_retry_other_errors(self):
+        client = FakeS3Client(failures={2: [TypeError('invalid parameter')]})
+        with self.assertRaises(TypeError):
+            self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, client=client)
+
+        self.assertEqual(client.part_calls.count(2), 1)
+
+    def test_retryable_errors(self):
+        self.assertTrue(transfer._is_retryable(FakeClientError('SlowDown', 503)))
+        self.assertTrue(transfer._is_retryable(ReadTimeoutError(endpoint_url='https://s3.amazonaws.com')))
+        self.assertTrue(transfer._is_retryable(EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')))
+        self.assertFalse(transfer._is_retryable(FakeClientError('AccessDenied', 403)))
+        self.assertFalse(transfer._is_retryable(ParamValidationError(report='Missing required parameter')))
+
+    def test_stream_part_limit(self):
+        client = FakeS3Client()
+        data = self.data + os.urandom(3 * MiB)
+        with mock.patch.object(transfer, 'S3_MAX_PARTS', 3):
+            # A stream ending exactly at the limit fits
+            stream = io.BufferedReader(io.BytesIO(data[:15 * MiB]))
+            result = self.storage.upload(stream, 'path/stream', part_size=5 * MiB, client=client)
+            self.assertEqual(result.parts, 3)
+
+            stream = io.BufferedReader(io.BytesIO(data[:15 * MiB + 1]))
+            with self.assertRaises(ValueError):
+                self.storage.upload(stream, 'path/stream', part_size=5 * MiB, client=client)
+
+    def test_aborts_without_state_path(self):
+        client = FakeS3Client(failures={2: [FakeClientError('AccessDenied', 403)]})
+        with self.assertRaises(FakeClientError):
+            self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, client=client)
+
+        self.assertEqual(client.aborted, ['upload-1'])
+        self.assertEqual(client.part_calls.count(2), 1)
+
+    def test_resumes_interrupted_upload(self):
+        state_path = os.path.join(self.tempdir.name, 'recording.mp4.upload')
+        client = FakeS3Client(failures={3: [FakeClientError('AccessDenied', 403)]})
+        with self.assertRaises(FakeClientError):
+            self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, max_concurrency=1,
+                                state_path=state_path, client=client)
+        self.assertEqual(client.aborted, [])
+        self.assertTrue(os.path.exists(state_path))
+
+        client.part_calls = []
+        result = self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, state_path=state_path,
+                                     client=client)
+
+        self.assertEqual(client.part_calls, [3])
+        self.assertEqual(client.objects['path/recording.mp4'], self.data)
+        self.assertEqual(result.parts, 3)
+        self.assertFalse(os.path.exists(state_path))
+
+    def test_resume_restarts_when_upload_is_gone(self):
+        state_path = os.path.join(self.tempdir.name, 'recording.mp4.upload')
+        client = FakeS3Client(failures={3: [FakeClientError('AccessDenied', 403)]})
+        with self.assertRaises(FakeClientError):
+            self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, max_concurrency=1,
+                                state_path=state_path, client=client)
+        client.uploads.clear()
+
+        client.part_calls = []
+        self.storage.upload(self.path, 'path/recording.mp4', part_size=5 * MiB, state_path=state_path,
+                            client=client)
+
+        self.assertEqual(sorted(client.part_calls), [1, 2, 3])
+        self.assertEqual(client.objects['path/recording.mp4'], self.data)
+
+    def test_part_size_grows_to_fit_part_limit(self):
+        self.assertEqual(transfer._part_size_for(10 * MiB, MiB), transfer.S3_MIN_PART_SIZE)
+        size = transfer.S3_MAX_PARTS * 6 * MiB + 1
+        self.assertEqual(-(-size // transfer._part_size_for(size, 5 * MiB)), transfer.S3_MAX_PARTS)
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = make_storage()
+        self.data = os.urandom(12 * MiB + 123)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'recording.mp4')
+        self.client = FakeS3Client()
+        self.storage.upload(self.data, 'path/multipart', part_size=5 * MiB, client=self.client)
+        self.storage.upload(self.data[:MiB], 'path/single', client=self.client)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_multipart_object_fetched_by_part(self):
+        result = self.storage.download('path/multipart', self.path, part_size=MiB, max_concurrency=4,
+                                       client=self.client)
+
+        self.assertEqual(self.read(), self.data)
+        self.assertTrue(result.verified)
+        self.assertEqual(result.size, len(self.data))
+        self.assertEqual(len(self.client.range_calls), 3)
+        self.assertEqual(self.client.range_calls[0], 'bytes=0-{}'.format(5 * MiB - 1))
+
+    def test_single_object_fetched_in_ranges(self):
+        result = self.storage.download('path/single', self.path, part_size=300 * 1024, client=self.client)
+
+        self.assertEqual(self.read(), self.data[:MiB])
+        self.assertTrue(result.verified)
+        self.assertEqual(len(self.client.range_calls), 4)
+
+    def test_verifies_etag_without_checksum(self):
+        self.client.metadata['path/multipart']['ChecksumSHA256'] = None
+        result = self.storage.download('path/multipart', self.path, client=self.client)
+
+        self.assertEqual(self.read(), self.data)
+        self.assertTrue(result.verified)
+        self.assertEqual(result.checksum, self.client.metadata['path/multipart']['ETag'].strip('"'))
+
+    def test_empty_object(self):
+        self.storage.upload(b'', 'path/empty', client=self.client)
+        result = self.storage.download('path/empty', self.path, client=self.client)
+
+        self.assertEqual(self.read(), b'')
+        self.assertTrue(result.verified)
+        self.assertEqual(self.client.range_calls, [])
+
+    def test_checksum_mismatch_leaves_no_file(self):
+        self.client.objects['path/multipart'] = self.data[:-1] + bytes([self.data[-1] ^ 0xFF])
+        with self.assertRaises(transfer.ChecksumMismatchError):
+            self.storage.download('path/multipart', self.path, client=self.client)
+
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_retries_failed_ranges(self):
+        self.client.get_failures = [FakeClientError('SlowDown', 503), ConnectionError()]
+        self.storage.download('path/multipart', self.path, max_concurrency=1, client=self.client)
+
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(len(self.client.range_calls), 5)
+
+    def test_iter_download_is_ordered_and_bounded(self):
+        chunks = self.storage.iter_download('path/single', part_size=100 * 1024, max_concurrency=2,
+                                            client=self.client)
+        first = next(chunks)
+        self.assertEqual(bytes(first), self.data[:100 * 1024])
+        self.assertLessEqual(len(self.client.range_calls), 3)
+
+        self.assertEqual(bytes(first) + b''.join(chunks), self.data[:MiB])
+
+    def test_iter_download_checks_after_last_chunk(self):
+        self.client.objects['path/multipart'] = bytes([self.data[0] ^ 0xFF]) + self.data[1:]
+        chunks = self.storage.iter_download('path/multipart', client=self.client)
+        with self.assertRaises(transfer.ChecksumMismatchError):
+            list(chunks)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(unittest.main())